@@ -3,7 +3,9 @@ source reference: https://github.com/nameko/nameko/pull/357
 """
 import weakref
 import os
+from typing import Optional
 
+from fastapi import Header
 from six.moves import xrange as xrange_six, queue as queue_six
 from nameko.standalone.rpc import ClusterRpcClient
 from nameko import config
@@ -28,6 +30,7 @@ class ClusterRpcProxyPool(object):
             self.pool = weakref.proxy(pool)
             self.proxy = ClusterRpcClient(uri=uri, timeout=timeout)
             self.rpc = self.proxy.start()
+            self.context_data = {}
 
         def stop(self):
             self.proxy.stop()
@@ -35,9 +38,13 @@ class ClusterRpcProxyPool(object):
             self.rpc = None
 
         def __enter__(self):
+            # The client sends its context data with every call.
+            self.rpc.context_data.update(self.context_data)
             return self.rpc
 
         def __exit__(self, *args, **kwargs):
+            for key in self.context_data:
+                self.rpc.context_data.pop(key, None)
             try:
                 self.pool._put_back(self)
             except ReferenceError:  # pragma: no cover
@@ -58,11 +65,13 @@ class ClusterRpcProxyPool(object):
             ctx = ClusterRpcProxyPool.RpcContext(self, self.uri, self.timeout)
             self.queue.put(ctx)
 
-    def next(self, timeout=None):
-        """ Fetch next connection.
+    def next(self, timeout=None, context_data=None):
+        """ Fetch next connection, whose calls carry `context_data`.
         This method is thread-safe.
         """
-        return self.queue.get(timeout=timeout)
+        ctx = self.queue.get(timeout=timeout)
+        ctx.context_data = context_data or {}
+        return ctx
 
     def _put_back(self, ctx):
         self.queue.put(ctx)
@@ -95,7 +104,19 @@ NAMEKO_POOL.start()
 def destroy_nameko_pool():
     NAMEKO_POOL.stop()
 
-def get_rpc():
-    yield NAMEKO_POOL
+class ClientRpcProxyPool(object):
+    """ The pool as seen by one request, passing its `X-Client-Id` header
+    on as the `client_id` context data of every call, like the gateway
+    service does.
+    """
+    def __init__(self, pool, client_id=None):
+        self.pool = pool
+        self.context_data = {'client_id': client_id} if client_id else {}
+
+    def next(self, timeout=None):
+        return self.pool.next(timeout, self.context_data)
+
+def get_rpc(x_client_id: Optional[str] = Header(None)):
+    yield ClientRpcProxyPool(NAMEKO_POOL, x_client_id)
 
 config = config
\ No newline at end of file
@@ -1,7 +1,8 @@
+from datetime import datetime
 from os import name
-from fastapi import APIRouter, status, HTTPException
+from fastapi import APIRouter, status, HTTPException, Query
 from fastapi.params import Depends
-from typing import List
+from typing import List, Optional
 from gateapi.api import schemas
 from gateapi.api.dependencies import get_rpc, config
 from .exceptions import OrderNotFound
@@ -11,6 +12,26 @@ router = APIRouter(
     tags = ['Orders']
 )
 
+@router.get("", status_code=status.HTTP_200_OK, response_model=schemas.OrderPage)
+def list_orders(
+    limit: int = Query(100, ge=1, le=1000),
+    after_id: Optional[int] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    product_id: Optional[str] = None,
+    rpc = Depends(get_rpc)
+):
+    # Order timestamps are stored in UTC.
+    filters = {}
+    if created_from is not None:
+        filters['created_from'] = created_from.isoformat()
+    if created_to is not None:
+        filters['created_to'] = created_to.isoformat()
+    if product_id is not None:
+        filters['product_id'] = product_id
+    with rpc.next() as nameko:
+        return nameko.orders.list_orders_page(limit, after_id, filters)
+
 @router.get("/{order_id}", status_code=status.HTTP_200_OK)
 def get_order(order_id: int, rpc = Depends(get_rpc)):
     try:
@@ -28,9 +49,12 @@ def _get_order(order_id, nameko_rpc):
     with nameko_rpc.next() as nameko:
         order = nameko.orders.get_order(order_id)
 
-    # Retrieve all products from the products service
+    # Retrieve the products on the order from the products service
     with nameko_rpc.next() as nameko:
-        product_map = {prod['id']: prod for prod in nameko.products.list()}
+        products = nameko.products.get_many(
+            [item['product_id'] for item in order['order_details']]
+        )
+        product_map = {prod['id']: prod for prod in products['products']}
 
     # get the configured image root
     image_root = config['PRODUCT_IMAGE_ROOT']
@@ -55,11 +79,12 @@ def create_order(request: schemas.CreateOrder, rpc = Depends(get_rpc)):
 def _create_order(order_data, nameko_rpc):
     # check order product ids are valid
     with nameko_rpc.next() as nameko:
-        valid_product_ids = {prod['id'] for prod in nameko.products.list()}
-        for item in order_data['order_details']:
-            if item['product_id'] not in valid_product_ids:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                    detail=f"Product with id {item['product_id']} not found"
+        products = nameko.products.get_many(
+            [item['product_id'] for item in order_data['order_details']]
+        )
+        if products['missing']:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Product with id {products['missing'][0]} not found"
             )
         # Call orders-service to create the order.
         result = nameko.orders.create_order(
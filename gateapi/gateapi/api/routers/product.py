@@ -1,19 +1,48 @@
-from fastapi import APIRouter, status, HTTPException
+from typing import List, Optional
+from fastapi import APIRouter, status, HTTPException, Query, Response
 from fastapi.params import Depends
 from gateapi.api.dependencies import get_rpc
 from gateapi.api import schemas
-from .exceptions import ProductNotFound
+from .exceptions import ProductNotFound, InvalidCursor
 
 router = APIRouter(
     prefix = "/products",
     tags = ["Products"]
 )
 
+@router.get("", status_code=status.HTTP_200_OK, response_model=schemas.ProductPage)
+def list_products(limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None, rpc = Depends(get_rpc)):
+    try:
+        with rpc.next() as nameko:
+            return nameko.products.list_page(limit, cursor)
+    except InvalidCursor as error:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(error)
+        )
+
+@router.get("/search", status_code=status.HTTP_200_OK, response_model=List[schemas.Product])
+def search_products(title: str = "", limit: int = Query(10, ge=1, le=1000), rpc = Depends(get_rpc)):
+    with rpc.next() as nameko:
+        return nameko.products.search_title(title, limit)
+
+@router.get("/stats", status_code=status.HTTP_200_OK, response_model=List[schemas.ProductSales])
+def get_product_stats(ids: str, rpc = Depends(get_rpc)):
+    product_ids = list(dict.fromkeys(product_id for product_id in ids.split(',') if product_id))
+    if not product_ids or len(product_ids) > 1000:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Expected a comma separated list of 1 to 1000 product ids"
+        )
+    with rpc.next() as nameko:
+        return nameko.orders.product_stats(product_ids)
+
 @router.get("/{product_id}", status_code=status.HTTP_200_OK, response_model=schemas.Product)
 def get_product(product_id: str, rpc = Depends(get_rpc)):
     try: 
         with rpc.next() as nameko:
-            return nameko.products.get(product_id)
+            # Pass the rendered document through without validating it again.
+            return Response(nameko.products.get_json(product_id), media_type="application/json")
     except ProductNotFound as error:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
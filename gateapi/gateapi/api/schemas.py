@@ -1,5 +1,6 @@
+from datetime import datetime
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 class Product(BaseModel):
     id: str
@@ -9,6 +10,18 @@ class Product(BaseModel):
     in_stock: int
 
 
+class ProductPage(BaseModel):
+    products: List[Product]
+    next_cursor: Optional[str]
+
+
+class ProductSales(BaseModel):
+    product_id: str
+    units: int
+    revenue: str
+    order_count: int
+    last_ordered_at: Optional[datetime]
+
 class CreateOrderDetail(BaseModel):
     product_id: str
     price: float
@@ -17,6 +30,20 @@ class CreateOrderDetail(BaseModel):
 class CreateOrder(BaseModel):
     order_details: List[CreateOrderDetail]
 
+class OrderDetail(BaseModel):
+    id: int
+    product_id: str
+    price: str
+    quantity: int
+
+class Order(BaseModel):
+    id: int
+    order_details: List[OrderDetail]
+
+class OrderPage(BaseModel):
+    orders: List[Order]
+    next_after_id: Optional[int]
+
 class CreateOrderSuccess(BaseModel):
     id: int
 
@@ -3,20 +3,43 @@ import json
 from marshmallow import ValidationError
 from nameko.exceptions import safe_for_serialization, BadRequest
 from nameko.web.handlers import HttpRequestHandler
+from nameko.web.server import WebServer
 from werkzeug import Response
 
-from gateway.exceptions import ProductNotFound, OrderNotFound
+from gateway.exceptions import ProductNotFound, OrderNotFound, InvalidCursor, OutOfStock
+
+# Request header identifying the client, passed on to the services as the
+# `client_id` context data so that the orders service can send the
+# client's reads after its own writes to the primary database.
+CLIENT_ID_HEADER = 'X-Client-Id'
+
+
+class ClientWebServer(WebServer):
+    """ Web server that adds the client id of each request to the context
+    data of its worker, which is sent along with every RPC call it makes.
+    """
+
+    def context_data_from_headers(self, request):
+        context_data = super(ClientWebServer, self).context_data_from_headers(request)
+        client_id = request.headers.get(CLIENT_ID_HEADER)
+        if client_id:
+            context_data['client_id'] = client_id
+        return context_data
 
 
 class HttpEntrypoint(HttpRequestHandler):
     """ Overrides `response_from_exception` so we can customize error handling.
     """
 
+    server = ClientWebServer()
+
     mapped_errors = {
         BadRequest: (400, 'BAD_REQUEST'),
         ValidationError: (400, 'VALIDATION_ERROR'),
         ProductNotFound: (404, 'PRODUCT_NOT_FOUND'),
         OrderNotFound: (404, 'ORDER_NOT_FOUND'),
+        InvalidCursor: (400, 'INVALID_CURSOR'),
+        OutOfStock: (409, 'OUT_OF_STOCK'),
     }
 
     def response_from_exception(self, exc):
@@ -28,3 +28,13 @@ class OrderNotFound(Exception):
 @remote_error('products.exceptions.NotFound')
 class ProductNotFound(Exception):
     pass
+
+
+@remote_error('products.exceptions.OutOfStock')
+class OutOfStock(Exception):
+    pass
+
+
+@remote_error('products.exceptions.InvalidCursor')
+class InvalidCursor(Exception):
+    pass
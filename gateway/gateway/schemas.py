@@ -21,6 +21,11 @@ class ProductSchema(Schema):
     passenger_capacity = fields.Int(required=True)
 
 
+class ProductPageSchema(Schema):
+    products = fields.Nested(ProductSchema, many=True)
+    next_cursor = fields.Str(allow_none=True)
+
+
 class GetOrderSchema(Schema):
 
     class OrderDetail(Schema):
@@ -33,3 +38,8 @@ class GetOrderSchema(Schema):
 
     id = fields.Int()
     order_details = fields.Nested(OrderDetail, many=True)
+
+
+class OrderPageSchema(Schema):
+    orders = fields.Nested(GetOrderSchema, many=True)
+    next_after_id = fields.Int(allow_none=True)
@@ -1,3 +1,4 @@
+import datetime
 import json
 
 from marshmallow import ValidationError
@@ -7,8 +8,16 @@ from nameko.rpc import RpcProxy
 from werkzeug import Response
 
 from gateway.entrypoints import http
-from gateway.exceptions import OrderNotFound, ProductNotFound
-from gateway.schemas import CreateOrderSchema, GetOrderSchema, ProductSchema
+from gateway.exceptions import InvalidCursor, OrderNotFound, OutOfStock, ProductNotFound
+from gateway.schemas import CreateOrderSchema, GetOrderSchema, OrderPageSchema, ProductPageSchema, ProductSchema
+
+
+ORDER_PAGE_ARGS = ('limit', 'after_id', 'created_from', 'created_to', 'product_id')
+
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_CHUNK_SIZE = 1000
+
+MAX_STATS_PRODUCTS = 1000
 
 
 class GatewayService(object):
@@ -30,8 +39,20 @@ class GatewayService(object):
             return Response(status=418)
 
 
-    @http("GET", "/products")
+    @http("GET", "/products", expected_exceptions=(BadRequest, InvalidCursor))
     def list_products(self, request: str):
+        """Lists products. Passing `limit` and/or `cursor` query parameters
+        returns a single page instead of the whole catalog ::
+
+            GET /products?limit=100&cursor=TFoxMjk=
+
+            {"products": [...], "next_cursor": "TFoxMzA="}
+
+        `next_cursor` is null on the last page.
+        """
+        if 'limit' in request.args or 'cursor' in request.args:
+            return self._list_products_page(request)
+
         products = self.products_rpc.list()
 
         products = list(map(lambda product: ProductSchema().dumps(product).data, products))
@@ -39,13 +60,72 @@ class GatewayService(object):
         return Response(products, mimetype='application/json')
 
 
+    def _list_products_page(self, request):
+        try:
+            limit = int(request.args.get('limit', 100))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise BadRequest("Invalid limit: {}".format(request.args['limit']))
+
+        page = self.products_rpc.list_page(limit, request.args.get('cursor'))
+
+        return Response(ProductPageSchema().dumps(page).data, mimetype='application/json')
+
+
+    @http("GET", "/products/search", expected_exceptions=BadRequest)
+    def search_products(self, request: str):
+        """Autocomplete products by title prefix ::
+
+            GET /products/search?title=lz%2012&limit=10
+
+        Matching ignores case and repeated whitespace. Results are ordered
+        by title.
+        """
+        try:
+            limit = int(request.args.get('limit', 10))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise BadRequest("Invalid limit: {}".format(request.args['limit']))
+
+        products = self.products_rpc.search_title(request.args.get('title', ''), limit)
+
+        return Response(ProductSchema(many=True).dumps(products).data, mimetype='application/json')
+
+
+    @http("GET", "/products/stats", expected_exceptions=BadRequest)
+    def get_product_stats(self, request):
+        """Gets the sales of products over all orders ::
+
+            GET /products/stats?ids=LZ127,LZ129
+
+        Returns units sold, revenue, order count and the time each product
+        was last ordered, in the order of `ids`. Products without orders
+        have zero sales.
+        """
+        product_ids = list(dict.fromkeys(
+            product_id for product_id in request.args.get('ids', '').split(',') if product_id
+        ))
+        if not product_ids:
+            raise BadRequest("Expected a comma separated list of product ids")
+        if len(product_ids) > MAX_STATS_PRODUCTS:
+            raise BadRequest("At most {} product ids are allowed".format(MAX_STATS_PRODUCTS))
+
+        stats = self.orders_rpc.product_stats(product_ids)
+
+        return Response(json.dumps(stats), mimetype='application/json')
+
+
     @http("GET", "/products/<string:product_id>", expected_exceptions=ProductNotFound)
     def get_product(self, request: str, product_id: str):
         """Gets product by `product_id`
+
+        The products service renders the document, so it is passed on as is.
         """
-        product = self.products_rpc.get(product_id)
+        document = self.products_rpc.get_json(product_id)
 
-        return Response(ProductSchema().dumps(product).data, mimetype='application/json')
+        return Response(document, mimetype='application/json')
 
 
     @http("POST", "/products", expected_exceptions=(ValidationError, BadRequest))
@@ -86,6 +166,77 @@ class GatewayService(object):
         )
 
 
+    @http("POST", "/products/bulk", expected_exceptions=(ValidationError, BadRequest))
+    def create_products(self, request: str):
+        """Create many products at once - a json list of products is posted
+
+        Items are validated individually. Valid items are stored and invalid
+        ones are reported by their position in the list ::
+
+            {
+                "created": ["the_odyssey"],
+                "errors": {"1": {"in_stock": ["Not a valid integer."]}}
+            }
+
+        """
+        try:
+            products = json.loads(request.get_data(as_text=True))
+        except ValueError as exc:
+            raise BadRequest("Invalid json: {}".format(exc))
+
+        if not isinstance(products, list):
+            raise BadRequest("Expected a json list of products")
+
+        result = self.products_rpc.create_many(products)
+        return Response(json.dumps(result), mimetype='application/json')
+
+
+    @http("PATCH", "/products/<string:product_id>",
+          expected_exceptions=(ValidationError, BadRequest, ProductNotFound))
+    def update_product(self, request: str, product_id: str):
+        """Update some fields of a product - the fields are posted as json ::
+
+            {"title": "The Odyssey II", "maximum_speed": 7}
+
+        The product id cannot be changed. The response contains the updated
+        product.
+        """
+        schema = ProductSchema(strict=True, partial=True, exclude=('id',))
+
+        try:
+            fields = schema.loads(request.get_data(as_text=True)).data
+        except ValueError as exc:
+            raise BadRequest("Invalid json: {}".format(exc))
+
+        product = self.products_rpc.update(product_id, fields)
+        return Response(ProductSchema().dumps(product).data, mimetype='application/json')
+
+
+    @http("POST", "/products/restock", expected_exceptions=(BadRequest, ProductNotFound, OutOfStock))
+    def restock_products(self, request: str):
+        """Change the stock of many products at once - a json object of
+        stock changes by product id is posted ::
+
+            {"the_odyssey": 20, "LZ127": -2}
+
+        All changes are applied together or, if a product does not exist
+        or would run out of stock, not at all. The response contains the
+        new stock levels by product id.
+        """
+        try:
+            deltas = json.loads(request.get_data(as_text=True))
+        except ValueError as exc:
+            raise BadRequest("Invalid json: {}".format(exc))
+
+        if not isinstance(deltas, dict) or not all(
+            isinstance(delta, int) and not isinstance(delta, bool) for delta in deltas.values()
+        ):
+            raise BadRequest("Expected a json object of integer stock changes")
+
+        levels = self.products_rpc.restock_many(deltas)
+        return Response(json.dumps(levels), mimetype='application/json')
+
+
     @http("DELETE", "/products/<string:product_id>", expected_exceptions=ProductNotFound)
     def delete_product(self, request: str, product_id: str):
         """Delete a product by its ID
@@ -98,8 +249,22 @@ class GatewayService(object):
         return Response(status=204, mimetype='application/json')
 
 
-    @http("GET", "/orders")
+    @http("GET", "/orders", expected_exceptions=BadRequest)
     def list_orders(self, request):
+        """Lists orders. Passing any of the `limit`, `after_id`,
+        `created_from`, `created_to` or `product_id` query parameters returns
+        a single page of matching orders in id order instead ::
+
+            GET /orders?limit=100&after_id=1200&product_id=the_odyssey
+
+            {"orders": [...], "next_after_id": 1300}
+
+        `created_from` (inclusive) and `created_to` (exclusive) are ISO 8601
+        datetimes. `next_after_id` is null on the last page.
+        """
+        if any(arg in request.args for arg in ORDER_PAGE_ARGS):
+            return self._list_orders_page(request)
+
         orders = self.orders_rpc.list_orders()
 
         orders = list(map(lambda order: GetOrderSchema().dumps(order).data, orders))
@@ -108,6 +273,71 @@ class GatewayService(object):
 
 
 
+    def _list_orders_page(self, request):
+        try:
+            limit = int(request.args.get('limit', 100))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise BadRequest("Invalid limit: {}".format(request.args['limit']))
+
+        after_id = request.args.get('after_id')
+        if after_id is not None:
+            try:
+                after_id = int(after_id)
+            except ValueError:
+                raise BadRequest("Invalid after_id: {}".format(after_id))
+
+        filters = {}
+        for arg in ('created_from', 'created_to'):
+            if arg in request.args:
+                try:
+                    datetime.datetime.fromisoformat(request.args[arg])
+                except ValueError:
+                    raise BadRequest("Invalid {}: {}".format(arg, request.args[arg]))
+                filters[arg] = request.args[arg]
+        if 'product_id' in request.args:
+            filters['product_id'] = request.args['product_id']
+
+        page = self.orders_rpc.list_orders_page(limit, after_id, filters)
+
+        return Response(OrderPageSchema().dumps(page).data, mimetype='application/json')
+
+
+    @http("GET", "/orders/export", expected_exceptions=BadRequest)
+    def export_orders(self, request):
+        """Streams every order with its details as NDJSON or CSV, one row
+        per order detail ::
+
+            GET /orders/export?format=csv
+
+        The response is sent in chunks as they are read from the orders
+        service, so neither service holds the whole export in memory.
+
+        The first chunk is read before the response starts, so a failure
+        there gets an error status. Later chunks are read while the body
+        is sent, after the worker returned: the container does not wait
+        for them on shutdown, and a failure cuts the body short with the
+        status already sent as 200. Clients should check that the last
+        line of an export is complete, ending with a line break.
+        """
+        format = request.args.get('format', 'ndjson')
+        if format not in EXPORT_MIMETYPES:
+            raise BadRequest("Invalid format: {}".format(format))
+
+        first = self.orders_rpc.export_orders_chunk(format, None, EXPORT_CHUNK_SIZE)
+
+        def chunks():
+            chunk = first
+            while True:
+                yield chunk['data']
+                if chunk['next_after_id'] is None:
+                    return
+                chunk = self.orders_rpc.export_orders_chunk(format, chunk['next_after_id'], EXPORT_CHUNK_SIZE)
+
+        return Response(chunks(), mimetype=EXPORT_MIMETYPES[format])
+
+
     @http("GET", "/orders/<int:order_id>", expected_exceptions=OrderNotFound)
     def get_order(self, request: str, order_id: int):
         """Gets the order details for the order given by `order_id`.
@@ -127,11 +357,19 @@ class GatewayService(object):
         # get the configured image root
         image_root = config['PRODUCT_IMAGE_ROOT']
 
+        # Fetch every product on the order with a single call.
+        products = self.products_rpc.get_many(
+            [item['product_id'] for item in order['order_details']]
+        )
+        if products['missing']:
+            raise ProductNotFound("Product Id {}".format(products['missing'][0]))
+        product_map = {product['id']: product for product in products['products']}
+
         # Enhance order details with product and image details.
         for item in order['order_details']:
             product_id = item['product_id']
 
-            item['product'] = self.products_rpc.get(product_id)
+            item['product'] = product_map[product_id]
             # Construct an image url.
             item['image'] = '{}/{}.jpg'.format(image_root, product_id)
 
@@ -182,10 +420,11 @@ class GatewayService(object):
 
     def _create_order(self, order_data):
         # check order product ids are valid
-        for item in order_data['order_details']:
-            valid_id = self.products_rpc.get(item['product_id'])
-            if not valid_id:
-                raise ProductNotFound("Product Id {}".format(item['product_id']))
+        products = self.products_rpc.get_many(
+            [item['product_id'] for item in order_data['order_details']]
+        )
+        if products['missing']:
+            raise ProductNotFound("Product Id {}".format(products['missing'][0]))
 
         # Call orders-service to create the order.
         # Dump the data through the schema to ensure the values are serialized
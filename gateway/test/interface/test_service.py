@@ -1,23 +1,24 @@
 import json
 
 import pytest
-from mock import call
+from mock import Mock, call
+from nameko.exceptions import BadRequest
 
-from gateway.exceptions import OrderNotFound, ProductNotFound
+from gateway.exceptions import InvalidCursor, OrderNotFound, ProductNotFound
 
 
 class TestGetProduct(object):
     def test_can_get_product(self, service):
-        service.products_rpc.get.return_value = {
+        service.products_rpc.get_json.return_value = json.dumps({
             "in_stock": 10,
             "maximum_speed": 5,
             "id": "the_odyssey",
             "passenger_capacity": 101,
             "title": "The Odyssey"
-        }
+        })
         response = service.get_product("req", 'the_odyssey')
         assert response.status_code == 200
-        assert service.products_rpc.get.call_args_list == [
+        assert service.products_rpc.get_json.call_args_list == [
             call("the_odyssey")
         ]
         assert response.json == {
@@ -29,7 +30,7 @@ class TestGetProduct(object):
         }
 
     def test_product_not_found(self, service):
-        service.products_rpc.get.side_effect = (ProductNotFound('missing'))
+        service.products_rpc.get_json.side_effect = (ProductNotFound('missing'))
 
         # call the gateway service to get order #1
         response = service.get_product("req", '/products/foo')
@@ -38,6 +39,196 @@ class TestGetProduct(object):
         assert payload['error'] == 'PRODUCT_NOT_FOUND'
         assert payload['message'] == 'missing'
 
+
+class TestListProducts(object):
+
+    def test_can_list_products_page(self, service):
+        service.products_rpc.list_page.return_value = {
+            "products": [{
+                "in_stock": 10,
+                "maximum_speed": 5,
+                "id": "the_odyssey",
+                "passenger_capacity": 101,
+                "title": "The Odyssey"
+            }],
+            "next_cursor": "dGhlX29keXNzZXk="
+        }
+        request = Mock(args={'limit': '1', 'cursor': 'abc='})
+
+        response = service.list_products(request)
+
+        assert response.status_code == 200
+        assert service.products_rpc.list_page.call_args_list == [
+            call(1, 'abc=')
+        ]
+        assert response.json['next_cursor'] == "dGhlX29keXNzZXk="
+        assert [p['id'] for p in response.json['products']] == ['the_odyssey']
+
+    def test_list_products_page_fails_with_invalid_limit(self, service):
+        request = Mock(args={'limit': 'many'})
+
+        with pytest.raises(BadRequest) as exc_info:
+            service.list_products(request)
+        assert exc_info.value.args[0] == 'Invalid limit: many'
+        assert service.products_rpc.list_page.call_count == 0
+
+    def test_list_products_page_fails_with_invalid_cursor(self, service):
+        service.products_rpc.list_page.side_effect = InvalidCursor('bad')
+        request = Mock(args={'cursor': 'bad'})
+
+        with pytest.raises(InvalidCursor) as exc_info:
+            service.list_products(request)
+        assert exc_info.value.args[0] == 'bad'
+
+
+class TestSearchProducts(object):
+
+    def test_can_search_products_by_title(self, service):
+        service.products_rpc.search_title.return_value = [{
+            "in_stock": 10,
+            "maximum_speed": 5,
+            "id": "the_odyssey",
+            "passenger_capacity": 101,
+            "title": "The Odyssey"
+        }]
+        request = Mock(args={'title': 'the od', 'limit': '5'})
+
+        response = service.search_products(request)
+
+        assert response.status_code == 200
+        assert service.products_rpc.search_title.call_args_list == [
+            call('the od', 5)
+        ]
+        assert [p['id'] for p in response.json] == ['the_odyssey']
+
+    def test_search_products_fails_with_invalid_limit(self, service):
+        request = Mock(args={'title': 'the', 'limit': '0'})
+
+        with pytest.raises(BadRequest) as exc_info:
+            service.search_products(request)
+        assert exc_info.value.args[0] == 'Invalid limit: 0'
+        assert service.products_rpc.search_title.call_count == 0
+
+
+class TestGetProductStats(object):
+
+    def test_can_get_product_stats(self, service):
+        stats = [{
+            'product_id': 'the_odyssey', 'units': 3, 'revenue': '29.97',
+            'order_count': 2, 'last_ordered_at': '2024-01-01T10:00:00+00:00'
+        }]
+        service.orders_rpc.product_stats.return_value = stats
+
+        response = service.get_product_stats(Mock(args={'ids': 'the_odyssey,,the_odyssey'}))
+
+        assert response.status_code == 200
+        assert service.orders_rpc.product_stats.call_args_list == [call(['the_odyssey'])]
+        assert response.json == stats
+
+    def test_product_stats_need_product_ids(self, service):
+        with pytest.raises(BadRequest) as exc_info:
+            service.get_product_stats(Mock(args={}))
+        assert exc_info.value.args[0] == 'Expected a comma separated list of product ids'
+        assert service.orders_rpc.product_stats.call_count == 0
+
+
+class TestUpdateProduct(object):
+
+    def test_can_update_product(self, service):
+        service.products_rpc.update.return_value = {
+            "in_stock": 10,
+            "maximum_speed": 7,
+            "id": "the_odyssey",
+            "passenger_capacity": 101,
+            "title": "The Odyssey II"
+        }
+        request = Mock()
+        request.get_data.return_value = json.dumps(
+            {"title": "The Odyssey II", "maximum_speed": 7, "id": "other"}
+        )
+
+        response = service.update_product(request, "the_odyssey")
+
+        assert response.status_code == 200
+        assert service.products_rpc.update.call_args_list == [
+            call("the_odyssey", {"title": "The Odyssey II", "maximum_speed": 7})
+        ]
+        assert response.json["title"] == "The Odyssey II"
+
+    def test_update_product_fails_with_invalid_json(self, service):
+        request = Mock()
+        request.get_data.return_value = "{"
+
+        with pytest.raises(BadRequest):
+            service.update_product(request, "the_odyssey")
+        assert service.products_rpc.update.call_count == 0
+
+
+class TestRestockProducts(object):
+
+    def test_can_restock_products(self, service):
+        service.products_rpc.restock_many.return_value = {"the_odyssey": 30, "LZ127": 8}
+        request = Mock()
+        request.get_data.return_value = json.dumps({"the_odyssey": 20, "LZ127": -2})
+
+        response = service.restock_products(request)
+
+        assert response.status_code == 200
+        assert response.json == {"the_odyssey": 30, "LZ127": 8}
+        assert service.products_rpc.restock_many.call_args_list == [
+            call({"the_odyssey": 20, "LZ127": -2})
+        ]
+
+    @pytest.mark.parametrize('body', [
+        json.dumps([{"the_odyssey": 20}]),
+        json.dumps({"the_odyssey": "20"}),
+    ])
+    def test_restock_products_fails_with_invalid_body(self, service, body):
+        request = Mock()
+        request.get_data.return_value = body
+
+        with pytest.raises(BadRequest) as exc_info:
+            service.restock_products(request)
+        assert exc_info.value.args[0] == "Expected a json object of integer stock changes"
+        assert service.products_rpc.restock_many.call_count == 0
+
+
+class TestCreateProducts(object):
+
+    def test_can_create_products(self, service):
+        service.products_rpc.create_many.return_value = {
+            'created': ['the_odyssey'],
+            'errors': {'1': {'id': ['Missing data for required field.']}}
+        }
+        products = [
+            {
+                "in_stock": 10,
+                "maximum_speed": 5,
+                "id": "the_odyssey",
+                "passenger_capacity": 101,
+                "title": "The Odyssey"
+            },
+            {"title": "No id"}
+        ]
+        request = Mock()
+        request.get_data.return_value = json.dumps(products)
+
+        response = service.create_products(request)
+
+        assert response.status_code == 200
+        assert response.json['created'] == ['the_odyssey']
+        assert service.products_rpc.create_many.call_args_list == [
+            call(products)
+        ]
+
+    def test_create_products_requires_a_list(self, service):
+        request = Mock()
+        request.get_data.return_value = json.dumps({"id": "the_odyssey"})
+
+        with pytest.raises(BadRequest):
+            service.create_products(request)
+        assert service.products_rpc.create_many.call_count == 0
+
 # class TestCreateProduct(object):
 #     def test_can_create_product(self, service, web_session):
 #         response = web_session.post(
@@ -109,12 +300,15 @@ class TestGetOrder(object):
         }
 
         # setup mock products-service response:
-        service.products_rpc.get.return_value = {
-            'id': 'the_odyssey',
-            'title': 'The Odyssey',
-            'maximum_speed': 3,
-            'in_stock': 899,
-            'passenger_capacity': 100
+        service.products_rpc.get_many.return_value = {
+            'products': [{
+                'id': 'the_odyssey',
+                'title': 'The Odyssey',
+                'maximum_speed': 3,
+                'in_stock': 899,
+                'passenger_capacity': 100
+            }],
+            'missing': []
         }
 
         # call the gateway service to get order #1
@@ -145,7 +339,10 @@ class TestGetOrder(object):
 
         # check dependencies called as expected
         assert service.orders_rpc.get_order.call_count == 1
-        assert service.products_rpc.get.call_count == 1
+        assert service.products_rpc.get_many.call_args_list == [
+            call(['the_odyssey'])
+        ]
+        assert service.products_rpc.get.call_count == 0
 
     def test_order_not_found(self, service):
         service.orders_rpc.get_order.side_effect = (OrderNotFound('missing'))
@@ -156,6 +353,58 @@ class TestGetOrder(object):
         assert service.orders_rpc.get_order.call_count == 1
 
 
+class TestCreateOrder(object):
+
+    def test_can_create_order(self, service):
+        service.products_rpc.get_many.return_value = {
+            'products': [{
+                'id': 'the_odyssey',
+                'title': 'The Odyssey',
+                'maximum_speed': 3,
+                'in_stock': 899,
+                'passenger_capacity': 100
+            }],
+            'missing': []
+        }
+        service.orders_rpc.create_order.return_value = {
+            'id': 11,
+            'order_details': []
+        }
+        request = Mock()
+        request.get_data.return_value = json.dumps({
+            'order_details': [
+                {'product_id': 'the_odyssey', 'price': '41.00', 'quantity': 3},
+                {'product_id': 'the_odyssey', 'price': '41.00', 'quantity': 1}
+            ]
+        })
+
+        response = service.create_order(request)
+
+        assert response.status_code == 200
+        assert response.json == {'id': 11}
+        assert service.products_rpc.get_many.call_args_list == [
+            call(['the_odyssey', 'the_odyssey'])
+        ]
+        assert service.orders_rpc.create_order.call_count == 1
+
+    def test_create_order_fails_with_unknown_product(self, service):
+        service.products_rpc.get_many.return_value = {
+            'products': [],
+            'missing': ['unknown']
+        }
+        request = Mock()
+        request.get_data.return_value = json.dumps({
+            'order_details': [
+                {'product_id': 'unknown', 'price': '41', 'quantity': 1}
+            ]
+        })
+
+        with pytest.raises(ProductNotFound) as exc_info:
+            service.create_order(request)
+        assert exc_info.value.args[0] == 'Product Id unknown'
+        assert service.orders_rpc.create_order.call_count == 0
+
+
 # class TestCreateOrder(object):
 #
 #     def test_can_create_order(self, service):
@@ -287,7 +536,7 @@ class TestListOrders(object):
             ]
         }]
 
-        response = service.list_orders("req")
+        response = service.list_orders(Mock(args={}))
 
         expected_response = {
             'id': 1,
@@ -304,3 +553,74 @@ class TestListOrders(object):
 
         # check dependencies called as expected
         assert service.orders_rpc.list_orders.call_count == 1
+
+    def test_can_list_orders_page(self, service):
+        service.orders_rpc.list_orders_page.return_value = {
+            'orders': [{
+                'id': 3,
+                'order_details': [
+                    {
+                        'id': 5,
+                        'quantity': 2,
+                        'product_id': 'the_odyssey',
+                        'price': '200.00'
+                    }
+                ]
+            }],
+            'next_after_id': 3
+        }
+        request = Mock(args={
+            'limit': '1',
+            'after_id': '2',
+            'created_from': '2024-01-01T00:00:00',
+            'product_id': 'the_odyssey'
+        })
+
+        response = service.list_orders(request)
+
+        assert response.status_code == 200
+        assert service.orders_rpc.list_orders_page.call_args_list == [
+            call(1, 2, {'created_from': '2024-01-01T00:00:00', 'product_id': 'the_odyssey'})
+        ]
+        assert response.json['next_after_id'] == 3
+        assert [order['id'] for order in response.json['orders']] == [3]
+        assert service.orders_rpc.list_orders.call_count == 0
+
+    @pytest.mark.parametrize('args, message', [
+        ({'limit': 'all'}, 'Invalid limit: all'),
+        ({'after_id': 'x'}, 'Invalid after_id: x'),
+        ({'created_to': 'tomorrow'}, 'Invalid created_to: tomorrow'),
+    ])
+    def test_list_orders_page_fails_with_invalid_args(self, service, args, message):
+        with pytest.raises(BadRequest) as exc_info:
+            service.list_orders(Mock(args=args))
+        assert exc_info.value.args[0] == message
+        assert service.orders_rpc.list_orders_page.call_count == 0
+
+
+class TestExportOrders(object):
+
+    def test_can_export_orders(self, service):
+        service.orders_rpc.export_orders_chunk.side_effect = [
+            {'data': 'order_id,quantity\r\n1,2\r\n', 'next_after_id': 1},
+            {'data': '2,5\r\n', 'next_after_id': None},
+        ]
+
+        response = service.export_orders(Mock(args={'format': 'csv'}))
+
+        assert response.mimetype == 'text/csv'
+        assert response.get_data(as_text=True) == 'order_id,quantity\r\n1,2\r\n2,5\r\n'
+        assert service.orders_rpc.export_orders_chunk.call_args_list == [
+            call('csv', None, 1000), call('csv', 1, 1000)
+        ]
+
+    def test_export_orders_reads_first_chunk_before_responding(self, service):
+        service.orders_rpc.export_orders_chunk.side_effect = ConnectionError('closed')
+
+        with pytest.raises(ConnectionError):
+            service.export_orders(Mock(args={'format': 'ndjson'}))
+
+    def test_export_orders_fails_with_invalid_format(self, service):
+        with pytest.raises(BadRequest) as exc_info:
+            service.export_orders(Mock(args={'format': 'xml'}))
+        assert exc_info.value.args[0] == 'Invalid format: xml'
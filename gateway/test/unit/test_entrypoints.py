@@ -1,9 +1,11 @@
 import json
 import pytest
 from marshmallow import ValidationError
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
 
-from gateway.entrypoints import HttpEntrypoint
-from gateway.exceptions import ProductNotFound, OrderNotFound
+from gateway.entrypoints import ClientWebServer, HttpEntrypoint
+from gateway.exceptions import ProductNotFound, OrderNotFound, InvalidCursor, OutOfStock
 
 
 class TestHttpEntrypoint(object):
@@ -15,6 +17,8 @@ class TestHttpEntrypoint(object):
             (ValidationError('v1'), 'VALIDATION_ERROR', 400, 'v1'),
             (ProductNotFound('p1'), 'PRODUCT_NOT_FOUND', 404, 'p1'),
             (OrderNotFound('o1'), 'ORDER_NOT_FOUND', 404, 'o1'),
+            (InvalidCursor('c1'), 'INVALID_CURSOR', 400, 'c1'),
+            (OutOfStock('s1'), 'OUT_OF_STOCK', 409, 's1'),
             (TypeError('t1'), 'BAD_REQUEST', 400, 't1'),
         ]
     )
@@ -26,6 +30,8 @@ class TestHttpEntrypoint(object):
             ValidationError,
             ProductNotFound,
             OrderNotFound,
+            InvalidCursor,
+            OutOfStock,
             TypeError,
         )
 
@@ -36,3 +42,16 @@ class TestHttpEntrypoint(object):
         assert response.status_code == expected_status_code
         assert response_data['error'] == expected_error
         assert response_data['message'] == expected_message
+
+
+class TestClientWebServer(object):
+
+    @pytest.mark.parametrize(('headers', 'expected'), [
+        ({'X-Client-Id': 'c1'}, {'client_id': 'c1'}),
+        ({'X-Client-Id': ''}, {}),
+        ({}, {}),
+    ])
+    def test_client_id_from_header(self, headers, expected):
+        request = Request(EnvironBuilder(headers=headers).get_environ())
+
+        assert ClientWebServer().context_data_from_headers(request) == expected
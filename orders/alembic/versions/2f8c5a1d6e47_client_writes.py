@@ -0,0 +1,32 @@
+"""client writes
+
+Revision ID: 2f8c5a1d6e47
+Revises: 7d3f6b1e2a90
+Create Date: 2026-10-18 23:50:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2f8c5a1d6e47'
+down_revision = '7d3f6b1e2a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "client_writes",
+        sa.Column("client_id", sa.String(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("client_id")
+    )
+    op.create_index("client_writes_updated_at", "client_writes", ["updated_at"])
+
+
+def downgrade():
+    op.drop_index("client_writes_updated_at", table_name="client_writes")
+    op.drop_table("client_writes")
@@ -0,0 +1,41 @@
+"""outbox events
+
+Revision ID: 4e7a9d2c8b13
+Revises: 9c41d7e3b5a2
+Create Date: 2026-10-18 23:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '4e7a9d2c8b13'
+down_revision = '9c41d7e3b5a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "outbox_events",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("event_type", sa.String(), nullable=False),
+        sa.Column("payload", sa.JSON(), nullable=False),
+        sa.Column("sent_at", sa.DateTime(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id")
+    )
+
+    op.create_index(
+        "outbox_events_pending", "outbox_events", ["id"],
+        postgresql_where=sa.text("sent_at IS NULL")
+    )
+    op.create_index("outbox_events_sent_at", "outbox_events", ["sent_at"])
+
+
+def downgrade():
+    op.drop_index("outbox_events_sent_at", table_name="outbox_events")
+    op.drop_index("outbox_events_pending", table_name="outbox_events")
+    op.drop_table("outbox_events")
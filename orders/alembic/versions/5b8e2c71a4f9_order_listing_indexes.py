@@ -0,0 +1,29 @@
+"""order listing indexes
+
+Revision ID: 5b8e2c71a4f9
+Revises: dd33cb03d01f
+Create Date: 2026-10-18 21:30:00.000000
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5b8e2c71a4f9'
+down_revision = 'dd33cb03d01f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("orders_created_at_id", "orders", ["created_at", "id"])
+    op.create_index(
+        "order_details_product_id_order_id", "order_details", ["product_id", "order_id"]
+    )
+    op.drop_index("order_details_product_id", table_name="order_details")
+
+
+def downgrade():
+    op.create_index("order_details_product_id", "order_details", ["product_id"])
+    op.drop_index("order_details_product_id_order_id", table_name="order_details")
+    op.drop_index("orders_created_at_id", table_name="orders")
@@ -0,0 +1,46 @@
+"""product sales
+
+Revision ID: 7d3f6b1e2a90
+Revises: 4e7a9d2c8b13
+Create Date: 2026-10-18 23:30:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '7d3f6b1e2a90'
+down_revision = '4e7a9d2c8b13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "product_sales",
+        sa.Column("product_id", sa.String(), nullable=False),
+        sa.Column("units", sa.Integer(), nullable=False),
+        sa.Column("revenue", sa.DECIMAL(18, 2), nullable=False),
+        sa.Column("order_count", sa.Integer(), nullable=False),
+        sa.Column("last_ordered_at", sa.DateTime(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("product_id")
+    )
+
+    # Start from the orders placed so far.
+    op.execute(
+        "INSERT INTO product_sales "
+        "(product_id, units, revenue, order_count, last_ordered_at, created_at, updated_at) "
+        "SELECT order_details.product_id, SUM(order_details.quantity), "
+        "SUM(order_details.price * order_details.quantity), "
+        "COUNT(DISTINCT order_details.order_id), MAX(orders.created_at), "
+        "CURRENT_TIMESTAMP, CURRENT_TIMESTAMP "
+        "FROM order_details JOIN orders ON orders.id = order_details.order_id "
+        "GROUP BY order_details.product_id"
+    )
+
+
+def downgrade():
+    op.drop_table("product_sales")
@@ -0,0 +1,31 @@
+"""cascade order details
+
+Revision ID: 9c41d7e3b5a2
+Revises: 5b8e2c71a4f9
+Create Date: 2026-10-18 22:00:00.000000
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9c41d7e3b5a2'
+down_revision = '5b8e2c71a4f9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_constraint("fk_order_details_orders", "order_details", type_="foreignkey")
+    op.create_foreign_key(
+        "fk_order_details_orders", "order_details", "orders",
+        ["order_id"], ["id"], ondelete="CASCADE"
+    )
+
+
+def downgrade():
+    op.drop_constraint("fk_order_details_orders", "order_details", type_="foreignkey")
+    op.create_foreign_key(
+        "fk_order_details_orders", "order_details", "orders",
+        ["order_id"], ["id"]
+    )
@@ -0,0 +1,415 @@
+import datetime
+import logging
+import random
+import time
+from typing import Dict, Optional, Union
+from weakref import WeakKeyDictionary
+
+import eventlet
+from nameko import config
+from nameko.constants import DEFAULT_MAX_WORKERS, MAX_WORKERS_CONFIG_KEY
+from nameko.events import EventDispatcher
+from nameko.extensions import DependencyProvider
+from nameko_sqlalchemy import DatabaseSession
+from sqlalchemy import create_engine, delete, event, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from orders.models import ClientWrite, OutboxEvent
+
+POOL = "DB_POOL"
+REPLICAS = "DB_REPLICAS"
+OUTBOX = "OUTBOX"
+
+# Context data key naming the client whose writes its later reads must see,
+# set by the gateways from the X-Client-Id request header.
+CLIENT_ID = "client_id"
+
+DEFAULT_OUTBOX_BATCH_SIZE = 100
+
+logger = logging.getLogger("orders.dependencies")
+
+# Seconds a PostgreSQL standby is behind, 0 once it replayed all it received.
+REPLICA_LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+    " ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ Queue pool that counts waits for a free connection and checkouts
+    that timed out waiting.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+
+    def _exhausted(self) -> bool:
+        # overflow() counts up from -pool_size as connections are opened.
+        return (
+            self.checkedin() == 0 and self._max_overflow > -1
+            and self.overflow() >= self._max_overflow
+        )
+
+    def connect(self):
+        exhausted = self._exhausted()
+        started = time.time()
+        try:
+            return super(InstrumentedQueuePool, self).connect()
+        except TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            if exhausted:
+                self.waits += 1
+                self.wait_time += time.time() - started
+
+    def metrics(self) -> Dict[str, Union[int, float]]:
+        return {
+            'pool_size': self.size(),
+            'max_overflow': self._max_overflow,
+            'checked_out': self.checkedout(),
+            'idle': self.checkedin(),
+            'overflow': max(0, self.overflow()),
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'timeouts': self.timeouts,
+        }
+
+
+class Replica:
+    """ A read replica and the replication lag last measured for it. """
+
+    def __init__(self, engine, session_options: Dict):
+        self.engine = engine
+        self.Session = sessionmaker(bind=engine, **session_options)
+        self.lag = None
+
+    def metrics(self) -> Dict:
+        return {'lag': self.lag, 'pool': self.engine.pool.metrics()}
+
+
+class Database(DatabaseSession):
+    """ `DatabaseSession` whose engine is tuned by the `DB_POOL` config ::
+
+        DB_POOL:
+            pool_size: 5
+            max_overflow: 10
+            pool_timeout: 30
+            pool_recycle: 1800
+            pool_pre_ping: true
+            statement_timeout: 30000
+
+    Every key but `statement_timeout` is passed to `create_engine`. The
+    pool size defaults to one connection per worker. `statement_timeout`
+    is in milliseconds and set on every new PostgreSQL connection; other
+    databases ignore it.
+
+    Read replicas are configured with `DB_REPLICAS` ::
+
+        DB_REPLICAS:
+            uris: [postgresql://...]
+            max_lag: 5
+            check_interval: 1
+            read_your_writes: 10
+
+    A background thread measures every replica's lag, and `read_session`
+    hands out sessions on a random replica no more than `max_lag` seconds
+    behind, or on the primary when there is none. For `read_your_writes`
+    seconds after a client committed a write, its reads go to the primary
+    too. Clients are told apart by the `client_id` context data of their
+    calls, which the gateways take from the `X-Client-Id` header; reads of
+    calls without it are never routed back. The time of a client's last
+    write is kept in the `client_writes` table, committed with the write,
+    so every instance of the service sees it; checking it costs a primary
+    key lookup on the primary for reads that would go to a replica.
+    """
+
+    def setup(self):
+        pool_options = dict(config.get(POOL) or {})
+        pool_options.setdefault('pool_size', config.get(MAX_WORKERS_CONFIG_KEY, DEFAULT_MAX_WORKERS))
+        self.statement_timeout = int(pool_options.pop('statement_timeout', None) or 0)
+        self.engine_options = dict(pool_options, poolclass=InstrumentedQueuePool, **self.engine_options)
+        super(Database, self).setup()
+
+        replica_options = config.get(REPLICAS) or {}
+        self.replicas = [
+            Replica(create_engine(uri, **self.engine_options), self.session_options)
+            for uri in replica_options.get('uris') or []
+        ]
+        self.max_lag = float(replica_options.get('max_lag', 5))
+        self.check_interval = float(replica_options.get('check_interval', 1))
+        self.read_your_writes = float(replica_options.get('read_your_writes') or 0)
+
+        for engine in [self.engine] + [replica.engine for replica in self.replicas]:
+            if self.statement_timeout and engine.dialect.name == 'postgresql':
+                event.listen(engine, 'connect', self._set_statement_timeout)
+        # Without replicas every read goes to the primary anyway.
+        if self.read_your_writes and self.replicas:
+            event.listen(self.Session, 'after_flush', self._flushed)
+            event.listen(self.Session, 'do_orm_execute', self._executed)
+            event.listen(self.Session, 'before_commit', self._committing)
+
+    def start(self):
+        if self.replicas:
+            self.container.spawn_managed_thread(self._watch_replicas, identifier='Database.watch_replicas')
+
+    def stop(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+        super(Database, self).stop()
+
+    def kill(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+        super(Database, self).kill()
+
+    def _set_statement_timeout(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SET statement_timeout = {:d}'.format(self.statement_timeout))
+        cursor.close()
+        # psycopg2 opens a transaction for the SET, which would otherwise
+        # be rolled back when the connection is first returned.
+        dbapi_connection.commit()
+
+    def _watch_replicas(self):
+        while True:
+            self.check_replicas()
+            if self.read_your_writes:
+                self.purge_client_writes()
+            eventlet.sleep(self.check_interval)
+
+    def check_replicas(self) -> None:
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as connection:
+                    lag = connection.execute(REPLICA_LAG_QUERY).scalar()
+            except SQLAlchemyError as e:
+                logger.warning("Replica lag check failed: %s", e)
+                lag = None
+            replica.lag = float(lag) if lag is not None else None
+
+    def get_dependency(self, worker_ctx):
+        session = super(Database, self).get_dependency(worker_ctx)
+        session.info[CLIENT_ID] = worker_ctx.context_data.get(CLIENT_ID)
+        return session
+
+    @staticmethod
+    def _flushed(session, flush_context):
+        session.info['wrote'] = True
+
+    @staticmethod
+    def _executed(orm_execute_state):
+        # Bulk INSERT, UPDATE and DELETE statements bypass the flush.
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            orm_execute_state.session.info['wrote'] = True
+
+    @staticmethod
+    def _committing(session):
+        # Commit flushes after this hook, too late to tell whether it wrote.
+        session.flush()
+        client_id = session.info.get(CLIENT_ID)
+        if session.info.get('wrote') and client_id is not None:
+            if session.get_bind().dialect.name == 'postgresql':
+                statement = postgresql.insert(ClientWrite)
+            else:
+                statement = sqlite.insert(ClientWrite)
+            session.execute(
+                statement.values(client_id=client_id).on_conflict_do_update(
+                    index_elements=[ClientWrite.client_id],
+                    set_={'updated_at': statement.excluded.updated_at},
+                )
+            )
+        session.info.pop('wrote', None)
+
+    def _write_cutoff(self) -> datetime.datetime:
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=self.read_your_writes)
+
+    def _wrote_recently(self, client_id: Optional[str]) -> bool:
+        if client_id is None or not self.read_your_writes:
+            return False
+        with self.engine.connect() as connection:
+            return connection.execute(
+                select(ClientWrite.client_id).where(
+                    ClientWrite.client_id == client_id, ClientWrite.updated_at >= self._write_cutoff()
+                )
+            ).first() is not None
+
+    def purge_client_writes(self) -> int:
+        """ Deletes the writes too old to affect where reads go. """
+        try:
+            with self.engine.begin() as connection:
+                return connection.execute(
+                    delete(ClientWrite).where(ClientWrite.updated_at < self._write_cutoff())
+                ).rowcount
+        except SQLAlchemyError as e:
+            logger.warning("Purging client writes failed: %s", e)
+            return 0
+
+    def read_session(self, worker_ctx):
+        """ A new session for read-only work, see the class docstring. """
+        healthy = [
+            replica for replica in self.replicas
+            if replica.lag is not None and replica.lag <= self.max_lag
+        ]
+        if not healthy or self._wrote_recently(worker_ctx.context_data.get(CLIENT_ID)):
+            return self.Session()
+        return random.choice(healthy).Session()
+
+    def metrics(self) -> Dict[str, Dict]:
+        return {
+            'pool': self.engine.pool.metrics(),
+            'replicas': [replica.metrics() for replica in self.replicas],
+        }
+
+
+class ReadSession(DependencyProvider):
+    """ Injects a session from the service's `Database.read_session`, for
+    entrypoints that only read.
+    """
+
+    def __init__(self):
+        self.sessions = WeakKeyDictionary()
+
+    def setup(self):
+        self.database = next(
+            dependency for dependency in self.container.dependencies if isinstance(dependency, Database)
+        )
+
+    def get_dependency(self, worker_ctx):
+        session = self.database.read_session(worker_ctx)
+        self.sessions[worker_ctx] = session
+        return session
+
+    def worker_teardown(self, worker_ctx):
+        self.sessions.pop(worker_ctx).close()
+
+
+class OutboxRelay(EventDispatcher):
+    """ Publishes the events in the outbox table to the service's events
+    exchange, like an `EventDispatcher` would, and marks them sent ::
+
+        OUTBOX:
+            batch_size: 100
+            poll_interval: 0.2
+            retention: 86400
+
+    A background thread takes up to `batch_size` pending events in id
+    order, publishes each with publisher confirms and marks the batch sent
+    with one UPDATE. It looks again right away after a full batch and
+    otherwise after `poll_interval` seconds, when it also deletes events
+    sent more than `retention` seconds ago.
+
+    Pending rows are locked with SKIP LOCKED, so several service instances
+    relay different events. An event is published at least once: when
+    marking a batch sent fails, its events are published again.
+
+    nameko's publisher waits for the confirm of each message before it
+    returns, so one relay publishes at most one event per broker round
+    trip whatever the batch size. Running more instances relays more
+    events concurrently.
+    """
+
+    def setup(self):
+        super(OutboxRelay, self).setup()
+        options = config.get(OUTBOX) or {}
+        self.batch_size = int(options.get('batch_size') or DEFAULT_OUTBOX_BATCH_SIZE)
+        self.poll_interval = float(options.get('poll_interval', 0.2))
+        self.retention = float(options.get('retention', 86400))
+        self.published = 0
+        self.batches = 0
+        self.failures = 0
+
+    def start(self):
+        database = next(
+            dependency for dependency in self.container.dependencies if isinstance(dependency, Database)
+        )
+        self.Session = sessionmaker(bind=database.engine)
+        self.container.spawn_managed_thread(self._relay, identifier='OutboxRelay.relay')
+
+    def _relay(self):
+        while True:
+            try:
+                relayed = self.relay_pending()
+                if relayed < self.batch_size:
+                    self.purge_sent()
+            except Exception as e:
+                logger.error("Relaying outbox events failed: %s", e)
+                relayed = 0
+            if relayed < self.batch_size:
+                eventlet.sleep(self.poll_interval)
+
+    def relay_pending(self) -> int:
+        """ Publishes one batch of pending events, returns how many were
+        published.
+        """
+        with self.Session() as session:
+            events = session.scalars(
+                select(OutboxEvent).where(OutboxEvent.sent_at.is_(None))
+                .order_by(OutboxEvent.id).limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not events:
+                return 0
+
+            sent = []
+            try:
+                for outbox_event in events:
+                    self.publisher.publish(
+                        outbox_event.payload, exchange=self.exchange, routing_key=outbox_event.event_type
+                    )
+                    sent.append(outbox_event.id)
+            except Exception:
+                self.failures += 1
+                raise
+            finally:
+                # Events published before a failure are still marked sent.
+                if sent:
+                    session.execute(
+                        update(OutboxEvent).where(OutboxEvent.id.in_(sent))
+                        .values(sent_at=datetime.datetime.utcnow())
+                        .execution_options(synchronize_session=False)
+                    )
+                    session.commit()
+                    self.published += len(sent)
+                    self.batches += 1
+
+        logger.info("%s outbox events published", len(sent))
+        return len(sent)
+
+    def purge_sent(self) -> int:
+        sent_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.retention)
+        with self.Session() as session:
+            purged = session.execute(
+                delete(OutboxEvent).where(OutboxEvent.sent_at < sent_before)
+            ).rowcount
+            session.commit()
+        return purged
+
+    def get_dependency(self, worker_ctx):
+        return self.relay_pending
+
+    def metrics(self) -> Dict[str, int]:
+        return {'published': self.published, 'batches': self.batches, 'failures': self.failures}
+
+
+class Metrics(DependencyProvider):
+    """ Collects the `metrics()` of every extension of the service that
+    provides them, keyed by entrypoint method or dependency attribute name.
+    """
+
+    def collect(self) -> Dict[str, Dict]:
+        collected = {}
+        for extension in self.container.extensions:
+            if extension is not self and hasattr(extension, 'metrics'):
+                name = getattr(extension, 'method_name', None) or extension.attr_name
+                collected[name] = extension.metrics()
+        return collected
+
+    def get_dependency(self, worker_ctx):
+        return self.collect
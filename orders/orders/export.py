@@ -0,0 +1,152 @@
+""" Streams orders joined to their details as NDJSON, CSV or Arrow IPC.
+
+Usage ::
+
+    POSTGRES_URI=postgresql://... python -m orders.export --format csv --output orders.csv
+
+Every output row is one order detail together with its order's id and
+creation time; orders without details give one row with empty detail
+columns. Rows are read through a server-side cursor in chunks of
+`--chunk-size`, so memory use does not grow with the tables. Arrow output
+needs pyarrow, see the `arrow` extra.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from typing import IO, Iterator, List
+
+from sqlalchemy import Row, Select, create_engine, select
+from sqlalchemy.orm import Session
+
+from orders.models import Order, OrderDetail
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+TEXT_FORMATS = ('ndjson', 'csv')
+FORMATS = TEXT_FORMATS + ('arrow',)
+COLUMNS = ('order_id', 'created_at', 'order_detail_id', 'product_id', 'price', 'quantity')
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def order_rows() -> Select:
+    return select(
+        Order.id.label('order_id'),
+        Order.created_at,
+        OrderDetail.id.label('order_detail_id'),
+        OrderDetail.product_id,
+        OrderDetail.price,
+        OrderDetail.quantity,
+    ).select_from(Order).outerjoin(OrderDetail).order_by(Order.id, OrderDetail.id)
+
+
+def iter_chunks(session: Session, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[List[Row]]:
+    """ All order rows in lists of up to `chunk_size`. `yield_per` makes
+    the driver use a server-side cursor where it supports one.
+    """
+    result = session.execute(order_rows().execution_options(yield_per=chunk_size))
+    for chunk in result.partitions():
+        yield chunk
+
+
+def _values(row: Row) -> dict:
+    return {
+        'order_id': row.order_id,
+        'created_at': row.created_at.isoformat(),
+        'order_detail_id': row.order_detail_id,
+        'product_id': row.product_id,
+        'price': None if row.price is None else str(row.price),
+        'quantity': row.quantity,
+    }
+
+
+def format_rows(rows: List[Row], format: str, header: bool = False) -> str:
+    """ `rows` as NDJSON, or as CSV with an optional header line. """
+    if format == 'ndjson':
+        return ''.join(json.dumps(_values(row)) + '\n' for row in rows)
+    if format == 'csv':
+        output = io.StringIO()
+        writer = csv.DictWriter(output, COLUMNS)
+        if header:
+            writer.writeheader()
+        writer.writerows(_values(row) for row in rows)
+        return output.getvalue()
+    raise ValueError('Unsupported format: {}'.format(format))
+
+
+def export_orders(session: Session, output: IO, format: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """ Writes every order row to `output`, a text file for NDJSON and CSV
+    or a binary one for Arrow. Returns the number of rows written.
+    """
+    if format == 'arrow':
+        return _export_arrow(session, output, chunk_size)
+
+    written = 0
+    if format == 'csv':
+        output.write(format_rows([], format, header=True))
+    for chunk in iter_chunks(session, chunk_size):
+        output.write(format_rows(chunk, format))
+        written += len(chunk)
+    return written
+
+
+def _export_arrow(session: Session, output: IO[bytes], chunk_size: int) -> int:
+    if pyarrow is None:
+        raise RuntimeError('Arrow export needs pyarrow, install nameko-examples-orders[arrow]')
+
+    schema = pyarrow.schema([
+        ('order_id', pyarrow.int64()),
+        ('created_at', pyarrow.timestamp('us')),
+        ('order_detail_id', pyarrow.int64()),
+        ('product_id', pyarrow.string()),
+        ('price', pyarrow.decimal128(18, 2)),
+        ('quantity', pyarrow.int64()),
+    ])
+    written = 0
+    with pyarrow.ipc.new_stream(output, schema) as writer:
+        for chunk in iter_chunks(session, chunk_size):
+            rows = [
+                dict(row._asdict(), product_id=None if row.product_id is None else str(row.product_id))
+                for row in chunk
+            ]
+            writer.write_batch(pyarrow.RecordBatch.from_pylist(rows, schema=schema))
+            written += len(chunk)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export orders with their details.')
+    parser.add_argument('--format', choices=FORMATS, default='ndjson')
+    parser.add_argument('--output', help='file to write, defaults to stdout')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--db-uri', default=os.getenv('POSTGRES_URI'),
+                        help='database to read, defaults to $POSTGRES_URI')
+    args = parser.parse_args(argv)
+    if not args.db_uri:
+        parser.error('--db-uri or POSTGRES_URI is required')
+
+    binary = args.format == 'arrow'
+    if args.output:
+        output = open(args.output, 'wb' if binary else 'w', newline=None if binary else '')
+    else:
+        output = sys.stdout.buffer if binary else sys.stdout
+
+    engine = create_engine(args.db_uri)
+    try:
+        with Session(engine) as session:
+            count = export_orders(session, output, args.format, args.chunk_size)
+    finally:
+        if args.output:
+            output.close()
+        engine.dispose()
+    print('{} rows exported'.format(count), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 import datetime
 
 from sqlalchemy import (
-    DECIMAL, Column, DateTime, ForeignKey, Integer, Index, Row
+    DECIMAL, JSON, Column, DateTime, ForeignKey, Integer, Index, Row, String, text
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -26,8 +26,17 @@ DeclarativeBase = declarative_base(cls=Base)
 
 class Order(DeclarativeBase):
     __tablename__ = "orders"
+    __table_args__ = (
+        # Serves created_at ranges of id-ordered pages.
+        Index("orders_created_at_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
+    # Details are removed with their order by the database.
+    order_details = relationship(
+        "OrderDetail", back_populates="order", order_by="OrderDetail.id",
+        cascade="all, delete-orphan", passive_deletes=True
+    )
 
 
 class OrderDetail(DeclarativeBase):
@@ -36,14 +45,61 @@ class OrderDetail(DeclarativeBase):
     id = Column(Integer, primary_key=True, autoincrement=True)
     order_id = Column(
         Integer,
-        ForeignKey("orders.id", name="fk_order_details_orders"),
+        ForeignKey("orders.id", name="fk_order_details_orders", ondelete="CASCADE"),
         nullable=False,
         index=True
     )
-    order = relationship(Order, backref="order_details")
+    order = relationship(Order, back_populates="order_details")
     product_id = Column(Integer, nullable=False)
     price = Column(DECIMAL(18, 2), nullable=False)
     quantity = Column(Integer, nullable=False)
 
     order_id_index = Index("order_details_fkey", order_id)
-    product_id_index = Index("order_details_product_id", product_id)
+    # Answers "orders with this product" from the index alone.
+    product_id_index = Index("order_details_product_id_order_id", product_id, order_id)
+
+
+class OutboxEvent(DeclarativeBase):
+    """ An event written in the transaction of the change it announces and
+    published afterwards by `orders.dependencies.OutboxRelay`.
+    """
+    __tablename__ = "outbox_events"
+    __table_args__ = (
+        # Finds the pending events without reading the sent ones.
+        Index(
+            "outbox_events_pending", "id",
+            postgresql_where=text("sent_at IS NULL"), sqlite_where=text("sent_at IS NULL")
+        ),
+        Index("outbox_events_sent_at", "sent_at"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    event_type = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+
+
+class ProductSales(DeclarativeBase):
+    """ Sales of a product over all current orders, kept up to date by
+    `orders.sales` in the transactions that change the orders.
+    """
+    __tablename__ = "product_sales"
+
+    product_id = Column(String, primary_key=True)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(DECIMAL(18, 2), nullable=False, default=0)
+    order_count = Column(Integer, nullable=False, default=0)
+    last_ordered_at = Column(DateTime, nullable=True)
+
+
+class ClientWrite(DeclarativeBase):
+    """ When a client last committed a write, recorded by
+    `orders.dependencies.Database` so that every service instance routes
+    the client's reads to the primary for a while.
+    """
+    __tablename__ = "client_writes"
+    __table_args__ = (
+        Index("client_writes_updated_at", "updated_at"),
+    )
+
+    client_id = Column(String, primary_key=True)
@@ -0,0 +1,162 @@
+""" Upkeep of the `product_sales` rollup.
+
+Every change to order details adds a delta per product to the rollup in
+the transaction of the change, so reading the sales of a product is one
+primary key lookup. Deltas are applied with INSERT ... ON CONFLICT DO
+UPDATE, which PostgreSQL and SQLite support, in product id order so that
+concurrent transactions lock the rollup rows in the same order.
+
+`last_ordered_at` only moves forward; deleting the latest order of a
+product does not set it back.
+
+Deleting orders subtracts their details in the database, see
+`delete_orders`, so they are never read into the service.
+"""
+import datetime
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import delete, distinct, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from orders.models import Order, OrderDetail, ProductSales
+
+
+def _delta(product_id: str, last_ordered_at: Optional[datetime.datetime] = None) -> Dict:
+    return {
+        'product_id': product_id,
+        'units': 0,
+        'revenue': Decimal('0.00'),
+        'order_count': 0,
+        'last_ordered_at': last_ordered_at,
+    }
+
+
+def placed(details: Iterable, ordered_at: Optional[datetime.datetime] = None, sign: int = 1) -> List[Dict]:
+    """ Deltas adding `details`, order details or rows with their order_id,
+    product_id, price and quantity. With `sign` -1 they remove them
+    instead.
+    """
+    deltas = {}
+    orders = defaultdict(set)
+    for detail in details:
+        delta = deltas.setdefault(detail.product_id, _delta(detail.product_id, ordered_at))
+        delta['units'] += sign * detail.quantity
+        delta['revenue'] += sign * Decimal(str(detail.price)) * detail.quantity
+        orders[detail.product_id].add(detail.order_id)
+    for product_id, order_ids in orders.items():
+        deltas[product_id]['order_count'] = sign * len(order_ids)
+    return list(deltas.values())
+
+
+def removed(details: Iterable) -> List[Dict]:
+    """ Deltas removing `details`, like `placed` does. """
+    return placed(details, sign=-1)
+
+
+def changed(before: Iterable, after: Dict[int, Dict]) -> List[Dict]:
+    """ Deltas for new prices and quantities of existing details.
+
+    `before` holds the details as they are, order details or rows with
+    their id, product_id, price and quantity, and `after` the new price
+    and quantity by detail id.
+    """
+    deltas = {}
+    for detail in before:
+        if detail.id not in after:
+            continue
+        new = after[detail.id]
+        delta = deltas.setdefault(detail.product_id, _delta(detail.product_id))
+        delta['units'] += new['quantity'] - detail.quantity
+        delta['revenue'] += (
+            Decimal(str(new['price'])) * new['quantity'] - Decimal(str(detail.price)) * detail.quantity
+        )
+    return list(deltas.values())
+
+
+def _insert(session: Session):
+    if session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert(ProductSales), func.greatest
+    return sqlite.insert(ProductSales), func.max
+
+
+def _adding(statement, greatest):
+    """ `statement`, an INSERT into the rollup, adding to the rows of
+    products that have one instead.
+    """
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[ProductSales.product_id],
+        set_={
+            'units': ProductSales.units + excluded.units,
+            'revenue': ProductSales.revenue + excluded.revenue,
+            'order_count': ProductSales.order_count + excluded.order_count,
+            'last_ordered_at': greatest(
+                func.coalesce(ProductSales.last_ordered_at, excluded.last_ordered_at),
+                func.coalesce(excluded.last_ordered_at, ProductSales.last_ordered_at),
+            ),
+            'updated_at': excluded.updated_at,
+        },
+    )
+
+
+def apply(session: Session, deltas: List[Dict]) -> None:
+    """ Adds `deltas` to the rollup rows of their products, creating
+    missing rows.
+    """
+    if not deltas:
+        return
+
+    statement, greatest = _insert(session)
+    session.execute(_adding(statement, greatest), sorted(deltas, key=lambda delta: delta['product_id']))
+
+
+def _removal(session: Session, order_ids):
+    statement, greatest = _insert(session)
+    return _adding(statement.from_select(
+        ['product_id', 'units', 'revenue', 'order_count'],
+        select(
+            OrderDetail.product_id,
+            -func.sum(OrderDetail.quantity),
+            -func.sum(OrderDetail.price * OrderDetail.quantity),
+            -func.count(distinct(OrderDetail.order_id)),
+        ).where(OrderDetail.order_id.in_(order_ids))
+        .group_by(OrderDetail.product_id).order_by(OrderDetail.product_id)
+    ), greatest)
+
+
+def remove_orders(session: Session, order_ids) -> None:
+    """ Subtracts the details of the orders in `order_ids`, a list or a
+    subquery, from the rollup with one INSERT ... SELECT summing them per
+    product. The orders should be locked and deleted next.
+    """
+    session.execute(_removal(session, order_ids))
+
+
+def delete_orders(session: Session, order_ids) -> int:
+    """ Deletes the orders in `order_ids`, a list or a subquery, with their
+    details and returns how many were deleted.
+
+    The details are subtracted from the rollup like `remove_orders` does,
+    before the cascading foreign key deletes them. On PostgreSQL the
+    orders are locked first, so changes to them in flight finish before,
+    and the INSERT runs as a CTE of the DELETE: both see the same
+    snapshot, so an order placed meanwhile is either subtracted and
+    deleted or left alone.
+    """
+    removal = _removal(session, order_ids)
+    orders = delete(Order).where(Order.id.in_(order_ids)).execution_options(synchronize_session=False)
+
+    if session.get_bind().dialect.name != 'postgresql':
+        # SQLite lets one write transaction run at a time.
+        session.execute(removal)
+        return session.execute(orders).rowcount
+
+    session.execute(
+        select(func.count()).select_from(
+            select(Order.id).where(Order.id.in_(order_ids)).with_for_update().subquery()
+        )
+    )
+    return session.execute(orders.add_cte(removal.cte('removed_sales'))).rowcount
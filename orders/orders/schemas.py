@@ -10,3 +10,17 @@ class OrderDetailSchema(Schema):
 class OrderSchema(Schema):
     id = fields.Int(required=True)
     order_details = fields.Nested(OrderDetailSchema, many=True)
+
+
+class ProductSalesSchema(Schema):
+    product_id = fields.Str(required=True)
+    units = fields.Int()
+    revenue = fields.Decimal(places=2, as_string=True)
+    order_count = fields.Int()
+    last_ordered_at = fields.DateTime(allow_none=True)
+
+
+class OrderFiltersSchema(Schema):
+    created_from = fields.DateTime()
+    created_to = fields.DateTime()
+    product_id = fields.Str()
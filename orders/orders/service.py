@@ -1,18 +1,19 @@
 import logging
 import logging.config
-from typing import List, Dict, Union
+from typing import List, Dict, Optional, Union
 
 import yaml
 from os import path
 
-from nameko.events import EventDispatcher
 from nameko.rpc import rpc
-from nameko_sqlalchemy import DatabaseSession
 
+from orders import export, sales
+from orders.dependencies import Database, Metrics, OutboxRelay, ReadSession
 from orders.exceptions import NotFound
-from orders.models import DeclarativeBase, Order, OrderDetail
-from orders.schemas import OrderSchema
-from sqlalchemy import Row
+from orders.models import DeclarativeBase, Order, OrderDetail, OutboxEvent, ProductSales
+from orders.schemas import OrderFiltersSchema, OrderSchema, ProductSalesSchema
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import selectinload
 
 logging_file = path.abspath('logging_config.yaml')
 
@@ -22,18 +23,27 @@ with open(logging_file, 'r') as config_file:
 
 logger = logging.getLogger("orders.service")
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 
 class OrdersService:
     name = 'orders'
 
-    db = DatabaseSession(DeclarativeBase)
-    event_dispatcher = EventDispatcher()
+    db = Database(DeclarativeBase)
+    # A replica session for read-only RPCs, see `Database.read_session`.
+    read_db = ReadSession()
+    # Publishes the events written to the outbox by order changes.
+    outbox_relay = OutboxRelay()
+    collect_metrics = Metrics()
 
     @rpc
     def list_orders(self) -> List[Dict[str, Union[int, str, float]]]:
 
         try:
-            orders = self.db.query(Order).all()
+            # Load the details of all orders with one more query instead of
+            # one per order when they are dumped.
+            orders = self.read_db.query(Order).options(selectinload(Order.order_details)).all()
             if not orders:
                 return []
             dumped_orders = OrderSchema(many=True).dump(orders).data
@@ -45,9 +55,78 @@ class OrdersService:
 
         return dumped_orders
 
+    @rpc
+    def list_orders_page(self, limit: int = DEFAULT_PAGE_SIZE, after_id: Optional[int] = None,
+                         filters: Optional[Dict[str, str]] = None) -> Dict[str, Union[int, List]]:
+        """ Up to `limit` orders with ids greater than `after_id`, in id
+        order, optionally filtered ::
+
+            list_orders_page(100, after_id=1200, filters={
+                'created_from': '2024-01-01T00:00:00',
+                'created_to': '2024-02-01T00:00:00',
+                'product_id': 'the_odyssey',
+            })
+
+        `created_from` is inclusive and `created_to` exclusive. Pass the
+        returned `next_after_id` to get the next page; it is None on the
+        last page.
+        """
+        filters = OrderFiltersSchema(strict=True).load(filters or {}).data
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+        query = self.read_db.query(Order).options(selectinload(Order.order_details))
+        if after_id is not None:
+            query = query.filter(Order.id > after_id)
+        if 'created_from' in filters:
+            query = query.filter(Order.created_at >= filters['created_from'])
+        if 'created_to' in filters:
+            query = query.filter(Order.created_at < filters['created_to'])
+        if 'product_id' in filters:
+            query = query.filter(Order.order_details.any(OrderDetail.product_id == filters['product_id']))
+        orders = query.order_by(Order.id).limit(limit + 1).all()
+
+        page = orders[:limit]
+        logger.info("%s orders listed", len(page))
+        return {
+            'orders': OrderSchema(many=True).dump(page).data,
+            'next_after_id': page[-1].id if len(orders) > limit else None,
+        }
+
+    @rpc
+    def export_orders_chunk(self, format: str = 'ndjson', after_id: Optional[int] = None,
+                            limit: int = export.DEFAULT_CHUNK_SIZE) -> Dict[str, Union[str, int]]:
+        """ One chunk of the rows `orders.export` writes, for callers that
+        stream an export themselves.
+
+        `data` holds the rows of up to `limit` orders with ids greater than
+        `after_id`, as NDJSON or CSV. CSV chunks start with a header when
+        `after_id` is None. Pass `next_after_id` to get the next chunk; it
+        is None after the last one.
+        """
+        if format not in export.TEXT_FORMATS:
+            raise ValueError('Unsupported format: {}'.format(format))
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+        order_ids = select(Order.id).order_by(Order.id).limit(limit)
+        if after_id is not None:
+            order_ids = order_ids.where(Order.id > after_id)
+        rows = self.read_db.execute(export.order_rows().where(Order.id.in_(order_ids.scalar_subquery()))).all()
+
+        orders = len({row.order_id for row in rows})
+        return {
+            'data': export.format_rows(rows, format, header=after_id is None),
+            'next_after_id': rows[-1].order_id if orders == limit else None,
+        }
+
+    @staticmethod
+    def _load_order(session, order_id: int) -> Optional[Order]:
+        return session.query(Order).options(
+            selectinload(Order.order_details)
+        ).filter(Order.id == order_id).first()
+
     @rpc
     def get_order(self, order_id: int) -> Dict[str, Union[int, str, float]]:
-        order = self.db.query(Order).filter(Order.id == order_id).first()
+        order = self._load_order(self.read_db, order_id)
 
         if not order:
             logger.error('Order with id %s not found', order_id)
@@ -72,62 +151,184 @@ class OrdersService:
             ]
         )
         self.db.add(order)
-        self.db.commit()
+        self.db.flush()
+        # Read the details back as stored, with prices rounded to the column.
+        self.db.scalars(
+            select(OrderDetail).where(OrderDetail.order_id == order.id)
+            .execution_options(populate_existing=True)
+        ).all()
+        sales.apply(self.db, sales.placed(order.order_details, order.created_at))
         order = OrderSchema().dump(order).data
-
-        self.event_dispatcher('order_created', {'order': order})
+        # The event is committed with the order and published by the relay.
+        self.db.add(OutboxEvent(event_type='order_created', payload={'order': order}))
+        self.db.commit()
 
         logger.info("Order with id %s successfully created", order['id'])
 
         return order
 
+    @rpc
+    def create_orders(self, orders: List[List[Dict[str, Union[int, str, float]]]]) -> List[Dict[str, Union[int, str, float]]]:
+        """ Creates many orders, each given as its list of order details like
+        for `create_order`, in one transaction.
+
+        Orders and details are each written with multi-row INSERT ...
+        RETURNING statements. The created orders are returned in input
+        order, and their `order_created` events are written to the outbox
+        in the same transaction.
+        """
+        if not orders:
+            return []
+
+        created_orders = self.db.execute(
+            insert(Order).returning(Order.id, Order.created_at, sort_by_parameter_order=True),
+            [{} for _ in orders],
+        ).all()
+        order_ids = [order.id for order in created_orders]
+        rows = [
+            {
+                'order_id': order_id,
+                'product_id': order_detail['product_id'],
+                'price': order_detail['price'],
+                'quantity': order_detail['quantity'],
+            }
+            for order_id, order_details in zip(order_ids, orders)
+            for order_detail in order_details
+        ]
+        details = []
+        if rows:
+            details = self.db.execute(
+                insert(OrderDetail).returning(
+                    OrderDetail.id, OrderDetail.order_id, OrderDetail.product_id,
+                    OrderDetail.price, OrderDetail.quantity,
+                    sort_by_parameter_order=True,
+                ),
+                rows,
+            ).all()
+        sales.apply(self.db, sales.placed(details, max(order.created_at for order in created_orders)))
+
+        order_details = {order_id: [] for order_id in order_ids}
+        for detail in details:
+            order_details[detail.order_id].append(detail._asdict())
+        created = OrderSchema(many=True).dump([
+            {'id': order_id, 'order_details': order_details[order_id]} for order_id in order_ids
+        ]).data
+
+        self.db.execute(insert(OutboxEvent), [
+            {'event_type': 'order_created', 'payload': {'order': order}} for order in created
+        ])
+        self.db.commit()
+
+        logger.info("%s orders successfully created", len(created))
+
+        return created
+
     @rpc
     def update_order(self, order: Dict[str, Union[int, str, float]]) -> Dict[str, Union[int, str, float]]:
-        order_details = {
-            order_details['id']: order_details
-            for order_details in order['order_details']
-        }
+        """ Sets the price and quantity of the order details given in
+        `order`, leaving its other details unchanged, and returns the
+        updated order.
 
-        order = self.db.query(Order).get(order['id'])
+        All given details are written with one executemany UPDATE. Raises
+        NotFound if the order does not exist or a detail id is not one of
+        its details.
+        """
+        order_id = order['id']
+        changes = [
+            {'id': detail['id'], 'price': detail['price'], 'quantity': detail['quantity']}
+            for detail in order['order_details']
+        ]
 
-        for order_detail in order.order_details:
-            order_detail.price = order_details[order_detail.id]['price']
-            order_detail.quantity = order_details[order_detail.id]['quantity']
+        # Locking the order keeps concurrent updates of it from computing
+        # their sales deltas from the same old details.
+        rows = self.db.execute(
+            select(
+                Order.id.label('order_id'), OrderDetail.id, OrderDetail.product_id,
+                OrderDetail.price, OrderDetail.quantity,
+            ).select_from(Order).outerjoin(OrderDetail).where(Order.id == order_id).with_for_update(of=Order)
+        ).all()
+        if not rows:
+            logger.error('Order with id %s not found', order_id)
+            raise NotFound('Order with id {} not found'.format(order_id))
+        unknown = sorted({change['id'] for change in changes} - {row.id for row in rows})
+        if unknown:
+            logger.error('Order details %s not found in order %s', unknown, order_id)
+            raise NotFound('Order details {} not found in order {}'.format(
+                ', '.join(map(str, unknown)), order_id
+            ))
 
+        if changes:
+            self.db.execute(update(OrderDetail), changes)
+            sales.apply(self.db, sales.changed(rows, {change['id']: change for change in changes}))
         self.db.commit()
-        return OrderSchema().dump(order).data
+
+        logger.info("Order with id %s successfully updated", order_id)
+
+        return OrderSchema().dump(self._load_order(self.db, order_id)).data
 
     @rpc
     def delete_order(self, order_id: int) -> None:
-        order = self.db.query(Order).get(order_id)
+        order = self.db.get(Order, order_id, with_for_update=True)
+        sales.remove_orders(self.db, [order_id])
         self.db.delete(order)
         self.db.commit()
 
     @rpc
-    def delete_orders_with_product_id(self, product_id: str) -> None:
-        try:
-            details: List[Row] = self.db.query(OrderDetail.order_id).filter(OrderDetail.product_id == product_id).all()
-            order_ids = list(map(lambda detail: detail._asdict()['order_id'], details))
-        except Exception as e:
-            logger.error("Failed to fetch orders with product id %s. %s", product_id, e)
-            raise e
+    def delete_orders_with_product_id(self, product_id: str) -> int:
+        """ Deletes every order with a detail for `product_id` and returns
+        how many were deleted.
 
+        The orders are selected by a subquery in the database, and their
+        details are removed from the product sales by the database and
+        then deleted by the cascading foreign key, see
+        `orders.sales.delete_orders`.
+        """
+        order_ids = select(OrderDetail.order_id).where(OrderDetail.product_id == product_id)
         try:
+            deleted = sales.delete_orders(self.db, order_ids)
             self.db.commit()
-            self.db.query(OrderDetail).filter(OrderDetail.order_id.in_(order_ids)).delete()
-            self.db.query(Order).filter(Order.id.in_(order_ids)).delete()
-            self.db.commit()
-            logger.info("%s orders with product id %s deleted to ensure data consistency", len(details), product_id)
+            logger.info("%s orders with product id %s deleted to ensure data consistency", deleted, product_id)
         except Exception as e:
             logger.error("Failed to delete orders with product id %s. %s", product_id, e)
             self.db.rollback()
             raise e
 
+        return deleted
+
+    @rpc
+    def product_stats(self, product_ids: List[str]) -> List[Dict[str, Union[int, str]]]:
+        """ Sales of each of `product_ids` over all current orders, in the
+        given order: units, revenue, order count and when it was last
+        ordered. Products without orders have zero sales.
+
+        Reads one rollup row per product, see `orders.sales`.
+        """
+        product_ids = list(dict.fromkeys(product_ids))
+        if len(product_ids) > MAX_PAGE_SIZE:
+            raise ValueError('At most {} product ids are allowed'.format(MAX_PAGE_SIZE))
+
+        found = {
+            product_sales.product_id: product_sales
+            for product_sales in self.read_db.scalars(
+                select(ProductSales).where(ProductSales.product_id.in_(product_ids))
+            )
+        }
+        return ProductSalesSchema(many=True).dump([
+            found.get(product_id) or ProductSales(
+                product_id=product_id, units=0, revenue=0, order_count=0, last_ordered_at=None
+            )
+            for product_id in product_ids
+        ]).data
+
     @rpc
     def test_connection(self) -> None:
         try:
-            self.db.query(Order).get(-1)
+            self.read_db.query(Order).get(-1)
             logger.info("Connection to database successfully established")
         except Exception as e:
             logger.error("Connection to database failed: %s", e)
-            raise e
\ No newline at end of file
+            raise e
+
+    @rpc
+    def metrics(self) -> Dict[str, Dict]:
+        return self.collect_metrics()
@@ -14,6 +14,9 @@ setup(
         'psycopg2-binary>=2.8.2',
     ],
     extras_require={
+        'arrow': [
+            'pyarrow>=10.0.0',
+        ],
         'dev': [
             'pytest>=4.5.0',
             'coverage>=4.5.3',
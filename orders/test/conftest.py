@@ -1,8 +1,19 @@
 import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 from orders.models import DeclarativeBase
 
 
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite only enforces foreign keys, and their cascades, when asked to"""
+    if type(dbapi_connection).__module__.startswith('sqlite3'):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
 @pytest.fixture(scope='session')
 def db_url():
     """Overriding db_url fixture from `nameko_sqlalchemy`
@@ -78,9 +78,9 @@ def create_service_meta(container_factory, test_config):
 
 @pytest.fixture
 def orders_service(create_service_meta):
-    """ Orders service test instance with `event_dispatcher`
+    """ Orders service test instance with `outbox_relay`
     dependency mocked """
-    return create_service_meta('event_dispatcher')
+    return create_service_meta('outbox_relay')
 
 
 @pytest.fixture
@@ -1,12 +1,14 @@
+import datetime
+
 import pytest
+from marshmallow import ValidationError
 
 from mock import call
-from mock.mock import Mock
-from nameko.events import EventDispatcher
 from nameko.exceptions import RemoteError
 from nameko_sqlalchemy import DatabaseSession
+from sqlalchemy import event
 
-from orders.models import Order, OrderDetail
+from orders.models import Order, OrderDetail, OutboxEvent
 from orders.schemas import OrderSchema, OrderDetailSchema
 
 from orders.exceptions import NotFound
@@ -34,13 +36,13 @@ def order_details(db_session, order):
     return order_details
 
 def test_get_order(orders_rpc, order, db_session):
-    orders_rpc.db = db_session
+    orders_rpc.read_db = db_session
     response = orders_rpc.get_order(1)
     assert response['id'] == order.id
 
 
 def test_will_raise_when_order_not_found(orders_rpc, db_session):
-    orders_rpc.db = db_session
+    orders_rpc.read_db = db_session
     with pytest.raises(NotFound) as err:
         orders_rpc.get_order(1)
     assert str(err.value) == 'Order with id 1 not found'
@@ -48,7 +50,6 @@ def test_will_raise_when_order_not_found(orders_rpc, db_session):
 
 def test_can_create_order(orders_rpc, db_session):
     orders_rpc.db = db_session
-    orders_rpc.event_dispatcher = Mock(EventDispatcher)
     order_details = [
         {
             'product_id': "the_odyssey",
@@ -57,7 +58,7 @@ def test_can_create_order(orders_rpc, db_session):
         },
         {
             'product_id': "the_enigma",
-            'price': 5.99,
+            'price': '5',
             'quantity': 8
         }
     ]
@@ -66,6 +67,12 @@ def test_can_create_order(orders_rpc, db_session):
     )
     assert new_order['id'] > 0
     assert len(new_order['order_details']) == len(order_details)
+    assert ['99.99', '5.00'] == [detail['price'] for detail in new_order['order_details']]
+
+    outbox_event = db_session.query(OutboxEvent).one()
+    assert 'order_created' == outbox_event.event_type
+    assert {'order': new_order} == outbox_event.payload
+    assert outbox_event.sent_at is None
 
 
 def test_can_update_order(orders_rpc, order, order_details, db_session):
@@ -82,4 +89,281 @@ def test_can_update_order(orders_rpc, order, order_details, db_session):
 def test_can_delete_order(orders_rpc, order, db_session):
     orders_rpc.db = db_session
     orders_rpc.delete_order(order.id)
-    assert not db_session.query(Order).filter_by(id=order.id).count()
\ No newline at end of file
+    assert not db_session.query(Order).filter_by(id=order.id).count()
+
+
+@pytest.fixture
+def executed_statements(db_session):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db_session.get_bind().engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def add_orders(db_session, count):
+    db_session.add_all([
+        Order(order_details=[
+            OrderDetail(product_id="the_odyssey", price=99.51, quantity=1),
+            OrderDetail(product_id="the_enigma", price=30.99, quantity=8),
+        ])
+        for _ in range(count)
+    ])
+    db_session.commit()
+
+
+def test_list_orders_query_count_does_not_grow(orders_rpc, db_session, executed_statements):
+    orders_rpc.read_db = db_session
+    add_orders(db_session, 1)
+    del executed_statements[:]
+    assert 1 == len(orders_rpc.list_orders())
+    single = len(executed_statements)
+
+    add_orders(db_session, 10)
+    del executed_statements[:]
+    orders = orders_rpc.list_orders()
+
+    assert 11 == len(orders)
+    assert all(len(order['order_details']) == 2 for order in orders)
+    assert single == len(executed_statements)
+
+
+def test_get_order_loads_details_eagerly(orders_rpc, order, order_details, db_session, executed_statements):
+    orders_rpc.read_db = db_session
+    order_id = order.id
+    db_session.expire_all()
+    del executed_statements[:]
+
+    response = orders_rpc.get_order(order_id)
+
+    assert 2 == len(response['order_details'])
+    assert 2 == len(executed_statements)
+
+
+def test_list_orders_page(orders_rpc, db_session):
+    orders_rpc.read_db = db_session
+    add_orders(db_session, 5)
+    ids = [order.id for order in db_session.query(Order).order_by(Order.id)]
+
+    first = orders_rpc.list_orders_page(2)
+    second = orders_rpc.list_orders_page(2, after_id=first['next_after_id'])
+    last = orders_rpc.list_orders_page(2, after_id=second['next_after_id'])
+
+    assert ids[:2] == [order['id'] for order in first['orders']]
+    assert ids[2:4] == [order['id'] for order in second['orders']]
+    assert ids[4:] == [order['id'] for order in last['orders']]
+    assert last['next_after_id'] is None
+    assert all(len(order['order_details']) == 2 for order in first['orders'])
+
+
+def test_list_orders_page_filters(orders_rpc, db_session):
+    orders_rpc.read_db = db_session
+    db_session.add_all([
+        Order(created_at=datetime.datetime(2024, 1, 1), order_details=[
+            OrderDetail(product_id="the_odyssey", price=1, quantity=1),
+        ]),
+        Order(created_at=datetime.datetime(2024, 2, 1), order_details=[
+            OrderDetail(product_id="the_enigma", price=1, quantity=1),
+        ]),
+        Order(created_at=datetime.datetime(2024, 3, 1), order_details=[
+            OrderDetail(product_id="the_odyssey", price=1, quantity=1),
+            OrderDetail(product_id="the_enigma", price=1, quantity=1),
+        ]),
+    ])
+    db_session.commit()
+    ids = [order.id for order in db_session.query(Order).order_by(Order.id)]
+
+    by_product = orders_rpc.list_orders_page(filters={'product_id': 'the_odyssey'})
+    by_date = orders_rpc.list_orders_page(filters={
+        'created_from': '2024-02-01T00:00:00', 'created_to': '2024-03-01T00:00:00'
+    })
+
+    assert [ids[0], ids[2]] == [order['id'] for order in by_product['orders']]
+    assert [ids[1]] == [order['id'] for order in by_date['orders']]
+
+
+def test_list_orders_page_rejects_invalid_filters(orders_rpc, db_session):
+    orders_rpc.read_db = db_session
+
+    with pytest.raises(ValidationError) as exc_info:
+        orders_rpc.list_orders_page(filters={'created_from': 'yesterday'})
+
+    assert {'created_from': ['Not a valid datetime.']} == exc_info.value.args[0]
+
+
+def test_can_create_orders(orders_rpc, db_session):
+    orders_rpc.db = db_session
+    orders = [
+        [
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+            {'product_id': "the_enigma", 'price': '5.99', 'quantity': 8},
+        ],
+        [
+            {'product_id': "the_enigma", 'price': '6.50', 'quantity': 2},
+        ],
+    ]
+
+    created = orders_rpc.create_orders(orders)
+
+    assert [2, 1] == [len(order['order_details']) for order in created]
+    assert created[0]['id'] < created[1]['id']
+    assert ['the_odyssey', 'the_enigma'] == [
+        detail['product_id'] for detail in created[0]['order_details']
+    ]
+    assert {'id': created[1]['order_details'][0]['id'], 'product_id': 'the_enigma',
+            'price': '6.50', 'quantity': 2} == created[1]['order_details'][0]
+    assert created == OrderSchema(many=True).dump(
+        db_session.query(Order).order_by(Order.id).all()
+    ).data
+    assert [('order_created', {'order': order}) for order in created] == [
+        (outbox_event.event_type, outbox_event.payload)
+        for outbox_event in db_session.query(OutboxEvent).order_by(OutboxEvent.id)
+    ]
+
+
+def test_delete_orders_with_product_id(orders_rpc, db_session):
+    orders_rpc.db = db_session
+    db_session.add_all([
+        Order(order_details=[
+            OrderDetail(product_id="the_odyssey", price=1, quantity=1),
+            OrderDetail(product_id="the_enigma", price=1, quantity=1),
+        ]),
+        Order(order_details=[
+            OrderDetail(product_id="the_enigma", price=1, quantity=1),
+        ]),
+        Order(order_details=[
+            OrderDetail(product_id="the_odyssey", price=1, quantity=2),
+        ]),
+    ])
+    db_session.commit()
+
+    assert 2 == orders_rpc.delete_orders_with_product_id("the_odyssey")
+
+    assert 1 == db_session.query(Order).count()
+    assert ["the_enigma"] == [detail.product_id for detail in db_session.query(OrderDetail)]
+    assert 0 == orders_rpc.delete_orders_with_product_id("the_odyssey")
+
+
+def test_delete_orders_with_product_id_stays_in_the_database(orders_rpc, db_session, executed_statements):
+    orders_rpc.db = db_session
+    db_session.add(Order(order_details=[OrderDetail(product_id="the_odyssey", price=1, quantity=1)]))
+    db_session.commit()
+    del executed_statements[:]
+
+    orders_rpc.delete_orders_with_product_id("the_odyssey")
+
+    writes = [statement for statement in executed_statements if statement.startswith(('INSERT', 'DELETE'))]
+    assert ['INSERT INTO product_sales', 'DELETE FROM orders'] == [' '.join(w.split()[:3]) for w in writes]
+    assert all('SELECT order_details.order_id' in statement for statement in writes)
+    assert not any('RETURNING' in statement for statement in writes)
+
+
+def test_can_delete_order_with_details(orders_rpc, order, order_details, db_session):
+    orders_rpc.db = db_session
+    orders_rpc.delete_order(order.id)
+    assert not db_session.query(OrderDetail).count()
+
+
+def test_update_order_changes_only_given_details(orders_rpc, order, order_details, db_session):
+    orders_rpc.db = db_session
+    order_payload = OrderSchema().dump(order).data
+    changed = dict(order_payload['order_details'][1], price='31.99', quantity=9)
+
+    updated_order = orders_rpc.update_order({'id': order.id, 'order_details': [changed]})
+
+    assert [order_payload['order_details'][0], changed] == updated_order['order_details']
+
+
+def test_update_order_reports_unknown_details(orders_rpc, order, order_details, db_session):
+    orders_rpc.db = db_session
+    order_payload = OrderSchema().dump(order).data
+    order_payload['order_details'][0]['quantity'] = 5
+    order_payload['order_details'].append({'id': 99, 'price': '1.00', 'quantity': 1})
+
+    with pytest.raises(NotFound) as err:
+        orders_rpc.update_order(order_payload)
+
+    assert str(err.value) == 'Order details 99 not found in order {}'.format(order.id)
+    assert 1 == db_session.query(OrderDetail).filter_by(product_id="the_odyssey").one().quantity
+
+
+def test_update_order_fails_when_order_not_found(orders_rpc, db_session):
+    orders_rpc.db = db_session
+    with pytest.raises(NotFound) as err:
+        orders_rpc.update_order({'id': 1, 'order_details': []})
+    assert str(err.value) == 'Order with id 1 not found'
+
+
+def test_export_orders_chunk(orders_rpc, db_session):
+    orders_rpc.read_db = db_session
+    add_orders(db_session, 3)
+    ids = [order.id for order in db_session.query(Order).order_by(Order.id)]
+
+    first = orders_rpc.export_orders_chunk('csv', limit=2)
+    last = orders_rpc.export_orders_chunk('csv', after_id=first['next_after_id'], limit=2)
+
+    assert ids[1] == first['next_after_id']
+    assert last['next_after_id'] is None
+    first_lines = first['data'].splitlines()
+    assert first_lines[0].startswith('order_id,')
+    assert 4 == len(first_lines[1:])
+    assert 2 == len(last['data'].splitlines())
+    assert all(line.startswith('{},'.format(ids[2])) for line in last['data'].splitlines())
+
+
+def test_export_orders_chunk_rejects_unknown_format(orders_rpc, db_session):
+    orders_rpc.read_db = db_session
+    with pytest.raises(ValueError):
+        orders_rpc.export_orders_chunk('xml')
+
+
+def stats(orders_rpc, *product_ids):
+    return {
+        product['product_id']: (product['units'], product['revenue'], product['order_count'])
+        for product in orders_rpc.product_stats(list(product_ids))
+    }
+
+
+def test_product_stats_follow_order_changes(orders_rpc, db_session):
+    orders_rpc.db = orders_rpc.read_db = db_session
+
+    first = orders_rpc.create_order([
+        {'product_id': "the_odyssey", 'price': '10.00', 'quantity': 2},
+        {'product_id': "the_odyssey", 'price': '12.50', 'quantity': 1},
+    ])
+    orders_rpc.create_orders([
+        [{'product_id': "the_odyssey", 'price': '10.00', 'quantity': 1},
+         {'product_id': "the_enigma", 'price': '5.00', 'quantity': 4}],
+        [{'product_id': "the_enigma", 'price': '5.00', 'quantity': 1}],
+    ])
+    assert {
+        'the_odyssey': (4, '42.50', 2), 'the_enigma': (5, '25.00', 2)
+    } == stats(orders_rpc, 'the_odyssey', 'the_enigma')
+
+    first['order_details'][0]['quantity'] = 3
+    orders_rpc.update_order({'id': first['id'], 'order_details': first['order_details'][:1]})
+    assert {'the_odyssey': (5, '52.50', 2)} == stats(orders_rpc, 'the_odyssey')
+
+    orders_rpc.delete_order(first['id'])
+    assert {'the_odyssey': (1, '10.00', 1)} == stats(orders_rpc, 'the_odyssey')
+
+    assert 1 == orders_rpc.delete_orders_with_product_id('the_odyssey')
+    assert {
+        'the_odyssey': (0, '0.00', 0), 'the_enigma': (1, '5.00', 1)
+    } == stats(orders_rpc, 'the_odyssey', 'the_enigma')
+
+
+def test_product_stats(orders_rpc, db_session):
+    orders_rpc.db = orders_rpc.read_db = db_session
+    created = orders_rpc.create_order([{'product_id': "the_enigma", 'price': '5.00', 'quantity': 2}])
+    ordered_at = db_session.get(Order, created['id']).created_at
+
+    assert [
+        {'product_id': 'unknown', 'units': 0, 'revenue': '0.00', 'order_count': 0, 'last_ordered_at': None},
+        {'product_id': 'the_enigma', 'units': 2, 'revenue': '10.00', 'order_count': 1,
+         'last_ordered_at': ordered_at.isoformat() + '+00:00'},
+    ] == orders_rpc.product_stats(['unknown', 'the_enigma', 'unknown'])
@@ -0,0 +1,223 @@
+import datetime
+
+import pytest
+from mock import Mock, call
+from nameko import config
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.orm import sessionmaker
+
+from orders.dependencies import Database, Metrics, OutboxRelay
+from orders.models import ClientWrite, DeclarativeBase, OutboxEvent
+
+
+@pytest.fixture
+def create_provider(tmp_path):
+    providers = []
+
+    def create(pool_options, replica_options=None):
+        provider = Database(DeclarativeBase)
+        provider.container = Mock(service_name='orders', config=config)
+        db_uris = {'orders:Base': 'sqlite:///{}'.format(tmp_path / 'orders.sql')}
+        with config.patch({'DB_URIS': db_uris, 'DB_POOL': pool_options, 'DB_REPLICAS': replica_options}):
+            provider.setup()
+        providers.append(provider)
+        return provider
+
+    yield create
+    for provider in providers:
+        provider.stop()
+
+
+def test_pool_is_configurable(create_provider):
+    provider = create_provider({
+        'pool_size': 3, 'max_overflow': 1, 'pool_timeout': 2, 'pool_recycle': 60, 'pool_pre_ping': True
+    })
+
+    pool = provider.engine.pool
+    assert 3 == pool.size()
+    assert 1 == pool._max_overflow
+    assert 2 == pool._timeout
+    assert 60 == pool._recycle
+    assert pool._pre_ping
+
+
+def test_pool_metrics(create_provider):
+    provider = create_provider({'pool_size': 1, 'max_overflow': 1, 'pool_timeout': 0.01})
+
+    first = provider.engine.connect()
+    second = provider.engine.connect()
+    with pytest.raises(TimeoutError):
+        provider.engine.connect()
+    metrics = provider.metrics()['pool']
+    first.close()
+    second.close()
+
+    assert 1 == metrics['pool_size']
+    assert 2 == metrics['checked_out']
+    assert 0 == metrics['idle']
+    assert 1 == metrics['overflow']
+    assert 1 == metrics['waits']
+    assert metrics['wait_time'] > 0
+    assert 1 == metrics['timeouts']
+    assert 0 == provider.metrics()['pool']['checked_out']
+
+
+@pytest.fixture
+def create_replicated_provider(create_provider, tmp_path):
+    def create():
+        # A second database stands in for the replica.
+        provider = create_provider({}, {
+            'uris': ['sqlite:///{}'.format(tmp_path / 'replica.sql')], 'max_lag': 5, 'read_your_writes': 10
+        })
+        DeclarativeBase.metadata.create_all(provider.engine)
+        return provider
+    return create
+
+
+@pytest.fixture
+def replicated_provider(create_replicated_provider):
+    return create_replicated_provider()
+
+
+def test_reads_use_primary_until_replica_lag_is_known(replicated_provider):
+    provider = replicated_provider
+    replica = provider.replicas[0]
+    worker_ctx = Mock(context_data={})
+
+    provider.check_replicas()
+    assert replica.lag is None
+    assert provider.read_session(worker_ctx).get_bind() is provider.engine
+
+    replica.lag = 1
+    assert provider.read_session(worker_ctx).get_bind() is replica.engine
+    assert 1 == provider.metrics()['replicas'][0]['lag']
+
+    replica.lag = 6
+    assert provider.read_session(worker_ctx).get_bind() is provider.engine
+
+
+def test_reads_after_own_writes_use_primary(create_replicated_provider):
+    provider, other_instance = create_replicated_provider(), create_replicated_provider()
+    provider.replicas[0].lag = other_instance.replicas[0].lag = 0
+    writer = Mock(context_data={'client_id': 'writer'})
+
+    session = provider.get_dependency(writer)
+    session.add(OutboxEvent(event_type='order_created', payload={}))
+    session.commit()
+    session.close()
+
+    assert provider.read_session(writer).get_bind() is provider.engine
+    assert other_instance.read_session(writer).get_bind() is other_instance.engine
+    assert provider.read_session(Mock(context_data={'client_id': 'reader'})).get_bind() is provider.replicas[0].engine
+
+    with provider.engine.begin() as connection:
+        connection.execute(update(ClientWrite).values(
+            updated_at=datetime.datetime.utcnow() - datetime.timedelta(seconds=11)
+        ))
+    assert provider.read_session(writer).get_bind() is provider.replicas[0].engine
+    assert 1 == provider.purge_client_writes()
+
+
+def test_bulk_writes_are_seen_by_read_your_writes(replicated_provider):
+    provider = replicated_provider
+    writer = Mock(context_data={'client_id': 'writer'})
+
+    session = provider.get_dependency(writer)
+    session.execute(insert(OutboxEvent), [{'event_type': 'order_created', 'payload': {}}])
+    session.commit()
+    session.close()
+
+    with provider.engine.connect() as connection:
+        assert ['writer'] == connection.execute(select(ClientWrite.client_id)).scalars().all()
+
+
+def test_writes_are_not_marked_without_replicas(create_provider):
+    provider = create_provider({}, {'read_your_writes': 10})
+    DeclarativeBase.metadata.create_all(provider.engine)
+
+    session = provider.get_dependency(Mock(context_data={'client_id': 'writer'}))
+    session.add(OutboxEvent(event_type='order_created', payload={}))
+    session.commit()
+    session.close()
+
+    with provider.engine.connect() as connection:
+        assert [] == connection.execute(select(ClientWrite.client_id)).all()
+
+
+def test_reads_do_not_mark_writes(replicated_provider):
+    provider = replicated_provider
+    session = provider.get_dependency(Mock(context_data={'client_id': 'reader'}))
+    session.query(OutboxEvent).all()
+    session.commit()
+    session.close()
+
+    with provider.engine.connect() as connection:
+        assert [] == connection.execute(select(ClientWrite.client_id)).all()
+
+
+def test_metrics_are_collected_from_extensions():
+    provider = Metrics()
+    db = Mock(attr_name='db', method_name=None, metrics=Mock(return_value={'pool': {}}))
+    provider.container = Mock(extensions=[provider, db, object()])
+
+    assert {'db': {'pool': {}}} == provider.get_dependency({})()
+
+
+@pytest.fixture
+def relay(db_session):
+    relay = OutboxRelay()
+    relay.exchange = Mock()
+    relay.publisher = Mock()
+    relay.batch_size = 2
+    relay.retention = 60
+    relay.published = relay.batches = relay.failures = 0
+    relay.Session = sessionmaker(bind=db_session.get_bind())
+    return relay
+
+
+def add_events(db_session, count, **fields):
+    db_session.add_all([
+        OutboxEvent(event_type='order_created', payload={'order': {'id': number}}, **fields)
+        for number in range(1, count + 1)
+    ])
+    db_session.commit()
+
+
+def test_relay_publishes_pending_events_in_batches(relay, db_session):
+    add_events(db_session, 3)
+
+    assert 2 == relay.relay_pending()
+    assert 1 == relay.relay_pending()
+    assert 0 == relay.relay_pending()
+
+    assert relay.publisher.publish.call_args_list == [
+        call({'order': {'id': number}}, exchange=relay.exchange, routing_key='order_created')
+        for number in (1, 2, 3)
+    ]
+    db_session.expire_all()
+    assert all(event.sent_at is not None for event in db_session.query(OutboxEvent))
+    assert {'published': 3, 'batches': 2, 'failures': 0} == relay.metrics()
+
+
+def test_relay_marks_events_published_before_a_failure(relay, db_session):
+    add_events(db_session, 2)
+    relay.publisher.publish.side_effect = [None, ConnectionError('closed')]
+
+    with pytest.raises(ConnectionError):
+        relay.relay_pending()
+
+    db_session.expire_all()
+    assert [False, True] == [
+        event.sent_at is None for event in db_session.query(OutboxEvent).order_by(OutboxEvent.id)
+    ]
+    assert {'published': 1, 'batches': 1, 'failures': 1} == relay.metrics()
+
+
+def test_relay_purges_old_sent_events(relay, db_session):
+    add_events(db_session, 1, sent_at=datetime.datetime.utcnow() - datetime.timedelta(minutes=2))
+    add_events(db_session, 1, sent_at=datetime.datetime.utcnow())
+    add_events(db_session, 1)
+
+    assert 1 == relay.purge_sent()
+    assert 2 == db_session.query(OutboxEvent).count()
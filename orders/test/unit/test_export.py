@@ -0,0 +1,68 @@
+import csv
+import io
+import json
+
+import pytest
+
+from orders.export import export_orders
+from orders.models import Order, OrderDetail
+
+
+@pytest.fixture
+def orders(db_session):
+    orders = [
+        Order(order_details=[
+            OrderDetail(product_id="the_odyssey", price=99.51, quantity=1),
+            OrderDetail(product_id="the_enigma", price=30.99, quantity=8),
+        ]),
+        Order(order_details=[]),
+        Order(order_details=[
+            OrderDetail(product_id="the_enigma", price=30.99, quantity=2),
+        ]),
+    ]
+    db_session.add_all(orders)
+    db_session.commit()
+    return orders
+
+
+def test_export_ndjson(db_session, orders):
+    output = io.StringIO()
+
+    assert 4 == export_orders(db_session, output, 'ndjson', chunk_size=2)
+
+    rows = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [
+        (orders[0].id, 'the_odyssey', '99.51', 1),
+        (orders[0].id, 'the_enigma', '30.99', 8),
+        (orders[1].id, None, None, None),
+        (orders[2].id, 'the_enigma', '30.99', 2),
+    ] == [(row['order_id'], row['product_id'], row['price'], row['quantity']) for row in rows]
+    assert orders[0].created_at.isoformat() == rows[0]['created_at']
+
+
+def test_export_csv(db_session, orders):
+    output = io.StringIO()
+
+    export_orders(db_session, output, 'csv', chunk_size=3)
+
+    rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+    assert [str(orders[0].order_details[0].id), '', str(orders[2].order_details[0].id)] == \
+        [rows[0]['order_detail_id'], rows[2]['order_detail_id'], rows[3]['order_detail_id']]
+
+
+def test_export_csv_header_without_orders(db_session):
+    output = io.StringIO()
+
+    assert 0 == export_orders(db_session, output, 'csv')
+    assert 'order_id,created_at,order_detail_id,product_id,price,quantity' == output.getvalue().strip()
+
+
+def test_export_arrow(db_session, orders):
+    pyarrow = pytest.importorskip('pyarrow')
+    output = io.BytesIO()
+
+    export_orders(db_session, output, 'arrow', chunk_size=2)
+
+    table = pyarrow.ipc.open_stream(output.getvalue()).read_all()
+    assert [2, 2] == [len(batch) for batch in table.to_batches()]
+    assert [1, 8, None, 2] == table.column('quantity').to_pylist()
@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, Tuple
+
+
+class ProductCache:
+    """ Bounded LRU cache whose entries also expire after `ttl` seconds.
+
+    A read racing a write may put a stale product back after it was
+    invalidated; the ttl bounds how long such an entry can live.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get_many(self, keys: Iterable[Hashable]) -> Tuple[Dict, List]:
+        """ Returns the cached values by key and the keys that missed. """
+        found, missing = {}, []
+        now = time.time()
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                missing.append(key)
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                found[key] = entry[1]
+                self.hits += 1
+        return found, missing
+
+    def set_many(self, values: Dict) -> None:
+        expires_at = time.time() + self.ttl
+        for key, value in values.items():
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, keys: Iterable[Hashable]) -> None:
+        for key in keys:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
@@ -1,24 +1,219 @@
+import json
+import logging
+import random
+import time
+import uuid
+
+import eventlet
 from nameko import config
+from nameko.constants import DEFAULT_MAX_WORKERS, MAX_WORKERS_CONFIG_KEY
 from nameko.extensions import DependencyProvider
-from redis import StrictRedis
-from typing import List, Union, Awaitable, Dict
+from redis import BlockingConnectionPool, StrictRedis
+from redis.exceptions import ConnectionError, RedisError, TimeoutError
+from typing import List, Union, Awaitable, Dict, Iterator, Optional, Tuple
 
-from .exceptions import NotFound
+from .cache import ProductCache
+from .exceptions import NotFound, OutOfStock
+from .sharding import DEFAULT_VNODES, HashRing, ShardedStorageWrapper
 
 DEFAULT_HOST = "DEFAULT_REDIS_URI"
 PROVIDED_HOST = "REDIS_URI"
+BATCH_SIZE = "REDIS_BATCH_SIZE"
+PREVENT_NEGATIVE_STOCK = "PREVENT_NEGATIVE_STOCK"
+POOL = "REDIS_POOL"
+CACHE = "PRODUCT_CACHE"
+REPLICAS = "REDIS_REPLICAS"
+SHARDS = "REDIS_SHARDS"
+SHARD_VNODES = "REDIS_SHARD_VNODES"
+PREVIOUS_SHARDS = "REDIS_PREVIOUS_SHARDS"
+JSON_DOCUMENTS = "PRODUCT_JSON_DOCUMENTS"
+
+DEFAULT_BATCH_SIZE = 500
+
+logger = logging.getLogger("products.dependencies")
+
+# KEYS[1] is the in_stock index, followed by the product hashes and then
+# their JSON document keys. ARGV[1] is "1" to refuse negative stock and
+# ARGV[2] "1" when JSON documents are kept, followed by the stock delta and
+# then the id of each product. Every product is checked before any is
+# written, so the adjustment is all-or-nothing. A kept document has its
+# trailing in_stock value replaced, so its bytes stay those rendered by
+# `render_product`, and is otherwise deleted.
+ADJUST_STOCK_SCRIPT = """
+local count = (#ARGV - 2) / 2
+for i = 1, count do
+    local in_stock = redis.call('HGET', KEYS[i + 1], 'in_stock')
+    if not in_stock then
+        return {'NOT_FOUND', i}
+    end
+    if ARGV[1] == '1' and tonumber(in_stock) + tonumber(ARGV[i + 2]) < 0 then
+        return {'OUT_OF_STOCK', i}
+    end
+end
+local levels = {'OK'}
+for i = 1, count do
+    local level = redis.call('HINCRBY', KEYS[i + 1], 'in_stock', ARGV[i + 2])
+    redis.call('ZADD', KEYS[1], level, ARGV[count + i + 2])
+    local document = ARGV[2] == '1' and redis.call('GET', KEYS[count + i + 1])
+    local prefix = document and string.match(document, '^(.*"in_stock":)%-?%d+}$')
+    if prefix then
+        redis.call('SET', KEYS[count + i + 1], prefix .. level .. '}')
+    else
+        redis.call('DEL', KEYS[count + i + 1])
+    end
+    levels[i + 1] = level
+end
+return levels
+"""
+
+
+def render_product(product: Dict[str, Union[int, str]]) -> str:
+    """ Compact JSON document of a product, as served to HTTP clients.
+
+    `in_stock` must stay last, ADJUST_STOCK_SCRIPT rewrites it in place.
+    """
+    return json.dumps({
+        'id': product['id'],
+        'title': product['title'],
+        'passenger_capacity': int(product['passenger_capacity']),
+        'maximum_speed': int(product['maximum_speed']),
+        'in_stock': int(product['in_stock']),
+    }, separators=(',', ':'))
+
+
+def normalize_title(title: str) -> str:
+    """ Case-folded title with runs of whitespace collapsed, as indexed for
+    prefix lookups.
+    """
+    return ' '.join(title.replace('\x00', '').casefold().split())
+
+
+class InstrumentedConnectionPool(BlockingConnectionPool):
+    """ Blocking connection pool that counts waits for a free connection and
+    failed connection attempts.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.waits = 0
+        self.wait_time = 0.0
+        self.connection_errors = 0
+        super(InstrumentedConnectionPool, self).__init__(*args, **kwargs)
+
+    def get_connection(self, *args, **kwargs):
+        exhausted = self.pool.empty()
+        started = time.time()
+        try:
+            return super(InstrumentedConnectionPool, self).get_connection(*args, **kwargs)
+        except (ConnectionError, TimeoutError):
+            self.connection_errors += 1
+            raise
+        finally:
+            if exhausted:
+                self.waits += 1
+                self.wait_time += time.time() - started
+
+    def metrics(self) -> Dict[str, Union[int, float]]:
+        created = len(self._connections)
+        idle = sum(1 for connection in list(self.pool.queue) if connection is not None)
+        return {
+            'max_connections': self.max_connections,
+            'created': created,
+            'in_use': created - idle,
+            'idle': idle,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'connection_errors': self.connection_errors,
+        }
+
+
+class Replica:
+    """ A read replica and the replication lag last measured for it. """
+
+    def __init__(self, pool: InstrumentedConnectionPool):
+        self.pool = pool
+        self.client = StrictRedis(connection_pool=pool)
+        self.lag = None
+
+    def metrics(self) -> Dict:
+        return {'lag': self.lag, 'pool': self.pool.metrics()}
 
 
 class StorageWrapper:
 
     NotFound = NotFound
 
-    def __init__(self, client):
+    index_key = "index:products"
+    indexed_fields = ('in_stock', 'passenger_capacity', 'maximum_speed')
+    title_index_key = "index:products:title"
+
+    def __init__(self, client, batch_size: int = DEFAULT_BATCH_SIZE, prevent_negative_stock: bool = False,
+                 cache: Optional[ProductCache] = None, read_client=None, fallback_on_miss: bool = False,
+                 json_documents: bool = False):
         self.client = client
+        self.read_client = read_client or client
+        self.fallback_on_miss = fallback_on_miss
+        self.batch_size = batch_size
+        self.prevent_negative_stock = prevent_negative_stock
+        self.cache = cache
+        self.json_documents = json_documents
+        self.adjust_stock_script = client.register_script(ADJUST_STOCK_SCRIPT)
 
     def _format_key(self, product_id: str) -> str:
         return "products:{}".format(product_id)
 
+    def _field_index_key(self, field: str) -> str:
+        return "{}:{}".format(self.index_key, field)
+
+    def _json_key(self, product_id: str) -> str:
+        # Kept outside "products:*" so rebuild_index does not scan documents.
+        return "json:products:{}".format(product_id)
+
+    def _iter_ids(self, start: str = '-') -> Iterator[List[str]]:
+        # The index is a sorted set where every member has score 0, so
+        # ZRANGEBYLEX walks it in id order without a cursor held server side.
+        while True:
+            ids = self.read_client.zrangebylex(self.index_key, start, '+', start=0, num=self.batch_size)
+            if not ids:
+                return
+            yield [product_id.decode('utf-8') for product_id in ids]
+            if len(ids) < self.batch_size:
+                return
+            start = b'(' + ids[-1]
+
+    def _fetch(self, product_ids: List[str]) -> Dict[str, Dict[str, Union[int, str]]]:
+        """ Products by id, from the cache where possible and otherwise with
+        one pipelined round trip. Missing products are left out.
+        """
+        products = {}
+        if self.cache is not None:
+            products, product_ids = self.cache.get_many(product_ids)
+        if not product_ids:
+            return products
+
+        fetched = self._fetch_hashes(product_ids, self.read_client)
+        if self.fallback_on_miss and self.read_client is not self.client and len(fetched) < len(product_ids):
+            # A replica may not have caught up with a recent write yet.
+            fetched.update(self._fetch_hashes(
+                [product_id for product_id in product_ids if product_id not in fetched], self.client
+            ))
+        if self.cache is not None:
+            self.cache.set_many(fetched)
+        products.update(fetched)
+        return products
+
+    def _fetch_hashes(self, product_ids: List[str], client) -> Dict[str, Dict[str, Union[int, str]]]:
+        pipeline = client.pipeline(transaction=False)
+        for product_id in product_ids:
+            pipeline.hgetall(self._format_key(product_id))
+        return {
+            product_id: self._from_hash(document)
+            for product_id, document in zip(product_ids, pipeline.execute()) if document
+        }
+
+    def _get_batch(self, product_ids: List[str]) -> List[Dict[str, Union[int, str]]]:
+        products = self._fetch(product_ids)
+        return [products[product_id] for product_id in product_ids if product_id in products]
+
     def _from_hash(self, document: Union[Awaitable[dict], dict]) -> Dict[str, Union[int, str]]:
         return {
             'id': document[b'id'].decode('utf-8'),
@@ -29,38 +224,525 @@ class StorageWrapper:
         }
 
     def get(self, product_id: str) -> Dict[str, Union[int, str]]:
-        product = self.client.hgetall(self._format_key(product_id))
+        product = self._fetch([product_id]).get(product_id)
         if not product:
             raise NotFound('Product ID {} does not exist'.format(product_id))
         else:
-            return self._from_hash(product)
+            return product
+
+    def get_json(self, product_id: str) -> str:
+        """ The product rendered by `render_product`, ready to be sent as is.
+
+        With JSON documents enabled this is a single GET. A product without
+        a document, stored while they were disabled or whose document was
+        dropped by a write, is rendered from its hash and its document
+        written then. With them disabled, documents are never read, as
+        writes delete them rather than keep them current.
+        """
+        if not self.json_documents:
+            return render_product(self.get(product_id))
+
+        key = self._json_key(product_id)
+        document = self.read_client.get(key)
+        if document is None and self.fallback_on_miss and self.read_client is not self.client:
+            document = self.client.get(key)
+        if document is not None:
+            return document.decode('utf-8')
+
+        hash_key = self._format_key(product_id)
+
+        def render(pipeline):
+            document = pipeline.hgetall(hash_key)
+            if not document:
+                raise NotFound('Product ID {} does not exist'.format(product_id))
+            rendered = render_product(self._from_hash(document))
+            # Watching the hash keeps a concurrent write from being
+            # overwritten with the older rendering.
+            pipeline.multi()
+            pipeline.set(key, rendered)
+            return rendered
+
+        return self.client.transaction(render, hash_key, value_from_callable=True)
 
-    def list(self) -> List[Dict[str, Union[int, str]]]:
-        keys = self.client.keys(self._format_key('*'))
-        for key in keys:
-            yield self._from_hash(self.client.hgetall(key))
+    def get_many(self, product_ids: List[str]) -> Tuple[List[Dict[str, Union[int, str]]], List[str]]:
+        """ Fetch several products in one round trip.
+
+        Returns the products found, in request order, and the ids that do
+        not exist.
+        """
+        product_ids = list(dict.fromkeys(product_ids))
+        products = self._fetch(product_ids)
+        found = [products[product_id] for product_id in product_ids if product_id in products]
+        missing = [product_id for product_id in product_ids if product_id not in products]
+        return found, missing
+
+    def list(self) -> Iterator[Dict[str, Union[int, str]]]:
+        for product_ids in self._iter_ids():
+            for product in self._get_batch(product_ids):
+                yield product
+
+    def list_page(self, limit: int, after: Optional[str] = None) -> Tuple[List[Dict[str, Union[int, str]]], Optional[str]]:
+        """ Return up to `limit` products with ids greater than `after`,
+        plus the id to resume from, or None on the last page.
+        """
+        start = '(' + after if after else '-'
+        ids = self.read_client.zrangebylex(self.index_key, start, '+', start=0, num=limit + 1)
+        product_ids = [product_id.decode('utf-8') for product_id in ids[:limit]]
+        last_id = product_ids[-1] if len(ids) > limit else None
+        return self._get_batch(product_ids) if product_ids else [], last_id
+
+    def _write(self, pipeline, product: Dict[str, Union[int, str]]) -> None:
+        pipeline.hmset(self._format_key(product['id']), product)
+        self._index(pipeline, product)
+        self._write_json(pipeline, product)
+
+    def _write_json(self, pipeline, product: Dict[str, Union[int, str]]) -> None:
+        # A document not kept current must not outlive the write, or it
+        # would be served once documents are enabled again.
+        if self.json_documents:
+            pipeline.set(self._json_key(product['id']), render_product(product))
+        else:
+            pipeline.delete(self._json_key(product['id']))
+
+    def _title_member(self, product_id: str, title: str) -> bytes:
+        # The id keeps members unique, the NUL sorts it before any longer
+        # title sharing the same prefix.
+        return normalize_title(title).encode('utf-8') + b'\x00' + product_id.encode('utf-8')
+
+    def _index(self, pipeline, product: Dict[str, Union[int, str]]) -> None:
+        pipeline.zadd(self.index_key, {product['id']: 0})
+        pipeline.zadd(self.title_index_key, {self._title_member(product['id'], product['title']): 0})
+        for field in self.indexed_fields:
+            pipeline.zadd(self._field_index_key(field), {product['id']: product[field]})
 
     def create(self, product: Dict[str, Union[int, str]]) -> None:
-        self.client.hmset(self._format_key(product['id']), product)
+        pipeline = self.client.pipeline()
+        self._write(pipeline, product)
+        pipeline.execute()
+        self.invalidate([product['id']])
+
+    def create_many(self, products: List[Dict[str, Union[int, str]]]) -> None:
+        for offset in range(0, len(products), self.batch_size):
+            pipeline = self.client.pipeline(transaction=False)
+            for product in products[offset:offset + self.batch_size]:
+                self._write(pipeline, product)
+            pipeline.execute()
+        self.invalidate([product['id'] for product in products])
+
+    def update(self, product_id: str, fields: Dict[str, Union[int, str]]) -> Dict[str, Union[int, str]]:
+        """ Write only `fields` of an existing product and return the
+        updated product.
+
+        Runs as a transaction watching the product hash, so the indexes are
+        moved from the values actually replaced even while stock changes
+        run concurrently.
+        """
+        key = self._format_key(product_id)
+        fields = {field: value for field, value in fields.items() if field != 'id'}
 
-    def decrement_stock(self, product_id: str, amount: int) -> Union[Awaitable[int], int]:
-        return self.client.hincrby(self._format_key(product_id), 'in_stock', -amount)
+        def write(pipeline):
+            document = pipeline.hgetall(key)
+            if not document:
+                raise NotFound('Product ID {} does not exist'.format(product_id))
+            current = self._from_hash(document)
+            product = dict(current, **fields)
+            pipeline.multi()
+            if fields:
+                pipeline.hmset(key, fields)
+            if product['title'] != current['title']:
+                pipeline.zrem(self.title_index_key, self._title_member(product_id, current['title']))
+            self._index(pipeline, product)
+            self._write_json(pipeline, product)
+            return product
+
+        product = self.client.transaction(write, key, value_from_callable=True)
+        self.invalidate([product_id])
+        return product
+
+    @property
+    def caching(self) -> bool:
+        return self.cache is not None
+
+    def invalidate(self, product_ids: List[str]) -> None:
+        if self.cache is not None:
+            self.cache.invalidate(product_ids)
+
+    def adjust_stock(self, deltas: Dict[str, int]) -> Dict[str, int]:
+        """ Apply all stock `deltas` atomically in one round trip.
+
+        Raises NotFound if any product is missing and, when negative stock is
+        prevented, OutOfStock if any level would drop below zero. Nothing is
+        written in either case. Returns the new stock levels.
+        """
+        levels = self._stock_levels(deltas, self._run_adjust_stock(deltas, self.client))
+        self.invalidate(list(levels))
+        return levels
+
+    def adjust_stock_many(self, deltas_list: List[Dict[str, int]]) -> List[Union[Dict[str, int], Exception]]:
+        """ Apply several independent stock adjustments in one round trip.
+
+        Each adjustment is atomic on its own, so one failing does not affect
+        the others. Returns the new stock levels, or the NotFound/OutOfStock
+        error, of every adjustment in order.
+        """
+        pipeline = self.client.pipeline(transaction=False)
+        for deltas in deltas_list:
+            self._run_adjust_stock(deltas, pipeline)
+
+        results = []
+        for deltas, result in zip(deltas_list, pipeline.execute()):
+            try:
+                levels = self._stock_levels(deltas, result)
+            except (NotFound, OutOfStock) as e:
+                results.append(e)
+            else:
+                self.invalidate(list(levels))
+                results.append(levels)
+        return results
+
+    def _run_adjust_stock(self, deltas: Dict[str, int], client) -> list:
+        keys = (
+            [self._field_index_key('in_stock')]
+            + [self._format_key(product_id) for product_id in deltas]
+            + [self._json_key(product_id) for product_id in deltas]
+        )
+        return self.adjust_stock_script(
+            keys=keys,
+            args=[int(self.prevent_negative_stock), int(self.json_documents)] + list(deltas.values()) + list(deltas),
+            client=client,
+        )
+
+    def _stock_levels(self, deltas: Dict[str, int], result: list) -> Dict[str, int]:
+        product_ids = list(deltas)
+        status, *levels = result
+        if status == b'NOT_FOUND':
+            raise NotFound('Product ID {} does not exist'.format(product_ids[levels[0] - 1]))
+        if status == b'OUT_OF_STOCK':
+            raise OutOfStock('Product ID {} is out of stock'.format(product_ids[levels[0] - 1]))
+        return dict(zip(product_ids, levels))
+
+    def decrement_stock(self, product_id: str, amount: int) -> int:
+        return self.adjust_stock({product_id: -amount})[product_id]
+
+    def _titles(self, product_ids: List[str]) -> List[Optional[bytes]]:
+        pipeline = self.client.pipeline(transaction=False)
+        for product_id in product_ids:
+            pipeline.hget(self._format_key(product_id), 'title')
+        return pipeline.execute()
+
+    def _delete(self, pipeline, product_id: str, title: Optional[bytes]) -> None:
+        pipeline.hdel(self._format_key(product_id), "id", "title", "passenger_capacity", "maximum_speed", "in_stock")
+        pipeline.zrem(self.index_key, product_id)
+        for field in self.indexed_fields:
+            pipeline.zrem(self._field_index_key(field), product_id)
+        pipeline.delete(self._json_key(product_id))
+        if title is not None:
+            pipeline.zrem(self.title_index_key, self._title_member(product_id, title.decode('utf-8')))
 
     def delete(self, product_id: str) -> int:
-        return self.client.hdel(self._format_key(product_id), "id", "title", "passenger_capacity", "maximum_speed", "in_stock")
+        title, = self._titles([product_id])
+        pipeline = self.client.pipeline()
+        self._delete(pipeline, product_id, title)
+        deleted_fields = pipeline.execute()[0]
+        self.invalidate([product_id])
+        return deleted_fields
+
+    def rebuild_index(self) -> int:
+        """ Index products stored before the indexes existed, and render
+        their JSON documents when those are enabled or drop them otherwise.
+
+        Uses SCAN rather than KEYS so Redis keeps serving other clients.
+        """
+        indexed = 0
+        keys = []
+        for key in self.client.scan_iter(match=self._format_key('*'), count=self.batch_size):
+            keys.append(key.decode('utf-8').split(':', 1)[1])
+            if len(keys) == self.batch_size:
+                indexed += self._reindex(keys)
+                keys = []
+        if keys:
+            indexed += self._reindex(keys)
+        return indexed
+
+    def _reindex(self, product_ids: List[str]) -> int:
+        products = self._fetch_hashes(product_ids, self.client)
+        pipeline = self.client.pipeline(transaction=False)
+        for product in products.values():
+            self._index(pipeline, product)
+            self._write_json(pipeline, product)
+        pipeline.execute()
+        return len(products)
+
+    @staticmethod
+    def _bounds(ranges: Dict[str, Tuple[Optional[int], Optional[int]]]) -> Dict[str, Tuple]:
+        return {
+            field: ('-inf' if low is None else low, '+inf' if high is None else high)
+            for field, (low, high) in ranges.items()
+        }
+
+    def count_matches(self, ranges: Dict[str, Tuple[Optional[int], Optional[int]]]) -> Dict[str, int]:
+        """ The number of products within each of the `ranges`, by field. """
+        bounds = self._bounds(ranges)
+        pipeline = self.read_client.pipeline(transaction=False)
+        for field, (low, high) in bounds.items():
+            pipeline.zcount(self._field_index_key(field), low, high)
+        return dict(zip(bounds, pipeline.execute()))
+
+    def holds(self, product_ids: List[str]) -> List[bool]:
+        """ Whether each product is stored here, read from the primary. """
+        pipeline = self.client.pipeline(transaction=False)
+        for product_id in product_ids:
+            pipeline.exists(self._format_key(product_id))
+        return [bool(exists) for exists in pipeline.execute()]
+
+    def search(self, ranges: Dict[str, Tuple[Optional[int], Optional[int]]], sort_by: Optional[str] = None,
+               descending: bool = False, limit: int = 100) -> List[Dict[str, Union[int, str]]]:
+        """ Products whose indexed fields fall within the inclusive
+        `(min, max)` ranges, ordered by `sort_by`.
+
+        The index of `sort_by`, or without it the filtered index with the
+        fewest matches, is walked in batches. The other ranges are checked
+        against their indexes before any product hash is read.
+        """
+        bounds = self._bounds(ranges)
+        if sort_by is None and bounds:
+            sort_by = min((count, field) for field, count in self.count_matches(ranges).items())[1]
+        sort_by = sort_by or 'in_stock'
+
+        low, high = bounds.pop(sort_by, ('-inf', '+inf'))
+        batch_size = max(limit, self.batch_size) if bounds else limit
+        products, offset = [], 0
+        while len(products) < limit:
+            if descending:
+                ids = self.read_client.zrevrangebyscore(self._field_index_key(sort_by), high, low,
+                                                        start=offset, num=batch_size)
+            else:
+                ids = self.read_client.zrangebyscore(self._field_index_key(sort_by), low, high,
+                                                     start=offset, num=batch_size)
+            offset += len(ids)
+            product_ids = [product_id.decode('utf-8') for product_id in ids]
+            if bounds:
+                product_ids = self._within(product_ids, bounds)
+            products.extend(self._get_batch(product_ids[:limit - len(products)]))
+            if len(ids) < batch_size:
+                break
+        return products
+
+    def search_title(self, prefix: str, limit: int = 10) -> List[Dict[str, Union[int, str]]]:
+        """ Products whose normalized title starts with `prefix`, ordered by
+        title and then id.
+
+        Each lookup is a ZRANGEBYLEX on the title index. Re-creating a
+        product with another title leaves its old member behind; such
+        members are skipped here and removed once the primary confirms
+        they are stale.
+        """
+        prefix = normalize_title(prefix).encode('utf-8')
+        # UTF-8 never contains 0xff, so it sorts after every member that
+        # starts with the prefix.
+        low, high = (b'[' + prefix, b'[' + prefix + b'\xff') if prefix else ('-', '+')
+        products = []
+        while len(products) < limit:
+            wanted = limit - len(products)
+            members = self.read_client.zrangebylex(self.title_index_key, low, high, start=0, num=wanted)
+            entries = [
+                (member, member.split(b'\x00', 1)[1].decode('utf-8')) for member in members
+            ]
+            found = self._fetch([product_id for _, product_id in entries])
+            suspects = []
+            for member, product_id in entries:
+                product = found.get(product_id)
+                if product and self._title_member(product_id, product['title']) == member:
+                    products.append(product)
+                else:
+                    suspects.append((member, product_id))
+            if suspects:
+                self._drop_stale_titles(suspects)
+            if len(members) < wanted:
+                break
+            low = b'(' + members[-1]
+        return products
+
+    def _drop_stale_titles(self, entries: List[Tuple[bytes, str]]) -> None:
+        titles = self._titles([product_id for _, product_id in entries])
+        stale = [
+            member for (member, product_id), title in zip(entries, titles)
+            if title is None or self._title_member(product_id, title.decode('utf-8')) != member
+        ]
+        if stale:
+            self.client.zrem(self.title_index_key, *stale)
+
+    def _within(self, product_ids: List[str], bounds: Dict[str, Tuple]) -> List[str]:
+        pipeline = self.read_client.pipeline(transaction=False)
+        for product_id in product_ids:
+            for field in bounds:
+                pipeline.zscore(self._field_index_key(field), product_id)
+        scores = iter(pipeline.execute())
+        matching = []
+        for product_id in product_ids:
+            product_scores = [next(scores) for _ in bounds]
+            if all(
+                score is not None and float(low) <= score <= float(high)
+                for (low, high), score in zip(bounds.values(), product_scores)
+            ):
+                matching.append(product_id)
+        return matching
 
     def test_connection(self) -> None:
         self.client.hgetall(self._format_key('*'))
 
 
 class Storage(DependencyProvider):
+    """ Redis storage, optionally reading from replicas.
+
+    With `REDIS_REPLICAS.uris` configured, each worker reads from a random
+    replica whose lag is at most `max_lag` seconds and falls back to the
+    primary when none qualifies. Lag is measured every `check_interval`
+    seconds from a heartbeat key this instance writes to the primary, so it
+    is an upper bound that includes the interval. With `fallback_on_miss`,
+    products a replica does not have yet are looked up on the primary.
+    Writes always go to the primary.
+
+    With `PRODUCT_JSON_DOCUMENTS` enabled, every product also keeps its
+    rendered JSON document, updated with each write, so `get_json` needs
+    no decoding or encoding at all. With it disabled, writes delete the
+    document instead.
+
+    With `REDIS_SHARDS` configured as a mapping of stable shard names to
+    URIs, products are instead spread over those nodes by consistent
+    hashing, see `products.sharding`. Replicas are not used in that mode.
+    """
     client: StrictRedis
 
     def setup(self):
+        # Every worker holds at most one connection at a time, so the pool
+        # defaults to one connection per worker.
+        pool_options = dict(config.get(POOL) or {})
+        pool_options.setdefault('max_connections', config.get(MAX_WORKERS_CONFIG_KEY, DEFAULT_MAX_WORKERS))
+
+        replica_options = config.get(REPLICAS) or {}
+        self.replicas = [
+            Replica(InstrumentedConnectionPool.from_url(uri, **pool_options))
+            for uri in replica_options.get('uris') or []
+        ]
+        self.max_lag = float(replica_options.get('max_lag', 5))
+        self.check_interval = float(replica_options.get('check_interval', 1))
+        self.fallback_on_miss = bool(replica_options.get('fallback_on_miss', True))
+        self.heartbeat_key = 'heartbeat:products:{}'.format(uuid.uuid4().hex)
+
+        shard_uris = config.get(SHARDS) or {}
+        self.shards = {
+            name: StrictRedis(connection_pool=InstrumentedConnectionPool.from_url(uri, **pool_options))
+            for name, uri in shard_uris.items()
+        }
+        vnodes = int(config.get(SHARD_VNODES) or DEFAULT_VNODES)
+        self.ring = HashRing(self.shards, vnodes) if self.shards else None
+        # Set while products move to shards just added, see products.rebalance.
+        previous_shards = config.get(PREVIOUS_SHARDS) or []
+        unknown = set(previous_shards) - set(self.shards)
+        if unknown:
+            raise ValueError('{} lists shards missing from {}: {}'.format(
+                PREVIOUS_SHARDS, SHARDS, ', '.join(sorted(unknown))
+            ))
+        self.previous_ring = HashRing(previous_shards, vnodes) if previous_shards else None
+        if self.shards:
+            self.replicas = []
+
         if config.get(PROVIDED_HOST) is None:
-            self.client = StrictRedis.from_url(config.get(DEFAULT_HOST))
+            self.pool = InstrumentedConnectionPool.from_url(config.get(DEFAULT_HOST), **pool_options)
         else:
-            self.client = StrictRedis.from_url(config.get(PROVIDED_HOST))
+            self.pool = InstrumentedConnectionPool.from_url(config.get(PROVIDED_HOST), **pool_options)
+        self.client = StrictRedis(connection_pool=self.pool)
+        self.batch_size = int(config.get(BATCH_SIZE) or DEFAULT_BATCH_SIZE)
+        self.prevent_negative_stock = bool(config.get(PREVENT_NEGATIVE_STOCK, False))
+        self.json_documents = bool(config.get(JSON_DOCUMENTS, False))
+
+        # The cache is shared by all workers of this service instance and is
+        # disabled unless a positive max_size is configured.
+        cache_options = config.get(CACHE) or {}
+        self.cache = None
+        if cache_options.get('max_size'):
+            self.cache = ProductCache(int(cache_options['max_size']), float(cache_options.get('ttl', 30)))
+
+    def start(self):
+        if self.replicas:
+            self.container.spawn_managed_thread(self._watch_replicas, identifier='Storage.watch_replicas')
+
+    def _watch_replicas(self):
+        while True:
+            self.check_replicas()
+            eventlet.sleep(self.check_interval)
+
+    def check_replicas(self) -> None:
+        now = time.time()
+        for replica in self.replicas:
+            try:
+                heartbeat = replica.client.get(self.heartbeat_key)
+            except RedisError as e:
+                logger.warning("Replica lag check failed: %s", e)
+                heartbeat = None
+            replica.lag = now - float(heartbeat) if heartbeat is not None else None
+        try:
+            self.client.set(self.heartbeat_key, now, ex=max(60, int(self.max_lag * 10)))
+        except RedisError as e:
+            logger.warning("Replica heartbeat failed: %s", e)
+
+    def _read_client(self) -> StrictRedis:
+        healthy = [
+            replica for replica in self.replicas
+            if replica.lag is not None and replica.lag <= self.max_lag
+        ]
+        return random.choice(healthy).client if healthy else self.client
+
+    def get_dependency(self, worker_ctx) -> Union[StorageWrapper, ShardedStorageWrapper]:
+        if self.shards:
+            return ShardedStorageWrapper(
+                {
+                    name: StorageWrapper(
+                        client,
+                        batch_size=self.batch_size,
+                        prevent_negative_stock=self.prevent_negative_stock,
+                        cache=self.cache,
+                        json_documents=self.json_documents,
+                    )
+                    for name, client in self.shards.items()
+                },
+                self.ring,
+                self.batch_size,
+                self.cache,
+                self.previous_ring,
+            )
+        return StorageWrapper(
+            self.client,
+            batch_size=self.batch_size,
+            prevent_negative_stock=self.prevent_negative_stock,
+            cache=self.cache,
+            read_client=self._read_client(),
+            fallback_on_miss=self.fallback_on_miss,
+            json_documents=self.json_documents,
+        )
+
+    def metrics(self) -> Dict[str, Dict]:
+        return {
+            'pool': self.pool.metrics(),
+            'cache': self.cache.metrics() if self.cache is not None else None,
+            'replicas': [replica.metrics() for replica in self.replicas],
+            'shards': {name: client.connection_pool.metrics() for name, client in self.shards.items()},
+        }
+
+
+class Metrics(DependencyProvider):
+    """ Collects the `metrics()` of every extension of the service that
+    provides them, keyed by entrypoint method or dependency attribute name.
+    """
+
+    def collect(self) -> Dict[str, Dict]:
+        collected = {}
+        for extension in self.container.extensions:
+            if extension is not self and hasattr(extension, 'metrics'):
+                name = getattr(extension, 'method_name', None) or extension.attr_name
+                collected[name] = extension.metrics()
+        return collected
 
-    def get_dependency(self, worker_ctx) -> StorageWrapper:
-        return StorageWrapper(self.client)
+    def get_dependency(self, worker_ctx):
+        return self.collect
@@ -0,0 +1,128 @@
+import time
+from functools import partial
+from typing import Dict, List, Union
+
+import eventlet
+from nameko import config
+from nameko.constants import DEFAULT_PREFETCH_COUNT, PREFETCH_COUNT_CONFIG_KEY
+from nameko.events import EventHandler
+from nameko.exceptions import ContainerBeingKilled
+from nameko.messaging import decode_from_headers
+
+BATCH_SIZE = "EVENT_BATCH_SIZE"
+BATCH_WINDOW = "EVENT_BATCH_WINDOW"
+BATCH_PREFETCH_COUNT = "EVENT_BATCH_PREFETCH_COUNT"
+
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_BATCH_WINDOW = 0.1
+
+
+class BatchEventHandler(EventHandler):
+    """ Event handler that passes a list of event payloads to each worker.
+
+    A batch is handed to a worker once `batch_size` events are waiting, or
+    `window` seconds after its oldest event arrived. All messages of a batch
+    are acked (or requeued, see `requeue_on_error`) together when the worker
+    finishes. Unacked messages are redelivered by the broker if the service
+    stops before their batch is dispatched.
+
+    `batch_size`, `window` and `prefetch_count` default to the
+    `EVENT_BATCH_SIZE`, `EVENT_BATCH_WINDOW` and `EVENT_BATCH_PREFETCH_COUNT`
+    config values. The prefetch count is never lower than the batch size,
+    otherwise batches could not fill up.
+    """
+
+    def __init__(self, source_service, event_type, batch_size=None, window=None, **kwargs):
+        self.batch_size = batch_size
+        self.window = window
+        super(BatchEventHandler, self).__init__(source_service, event_type, **kwargs)
+
+    def setup(self):
+        self.batch_size = int(self.batch_size or config.get(BATCH_SIZE, DEFAULT_BATCH_SIZE))
+        self.window = float(self.window or config.get(BATCH_WINDOW, DEFAULT_BATCH_WINDOW))
+
+        prefetch_count = self.consumer_options.get('prefetch_count') or config.get(
+            BATCH_PREFETCH_COUNT, config.get(PREFETCH_COUNT_CONFIG_KEY, DEFAULT_PREFETCH_COUNT)
+        )
+        self.consumer_options['prefetch_count'] = max(int(prefetch_count), self.batch_size)
+
+        self.pending = []
+        self.stats = {
+            'batches': 0,
+            'events': 0,
+            'last_batch_size': 0,
+            'max_batch_size': 0,
+            'last_lag': 0.0,
+            'max_lag': 0.0,
+        }
+        super(BatchEventHandler, self).setup()
+
+    def start(self):
+        super(BatchEventHandler, self).start()
+        ident = u"{}.flush_on_window[{}.{}]".format(
+            type(self).__name__, self.container.service_name, self.method_name
+        )
+        self.container.spawn_managed_thread(self._flush_on_window, identifier=ident)
+
+    def handle_message(self, body, message):
+        self.pending.append((body, message, time.time()))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def _flush_on_window(self):
+        while True:
+            wait = self.window
+            if self.pending:
+                wait = self.pending[0][2] + self.window - time.time()
+                if wait <= 0:
+                    self.flush()
+                    continue
+            eventlet.sleep(wait)
+
+    def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        self._record(batch)
+
+        args = ([body for body, _, _ in batch],)
+        messages = [message for _, message, _ in batch]
+        context_data = decode_from_headers(messages[0].headers)
+        handle_result = partial(self.handle_result, messages)
+
+        def spawn_worker():
+            try:
+                self.container.spawn_worker(
+                    self, args, {},
+                    context_data=context_data,
+                    handle_result=handle_result
+                )
+            except ContainerBeingKilled:
+                for message in messages:
+                    self.consumer.requeue_message(message)
+
+        ident = u"{}.wait_for_worker_pool[{}.{}]".format(
+            type(self).__name__, self.container.service_name, self.method_name
+        )
+        self.container.spawn_managed_thread(spawn_worker, identifier=ident)
+
+    def handle_result(self, messages, worker_ctx, result=None, exc_info=None):
+        for message in messages:
+            self.handle_message_processed(message, result, exc_info)
+        return result, exc_info
+
+    def _record(self, batch: List) -> None:
+        size, lag = len(batch), time.time() - batch[0][2]
+        self.stats['batches'] += 1
+        self.stats['events'] += size
+        self.stats['last_batch_size'] = size
+        self.stats['max_batch_size'] = max(self.stats['max_batch_size'], size)
+        self.stats['last_lag'] = lag
+        self.stats['max_lag'] = max(self.stats['max_lag'], lag)
+
+    def metrics(self) -> Dict[str, Union[int, float]]:
+        return dict(self.stats, pending=len(self.pending))
+
+
+batch_event_handler = BatchEventHandler.decorator
@@ -1,2 +1,10 @@
 class NotFound(Exception):
     pass
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class OutOfStock(Exception):
+    pass
@@ -0,0 +1,109 @@
+""" Moves products to the shard that owns them after shards are added.
+
+Usage ::
+
+    python -m products.rebalance \
+        --shard a=redis://localhost:6379/7 --shard b=redis://localhost:6380/7 \
+        --add c=redis://localhost:6381/7
+
+Adding shards takes three steps:
+
+1. Add the new shards to REDIS_SHARDS and list the shards there before in
+   REDIS_PREVIOUS_SHARDS. The services then look for a product whose
+   owner changes on its previous owner first, where it stays until it is
+   moved, so nothing has to move before every instance is updated.
+   Products created meanwhile go to their new owner, which instances
+   still running the old configuration do not read.
+2. Once all instances run the new configuration, run this command.
+3. Empty REDIS_PREVIOUS_SHARDS again.
+
+Every product is moved on its own. Its hash on the old shard is watched
+while it is copied to the new owner, with its indexes and JSON document,
+and is deleted only if it did not change in the meantime; otherwise the
+copy is made again. As the services read the old shard first, they see
+every write whether it landed before or after the copy.
+"""
+import argparse
+from collections import defaultdict
+from typing import Dict, Union
+
+from redis import StrictRedis
+
+from products.dependencies import StorageWrapper
+from products.sharding import DEFAULT_VNODES, HashRing, shard_argument
+
+
+def move(source: StorageWrapper, target: StorageWrapper, product_id: str) -> bool:
+    """ Moves one product, returns False if `source` does not hold it. """
+    key = source._format_key(product_id)
+    copies = []
+
+    def copy(pipeline):
+        document = pipeline.hgetall(key)
+        if not document:
+            return False
+        product = source._from_hash(document)
+        target.create(product)
+        copies.append(product)
+        pipeline.multi()
+        source._delete(pipeline, product_id, document[b'title'])
+        return True
+
+    moved = source.client.transaction(copy, key, value_from_callable=True)
+    if not moved and copies:
+        # Deleted while it was being copied.
+        _discard(target, copies[-1])
+    return moved
+
+
+def _discard(storage: StorageWrapper, product: Dict[str, Union[int, str]]) -> None:
+    """ Deletes `product` unless it was written again since. """
+    key = storage._format_key(product['id'])
+
+    def discard(pipeline):
+        document = pipeline.hgetall(key)
+        if not document or storage._from_hash(document) != product:
+            return
+        pipeline.multi()
+        storage._delete(pipeline, product['id'], document[b'title'])
+
+    storage.client.transaction(discard, key)
+
+
+def rebalance(shards: Dict[str, StorageWrapper], old_ring: HashRing, new_ring: HashRing) -> Dict[str, int]:
+    """ Returns the number of products moved to each shard. """
+    moved = defaultdict(int)
+    for name in old_ring.nodes:
+        storage = shards[name]
+        for product_ids in storage._iter_ids():
+            for product_id in product_ids:
+                owner = new_ring.get_node(product_id)
+                if owner != name and move(storage, shards[owner], product_id):
+                    moved[owner] += 1
+    return dict(moved)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move products after adding Redis shards.')
+    parser.add_argument('--shard', type=shard_argument, action='append', required=True,
+                        help='an existing shard as name=uri, repeat for every shard')
+    parser.add_argument('--add', type=shard_argument, action='append', required=True,
+                        help='a new shard as name=uri, repeat for every new shard')
+    parser.add_argument('--vnodes', type=int, default=DEFAULT_VNODES)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args(argv)
+
+    uris = dict(args.shard + args.add)
+    shards = {
+        name: StorageWrapper(StrictRedis.from_url(uri), batch_size=args.batch_size)
+        for name, uri in uris.items()
+    }
+    old_ring = HashRing([name for name, _ in args.shard], args.vnodes)
+    new_ring = HashRing(uris, args.vnodes)
+
+    for name, count in sorted(rebalance(shards, old_ring, new_ring).items()):
+        print('{} products moved to {}'.format(count, name))
+
+
+if __name__ == '__main__':
+    main()
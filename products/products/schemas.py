@@ -7,3 +7,8 @@ class Product(Schema):
     passenger_capacity = fields.Int(required=True)
     maximum_speed = fields.Int(required=True)
     in_stock = fields.Int(required=True)
+
+
+class Range(Schema):
+    min = fields.Int(allow_none=True)
+    max = fields.Int(allow_none=True)
@@ -1,13 +1,19 @@
+import base64
+import binascii
 import logging.config
-from typing import Dict, Union, List
+from collections import defaultdict
+from typing import Dict, Union, List, Optional
 
 import yaml
+from marshmallow import ValidationError
 from os import path
 
-from nameko.events import event_handler
+from nameko.events import BROADCAST, EventDispatcher, event_handler
 from nameko.rpc import rpc
 
 from products import dependencies, schemas
+from products.entrypoints import batch_event_handler
+from products.exceptions import InvalidCursor, NotFound, OutOfStock
 
 logging_file = path.abspath('logging_config.yaml')
 
@@ -17,12 +23,37 @@ with open(logging_file, 'r') as config_file:
 
 logger = logging.getLogger("products.service")
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(product_id: Optional[str]) -> Optional[str]:
+    if product_id is None:
+        return None
+    return base64.urlsafe_b64encode(product_id.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[str]:
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (binascii.Error, UnicodeError):
+        raise InvalidCursor('Invalid cursor {}'.format(cursor))
+
 
 class ProductsService:
 
     name = 'products'
 
     storage = dependencies.Storage()
+    collect_metrics = dependencies.Metrics()
+    event_dispatcher = EventDispatcher()
+
+    def _products_changed(self, product_ids: List[str]) -> None:
+        # Every instance keeps its own cache, so tell all of them.
+        if product_ids and self.storage.caching:
+            self.event_dispatcher('products_changed', {'ids': product_ids})
 
     @rpc
     def test_connection(self) -> None:
@@ -39,6 +70,24 @@ class ProductsService:
         logger.info("Product with id %s successfully retrieved", product_id)
         return schemas.Product().dump(product).data
 
+    @rpc
+    def get_json(self, product_id: str) -> str:
+        """ The product as a JSON document, for callers that pass it on
+        unchanged.
+        """
+        document = self.storage.get_json(product_id)
+        logger.info("Product with id %s successfully retrieved", product_id)
+        return document
+
+    @rpc
+    def get_many(self, product_ids: List[str]) -> Dict[str, List]:
+        products, missing = self.storage.get_many(product_ids)
+        logger.info("%s products successfully retrieved, %s not found", len(products), len(missing))
+        return {
+            'products': schemas.Product(many=True).dump(products).data,
+            'missing': missing,
+        }
+
     @rpc
     def list(self) -> List[Dict[str, Union[int, str]]]:
         products = self.storage.list()
@@ -46,19 +95,158 @@ class ProductsService:
         logger.info("%s products successfully retrieved", len(dumped_products))
         return dumped_products
 
+    @rpc
+    def list_page(self, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None) -> Dict[str, Union[str, List]]:
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        products, last_id = self.storage.list_page(limit, decode_cursor(cursor))
+        dumped_products = schemas.Product(many=True).dump(products).data
+        logger.info("%s products successfully retrieved", len(dumped_products))
+        return {
+            'products': dumped_products,
+            'next_cursor': encode_cursor(last_id),
+        }
+
+    @rpc
+    def search(self, filters: Optional[Dict[str, Dict[str, int]]] = None, sort_by: Optional[str] = None,
+               descending: bool = False, limit: int = DEFAULT_PAGE_SIZE) -> List[Dict[str, Union[int, str]]]:
+        """ Products filtered by inclusive ranges on the indexed fields, e.g. ::
+
+            search({'in_stock': {'min': 1}, 'passenger_capacity': {'min': 50, 'max': 100}},
+                   sort_by='maximum_speed', descending=True, limit=10)
+        """
+        filters = filters or {}
+        indexed_fields = dependencies.StorageWrapper.indexed_fields
+        errors = {
+            field: ['Not an indexed field.']
+            for field in list(filters) + [sort_by] if field is not None and field not in indexed_fields
+        }
+        if errors:
+            raise ValidationError(errors)
+
+        ranges = {}
+        for field, bounds in filters.items():
+            bounds = schemas.Range(strict=True).load(bounds).data
+            ranges[field] = (bounds.get('min'), bounds.get('max'))
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+        products = self.storage.search(ranges, sort_by, descending, limit)
+        dumped_products = schemas.Product(many=True).dump(products).data
+        logger.info("%s products found", len(dumped_products))
+        return dumped_products
+
+    @rpc
+    def search_title(self, prefix: str, limit: int = 10) -> List[Dict[str, Union[int, str]]]:
+        """ Products whose title starts with `prefix`, ignoring case and
+        repeated whitespace, ordered by title.
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        products = self.storage.search_title(prefix, limit)
+        dumped_products = schemas.Product(many=True).dump(products).data
+        logger.info("%s products found for title prefix %r", len(dumped_products), prefix)
+        return dumped_products
+
     @rpc
     def create(self, product: Dict[str, Union[int, str]]) -> None:
         product = schemas.Product(strict=True).load(product).data
         self.storage.create(product)
+        self._products_changed([product['id']])
         logger.info("Product with id %s created successfully", product['id'])
 
+    @rpc
+    def create_many(self, products: List[Dict[str, Union[int, str]]]) -> Dict[str, Union[List[str], Dict]]:
+        """ Validates all `products` in one pass and stores the valid ones.
+
+        Invalid items are skipped and reported by their position in the
+        input list.
+        """
+        if not isinstance(products, list):
+            raise ValidationError('Invalid input type.')
+
+        loaded, errors = schemas.Product(many=True).load(products)
+        valid_products = [
+            product for index, product in enumerate(loaded)
+            if product is not None and index not in errors
+        ]
+        item_errors = {
+            str(index): errors[index] or {'_schema': ['Invalid input type.']}
+            for index in errors if index != '_schema'
+        }
+
+        self.storage.create_many(valid_products)
+        self._products_changed([product['id'] for product in valid_products])
+        logger.info("%s products created successfully, %s rejected", len(valid_products), len(item_errors))
+        return {
+            'created': [product['id'] for product in valid_products],
+            'errors': item_errors,
+        }
+
+    @rpc
+    def update(self, product_id: str, fields: Dict[str, Union[int, str]]) -> Dict[str, Union[int, str]]:
+        """ Changes only the given fields of a product. The id cannot be
+        changed. Returns the updated product.
+        """
+        fields = schemas.Product(strict=True, partial=True, exclude=('id',)).load(fields).data
+        product = self.storage.update(product_id, fields)
+        self._products_changed([product_id])
+        logger.info("Product with id %s updated successfully", product_id)
+        return schemas.Product().dump(product).data
+
+    @rpc
+    def restock_many(self, deltas: Dict[str, int]) -> Dict[str, int]:
+        """ Changes the stock of several products by the given amounts in
+        one atomic step and returns the new stock levels.
+
+        Nothing is changed if any product does not exist or, when negative
+        stock is prevented, would drop below zero.
+        """
+        errors = {
+            product_id: ['Not a valid integer.']
+            for product_id, delta in deltas.items() if isinstance(delta, bool) or not isinstance(delta, int)
+        }
+        if errors:
+            raise ValidationError(errors)
+
+        levels = self.storage.adjust_stock(deltas) if deltas else {}
+        self._products_changed(list(levels))
+        logger.info("Stock of %s products changed", len(levels))
+        return levels
+
     @rpc
     def delete(self, product_id: str) -> None:
         deleted_fields = self.storage.delete(product_id)
+        self._products_changed([product_id])
         logger.info("%s fields deleted successfully for product with id %s", deleted_fields, product_id)
 
-    @event_handler('orders', 'order_created')
-    def handle_order_created(self, payload):
-        for product in payload['order']['order_details']:
-            self.storage.decrement_stock(
-                product['product_id'], product['quantity'])
+    @rpc
+    def rebuild_index(self) -> int:
+        indexed = self.storage.rebuild_index()
+        logger.info("%s products added to the product index", indexed)
+        return indexed
+
+    @rpc
+    def metrics(self) -> Dict[str, Dict]:
+        return self.collect_metrics()
+
+    @batch_event_handler('orders', 'order_created')
+    def handle_order_created(self, payloads: List[Dict]):
+        deltas_list = []
+        for payload in payloads:
+            deltas = defaultdict(int)
+            for product in payload['order']['order_details']:
+                deltas[product['product_id']] -= product['quantity']
+            deltas_list.append(deltas)
+
+        results = self.storage.adjust_stock_many(deltas_list)
+
+        changed = set()
+        for payload, result in zip(payloads, results):
+            if isinstance(result, (NotFound, OutOfStock)):
+                logger.error("Stock not updated for order with id %s: %s", payload['order']['id'], result)
+            else:
+                changed.update(result)
+        self._products_changed(sorted(changed))
+        logger.info("Stock updated for a batch of %s orders", len(payloads))
+
+    @event_handler('products', 'products_changed', handler_type=BROADCAST, reliable_delivery=False)
+    def handle_products_changed(self, payload: Dict[str, List[str]]):
+        self.storage.invalidate(payload['ids'])
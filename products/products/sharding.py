@@ -0,0 +1,294 @@
+import argparse
+import bisect
+import hashlib
+import heapq
+from collections import defaultdict
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from eventlet.greenpool import GreenPool
+
+from .exceptions import NotFound, OutOfStock
+
+DEFAULT_VNODES = 100
+
+
+class HashRing:
+    """ Consistent hash ring mapping product ids to shard names.
+
+    Each shard is placed on the ring `vnodes` times, so adding a shard only
+    moves about 1/n of the products, all of them to the new shard.
+    """
+
+    def __init__(self, nodes: Iterable[str], vnodes: int = DEFAULT_VNODES):
+        self.nodes = sorted(nodes)
+        self.ring = sorted(
+            (self._hash('{}#{}'.format(node, vnode)), node)
+            for node in self.nodes for vnode in range(vnodes)
+        )
+        self.hashes = [point for point, _ in self.ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def get_node(self, product_id: str) -> str:
+        index = bisect.bisect(self.hashes, self._hash(str(product_id))) % len(self.ring)
+        return self.ring[index][1]
+
+
+def shard_argument(value: str) -> Tuple[str, str]:
+    """ Parses a `name=uri` command line argument naming a shard. """
+    name, _, uri = value.partition('=')
+    if not name or not uri:
+        raise argparse.ArgumentTypeError('expected name=uri, got {}'.format(value))
+    return name, uri
+
+
+class ShardedStorageWrapper:
+    """ Spreads products over several Redis nodes.
+
+    Every shard is a complete `StorageWrapper` holding its own products and
+    indexes. Calls about one product go to the shard that owns it, and
+    calls spanning several shards run on all of them in parallel and merge
+    the results.
+
+    Stock adjustments are atomic per shard only. When part of an adjustment
+    fails, the parts already applied on other shards are reverted.
+
+    While products move to the shards of a new ring, `previous_ring` is the
+    ring they move from. A product whose owner changes is looked for on its
+    previous owner first and is used there until it has been moved, see
+    `products.rebalance`.
+    """
+
+    NotFound = NotFound
+
+    def __init__(self, shards: Dict, ring: HashRing, batch_size: int, cache=None,
+                 previous_ring: Optional[HashRing] = None):
+        self.shards = shards
+        self.ring = ring
+        self.previous_ring = previous_ring
+        self.batch_size = batch_size
+        self.cache = cache
+        self.pool = GreenPool(len(shards))
+
+    @property
+    def indexed_fields(self) -> Tuple[str, ...]:
+        return next(iter(self.shards.values())).indexed_fields
+
+    def _previous_owner(self, product_id: str) -> Optional[str]:
+        """ The shard the product is moving from, if it is moving. """
+        if self.previous_ring is None:
+            return None
+        previous = self.previous_ring.get_node(product_id)
+        return previous if previous != self.ring.get_node(product_id) else None
+
+    def _holders(self, product_ids: Iterable[str]) -> Dict[str, str]:
+        """ The shard holding each product, or that would hold it if it
+        does not exist.
+        """
+        holders = {product_id: self.ring.get_node(product_id) for product_id in product_ids}
+        moving = defaultdict(list)
+        for product_id in holders:
+            previous = self._previous_owner(product_id)
+            if previous is not None:
+                moving[previous].append(product_id)
+        if not moving:
+            return holders
+        held = self._fan_out({name: ('holds', ids) for name, ids in moving.items()})
+        for name, ids in moving.items():
+            holders.update((product_id, name) for product_id, holds in zip(ids, held[name]) if holds)
+        return holders
+
+    def _shard(self, product_id: str):
+        return self.shards[self._holders([product_id])[product_id]]
+
+    def _group(self, product_ids: Iterable[str]) -> Dict[str, List[str]]:
+        groups = defaultdict(list)
+        for product_id, name in self._holders(product_ids).items():
+            groups[name].append(product_id)
+        return groups
+
+    def _call(self, product_id: str, method: str, *args):
+        """ Calls `method` on the shard holding the product, again on its
+        new owner if it was moved in between.
+        """
+        try:
+            return getattr(self._shard(product_id), method)(*args)
+        except NotFound:
+            if self._previous_owner(product_id) is None:
+                raise
+            return getattr(self.shards[self.ring.get_node(product_id)], method)(*args)
+
+    @staticmethod
+    def _unique(products: Iterable[Dict[str, Union[int, str]]]) -> Iterator[Dict[str, Union[int, str]]]:
+        # A product being moved is on two shards for a moment.
+        seen = set()
+        for product in products:
+            if product['id'] not in seen:
+                seen.add(product['id'])
+                yield product
+
+    def _fan_out(self, calls: Dict[str, tuple]) -> Dict[str, object]:
+        """ Runs `{shard name: (method name, *args)}` in parallel. """
+        names = list(calls)
+        results = self.pool.imap(
+            lambda name: getattr(self.shards[name], calls[name][0])(*calls[name][1:]), names
+        )
+        return dict(zip(names, results))
+
+    @property
+    def caching(self) -> bool:
+        return self.cache is not None
+
+    def invalidate(self, product_ids: List[str]) -> None:
+        if self.cache is not None:
+            self.cache.invalidate(product_ids)
+
+    def get(self, product_id: str) -> Dict[str, Union[int, str]]:
+        return self._call(product_id, 'get', product_id)
+
+    def get_json(self, product_id: str) -> str:
+        return self._call(product_id, 'get_json', product_id)
+
+    def _get_grouped(self, groups: Dict[str, List[str]]) -> Dict[str, Dict[str, Union[int, str]]]:
+        results = self._fan_out({name: ('get_many', ids) for name, ids in groups.items()})
+        return {product['id']: product for found, _ in results.values() for product in found}
+
+    def get_many(self, product_ids: List[str]) -> Tuple[List[Dict[str, Union[int, str]]], List[str]]:
+        product_ids = list(dict.fromkeys(product_ids))
+        products = self._get_grouped(self._group(product_ids))
+        moved = defaultdict(list)
+        for product_id in product_ids:
+            if product_id not in products and self._previous_owner(product_id) is not None:
+                moved[self.ring.get_node(product_id)].append(product_id)
+        if moved:
+            products.update(self._get_grouped(moved))
+        found = [products[product_id] for product_id in product_ids if product_id in products]
+        return found, [product_id for product_id in product_ids if product_id not in products]
+
+    def list(self) -> Iterator[Dict[str, Union[int, str]]]:
+        after = None
+        while True:
+            products, after = self.list_page(self.batch_size, after)
+            for product in products:
+                yield product
+            if after is None:
+                return
+
+    def list_page(self, limit: int, after: Optional[str] = None) -> Tuple[List[Dict[str, Union[int, str]]], Optional[str]]:
+        results = self._fan_out({name: ('list_page', limit, after) for name in self.shards})
+        merged = list(self._unique(
+            heapq.merge(*(products for products, _ in results.values()), key=lambda p: p['id'])
+        ))
+        page = merged[:limit]
+        more = len(merged) > limit or any(last_id is not None for _, last_id in results.values())
+        return page, page[-1]['id'] if page and more else None
+
+    def search(self, ranges: Dict[str, Tuple[Optional[int], Optional[int]]], sort_by: Optional[str] = None,
+               descending: bool = False, limit: int = 100) -> List[Dict[str, Union[int, str]]]:
+        if sort_by is None:
+            # Every shard has to walk the same index for the results to
+            # merge, so pick the one with the fewest matches over all shards.
+            totals = defaultdict(int)
+            if ranges:
+                for counts in self._fan_out({name: ('count_matches', ranges) for name in self.shards}).values():
+                    for field, count in counts.items():
+                        totals[field] += count
+            sort_by = min((count, field) for field, count in totals.items())[1] if totals else 'in_stock'
+
+        results = self._fan_out({
+            name: ('search', ranges, sort_by, descending, limit) for name in self.shards
+        })
+        # Each shard returns ties on sort_by in id order.
+        return list(islice(self._unique(heapq.merge(
+            *results.values(), key=lambda product: (product[sort_by], product['id']), reverse=descending
+        )), limit))
+
+    def search_title(self, prefix: str, limit: int = 10) -> List[Dict[str, Union[int, str]]]:
+        results = self._fan_out({name: ('search_title', prefix, limit) for name in self.shards})
+        # Merge in the order of the shards' title index members.
+        title_member = next(iter(self.shards.values()))._title_member
+        return list(islice(self._unique(heapq.merge(
+            *results.values(), key=lambda product: title_member(product['id'], product['title'])
+        )), limit))
+
+    def create(self, product: Dict[str, Union[int, str]]) -> None:
+        self._shard(product['id']).create(product)
+
+    def create_many(self, products: List[Dict[str, Union[int, str]]]) -> None:
+        groups = defaultdict(list)
+        holders = self._holders(product['id'] for product in products)
+        for product in products:
+            groups[holders[product['id']]].append(product)
+        self._fan_out({name: ('create_many', shard_products) for name, shard_products in groups.items()})
+
+    def update(self, product_id: str, fields: Dict[str, Union[int, str]]) -> Dict[str, Union[int, str]]:
+        return self._call(product_id, 'update', product_id, fields)
+
+    def delete(self, product_id: str) -> int:
+        # A moving product is deleted from both shards, so a move in
+        # progress cannot bring it back.
+        previous = self._previous_owner(product_id)
+        deleted = self.shards[previous].delete(product_id) if previous is not None else 0
+        return max(deleted, self.shards[self.ring.get_node(product_id)].delete(product_id))
+
+    def adjust_stock(self, deltas: Dict[str, int]) -> Dict[str, int]:
+        result = self.adjust_stock_many([deltas])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def adjust_stock_many(self, deltas_list: List[Dict[str, int]]) -> List[Union[Dict[str, int], Exception]]:
+        outcomes = self._adjust_stock_many(deltas_list)
+        if self.previous_ring is not None:
+            # Adjustments that missed a product moved in between were
+            # reverted, so they can run again.
+            retry = [position for position, outcome in enumerate(outcomes) if isinstance(outcome, NotFound)]
+            if retry:
+                for position, outcome in zip(retry, self._adjust_stock_many([deltas_list[i] for i in retry])):
+                    outcomes[position] = outcome
+        return outcomes
+
+    def _adjust_stock_many(self, deltas_list: List[Dict[str, int]]) -> List[Union[Dict[str, int], Exception]]:
+        # Split every adjustment into its per-shard parts and run each
+        # shard's parts as one pipelined call.
+        parts = defaultdict(list)
+        for position, deltas in enumerate(deltas_list):
+            for name, product_ids in self._group(deltas).items():
+                parts[name].append((position, {product_id: deltas[product_id] for product_id in product_ids}))
+
+        results = self._fan_out({
+            name: ('adjust_stock_many', [shard_deltas for _, shard_deltas in shard_parts])
+            for name, shard_parts in parts.items()
+        })
+
+        outcomes = [{} for _ in deltas_list]
+        applied = [[] for _ in deltas_list]
+        for name, shard_parts in parts.items():
+            for (position, shard_deltas), result in zip(shard_parts, results[name]):
+                if isinstance(result, Exception):
+                    outcomes[position] = result
+                    continue
+                applied[position].append((name, shard_deltas))
+                if isinstance(outcomes[position], dict):
+                    outcomes[position].update(result)
+
+        reverts = defaultdict(list)
+        for position, outcome in enumerate(outcomes):
+            if isinstance(outcome, (NotFound, OutOfStock)):
+                for name, shard_deltas in applied[position]:
+                    reverts[name].append({product_id: -delta for product_id, delta in shard_deltas.items()})
+        if reverts:
+            self._fan_out({name: ('adjust_stock_many', shard_reverts) for name, shard_reverts in reverts.items()})
+        return outcomes
+
+    def decrement_stock(self, product_id: str, amount: int) -> int:
+        return self.adjust_stock({product_id: -amount})[product_id]
+
+    def rebuild_index(self) -> int:
+        return sum(self._fan_out({name: ('rebuild_index',) for name in self.shards}).values())
+
+    def test_connection(self) -> None:
+        self._fan_out({name: ('test_connection',) for name in self.shards})
@@ -0,0 +1,115 @@
+""" Exports the product catalog to NDJSON and loads it back.
+
+Usage ::
+
+    python -m products.snapshot export --uri redis://localhost:6379/7 > catalog.ndjson
+    python -m products.snapshot import --uri redis://localhost:6379/7 < catalog.ndjson
+
+For a sharded catalog, name every shard like REDIS_SHARDS does, with the
+same REDIS_SHARD_VNODES, instead of `--uri` ::
+
+    python -m products.snapshot export \
+        --shard a=redis://localhost:6379/7 --shard b=redis://localhost:6380/7 > catalog.ndjson
+
+The export walks the id index in batches, so it holds one batch in memory
+and does not block Redis. Every line is one product as rendered by
+`render_product`. The import validates the products and writes them with
+one pipelined round trip per batch, indexes and JSON documents included.
+Products already stored are overwritten, others are kept.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import sys
+from typing import IO, Iterable, Union
+
+from marshmallow import ValidationError
+from redis import StrictRedis
+
+from products import schemas
+from products.dependencies import DEFAULT_BATCH_SIZE, StorageWrapper, render_product
+from products.sharding import DEFAULT_VNODES, HashRing, ShardedStorageWrapper, shard_argument
+
+Storage = Union[StorageWrapper, ShardedStorageWrapper]
+
+
+def export_snapshot(storage: Storage, output: IO[str]) -> int:
+    """ Writes every product to `output`, returns how many were written. """
+    exported = 0
+    for product in storage.list():
+        output.write(render_product(product))
+        output.write('\n')
+        exported += 1
+    return exported
+
+
+def import_snapshot(storage: Storage, lines: Iterable[str]) -> int:
+    """ Stores the products read from NDJSON `lines`, returns how many were
+    stored.
+
+    Raises ValueError for the first line that does not hold a valid
+    product. Batches before it are already stored.
+    """
+    imported = 0
+    numbered = ((number, line) for number, line in enumerate(lines, 1) if line.strip())
+    while True:
+        batch = list(itertools.islice(numbered, storage.batch_size))
+        if not batch:
+            return imported
+        products = []
+        for number, line in batch:
+            try:
+                products.append(schemas.Product(strict=True).load(json.loads(line)).data)
+            except (ValueError, ValidationError) as exc:
+                raise ValueError('Invalid product on line {}: {}'.format(number, exc))
+        storage.create_many(products)
+        imported += len(products)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export or import the product catalog as NDJSON.')
+    parser.add_argument('command', choices=['export', 'import'])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--uri', help='Redis URI of the catalog')
+    target.add_argument('--shard', type=shard_argument, action='append',
+                        help='a shard of the catalog as name=uri, repeat for every shard')
+    parser.add_argument('--vnodes', type=int, default=DEFAULT_VNODES)
+    parser.add_argument('--file', help='snapshot file, defaults to stdout or stdin')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--json-documents', action='store_true',
+                        help='also write JSON documents, see PRODUCT_JSON_DOCUMENTS')
+    args = parser.parse_args(argv)
+
+    if args.shard:
+        uris = dict(args.shard)
+        storage = ShardedStorageWrapper(
+            {
+                name: StorageWrapper(
+                    StrictRedis.from_url(uri), batch_size=args.batch_size, json_documents=args.json_documents
+                )
+                for name, uri in uris.items()
+            },
+            HashRing(uris, args.vnodes),
+            args.batch_size,
+        )
+    else:
+        storage = StorageWrapper(
+            StrictRedis.from_url(args.uri), batch_size=args.batch_size, json_documents=args.json_documents
+        )
+
+    if args.command == 'export':
+        with open(args.file, 'w') if args.file else contextlib.nullcontext(sys.stdout) as output:
+            count = export_snapshot(storage, output)
+        print('{} products exported'.format(count), file=sys.stderr)
+    else:
+        with open(args.file) if args.file else contextlib.nullcontext(sys.stdin) as lines:
+            try:
+                count = import_snapshot(storage, lines)
+            except ValueError as exc:
+                parser.exit(1, '{}\n'.format(exc))
+        print('{} products imported'.format(count), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
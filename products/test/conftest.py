@@ -37,6 +37,12 @@ def create_product(redis_client, product):
         redis_client.hmset(
             'products:{}'.format(new_product['id']),
             new_product)
+        redis_client.zadd('index:products', {new_product['id']: 0})
+        redis_client.zadd('index:products:title', {
+            '{}\x00{}'.format(' '.join(new_product['title'].lower().split()), new_product['id']): 0
+        })
+        for field in ('in_stock', 'passenger_capacity', 'maximum_speed'):
+            redis_client.zadd('index:products:{}'.format(field), {new_product['id']: new_product[field]})
         return new_product
     return create
 
@@ -0,0 +1,49 @@
+from mock import patch
+
+from products.cache import ProductCache
+
+
+def test_get_many_counts_hits_and_misses():
+    cache = ProductCache(max_size=10, ttl=30)
+    cache.set_many({'LZ127': {'id': 'LZ127'}})
+
+    found, missing = cache.get_many(['LZ127', 'LZ129'])
+
+    assert {'LZ127': {'id': 'LZ127'}} == found
+    assert ['LZ129'] == missing
+    assert 1 == cache.hits
+    assert 1 == cache.misses
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ProductCache(max_size=2, ttl=30)
+    cache.set_many({'LZ127': 1, 'LZ129': 2})
+    cache.get_many(['LZ127'])
+
+    cache.set_many({'LZ130': 3})
+
+    assert ['LZ127', 'LZ130'] == list(cache.entries)
+    assert 1 == cache.evictions
+
+
+def test_entries_expire_after_ttl():
+    cache = ProductCache(max_size=10, ttl=30)
+    with patch('products.cache.time.time', return_value=100):
+        cache.set_many({'LZ127': 1})
+    with patch('products.cache.time.time', return_value=130):
+        found, missing = cache.get_many(['LZ127'])
+
+    assert {} == found
+    assert ['LZ127'] == missing
+    assert 1 == cache.expirations
+    assert 0 == cache.metrics()['size']
+
+
+def test_invalidate():
+    cache = ProductCache(max_size=10, ttl=30)
+    cache.set_many({'LZ127': 1, 'LZ129': 2})
+
+    cache.invalidate(['LZ127', 'LZ130'])
+
+    assert ['LZ129'] == list(cache.entries)
+    assert 1 == cache.metrics()['invalidations']
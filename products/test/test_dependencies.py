@@ -1,8 +1,12 @@
+import json
+
 import pytest
+import redis
 from mock import Mock
 
 from nameko import config
-from products.dependencies import Storage
+from products.dependencies import Metrics, Storage, render_product
+from products.exceptions import OutOfStock
 
 
 @pytest.fixture
@@ -13,6 +17,145 @@ def storage(test_config):
     return provider.get_dependency({})
 
 
+def test_pool_is_configurable(test_config):
+    provider = Storage()
+    provider.container = Mock(config=config)
+    with config.patch({'REDIS_POOL': {'max_connections': 3, 'timeout': 1}}):
+        provider.setup()
+
+    assert 3 == provider.pool.max_connections
+    assert 1 == provider.pool.timeout
+
+
+def test_pool_metrics(test_config):
+    provider = Storage()
+    provider.container = Mock(config=config)
+    with config.patch({'REDIS_POOL': {'max_connections': 2}}):
+        provider.setup()
+
+    connection = provider.pool.get_connection('PING')
+    metrics = provider.metrics()['pool']
+    provider.pool.release(connection)
+
+    assert 2 == metrics['max_connections']
+    assert 1 == metrics['created']
+    assert 1 == metrics['in_use']
+    assert 0 == metrics['idle']
+    assert 0 == metrics['waits']
+    assert 0 == metrics['connection_errors']
+    assert 1 == provider.metrics()['pool']['idle']
+    assert provider.metrics()['cache'] is None
+
+
+@pytest.fixture
+def cached_storage(test_config):
+    provider = Storage()
+    provider.container = Mock(config=config)
+    with config.patch({'PRODUCT_CACHE': {'max_size': 10, 'ttl': 30}}):
+        provider.setup()
+    return provider.get_dependency({})
+
+
+def test_get_is_cached(cached_storage, products, redis_client):
+    cached_storage.get('LZ127')
+    redis_client.hset('products:LZ127', 'in_stock', 1)
+
+    assert 10 == cached_storage.get('LZ127')['in_stock']
+    assert 1 == cached_storage.cache.hits
+
+    cached_storage.invalidate(['LZ127'])
+
+    assert 1 == cached_storage.get('LZ127')['in_stock']
+
+
+def test_list_fills_cache(cached_storage, products):
+    list(cached_storage.list())
+
+    found, missing = cached_storage.get_many(['LZ127', 'LZ130', 'LZ1'])
+
+    assert ['LZ127', 'LZ130'] == [product['id'] for product in found]
+    assert ['LZ1'] == missing
+    assert 2 == cached_storage.cache.hits
+
+
+def test_writes_invalidate_cache(cached_storage, products):
+    cached_storage.get_many(['LZ127', 'LZ129', 'LZ130'])
+
+    cached_storage.adjust_stock({'LZ127': -1})
+    cached_storage.delete('LZ129')
+
+    assert 9 == cached_storage.get('LZ127')['in_stock']
+    with pytest.raises(cached_storage.NotFound):
+        cached_storage.get('LZ129')
+    assert ['LZ130'] == [product['id'] for product in cached_storage.get_many(['LZ130'])[0]]
+
+
+@pytest.fixture
+def json_storage(test_config):
+    provider = Storage()
+    provider.container = Mock(config=config)
+    with config.patch({'PRODUCT_JSON_DOCUMENTS': True}):
+        provider.setup()
+    return provider.get_dependency({})
+
+
+def test_get_json_renders_hash(storage, products, redis_client):
+    document = storage.get_json('LZ129')
+
+    assert products[1] == json.loads(document)
+    assert redis_client.get('json:products:LZ129') is None
+
+
+def test_json_documents_follow_writes(json_storage, product, redis_client):
+    json_storage.create(product)
+    assert product == json.loads(redis_client.get('json:products:LZ127'))
+
+    json_storage.adjust_stock({'LZ127': -3})
+    assert dict(product, in_stock=8) == json.loads(json_storage.get_json('LZ127'))
+
+    json_storage.delete('LZ127')
+    assert redis_client.get('json:products:LZ127') is None
+    with pytest.raises(json_storage.NotFound):
+        json_storage.get_json('LZ127')
+
+
+def test_stock_change_keeps_rendered_bytes(json_storage, product):
+    json_storage.create(dict(product, title='Zeppelin / Über "LZ" 127'))
+
+    json_storage.adjust_stock({'LZ127': -12})
+
+    assert render_product(json_storage.get('LZ127')) == json_storage.get_json('LZ127')
+
+
+def test_writes_drop_documents_when_disabled(storage, json_storage, product, redis_client):
+    json_storage.create(product)
+
+    storage.adjust_stock({'LZ127': -3})
+    assert redis_client.get('json:products:LZ127') is None
+
+    json_storage.get_json('LZ127')
+    storage.update('LZ127', {'maximum_speed': 140})
+    assert redis_client.get('json:products:LZ127') is None
+
+    json_storage.get_json('LZ127')
+    storage.create(dict(product, in_stock=1))
+    assert redis_client.get('json:products:LZ127') is None
+    assert dict(product, in_stock=1) == json.loads(json_storage.get_json('LZ127'))
+
+
+def test_json_document_written_on_first_read(json_storage, products, redis_client):
+    document = json_storage.get_json('LZ127')
+
+    assert products[0] == json.loads(document)
+    assert document == redis_client.get('json:products:LZ127').decode('utf-8')
+
+
+def test_rebuild_index_renders_json_documents(json_storage, products, redis_client):
+    json_storage.rebuild_index()
+
+    assert products[2] == json.loads(redis_client.get('json:products:LZ130'))
+
+
 def test_get_fails_on_not_found(storage):
     with pytest.raises(storage.NotFound) as exc:
         storage.get(2)
@@ -28,11 +171,43 @@ def test_get(storage, products):
     assert 11 == product['in_stock']
 
 
+def test_get_many(storage, products):
+    found, missing = storage.get_many(['LZ130', 'LZ1', 'LZ127', 'LZ130'])
+    assert ['LZ130', 'LZ127'] == [product['id'] for product in found]
+    assert ['LZ1'] == missing
+
+
 def test_list(storage, products):
     listed_products = storage.list()
     assert (products == sorted(list(listed_products), key=lambda x: x['id']))
 
 
+def test_list_reads_in_batches(storage, products):
+    storage.batch_size = 2
+    listed_products = list(storage.list())
+    assert products == listed_products
+
+
+def test_list_skips_missing_products(storage, products, redis_client):
+    redis_client.delete('products:LZ129')
+    listed_products = [product['id'] for product in storage.list()]
+    assert ['LZ127', 'LZ130'] == listed_products
+
+
+def test_list_page(storage, products):
+    first_page, last_id = storage.list_page(2)
+    assert ['LZ127', 'LZ129'] == [product['id'] for product in first_page]
+    assert 'LZ129' == last_id
+
+    second_page, last_id = storage.list_page(2, last_id)
+    assert ['LZ130'] == [product['id'] for product in second_page]
+    assert last_id is None
+
+
+def test_list_page_when_empty(storage):
+    assert ([], None) == storage.list_page(10)
+
+
 def test_create(product, redis_client, storage):
     storage.create(product)
 
@@ -43,6 +218,24 @@ def test_create(product, redis_client, storage):
     assert product['maximum_speed'] == int(stored_product[b'maximum_speed'])
     assert product['passenger_capacity'] == (int(stored_product[b'passenger_capacity']))
     assert product['in_stock'] == int(stored_product[b'in_stock'])
+    assert [b'LZ127'] == redis_client.zrange('index:products', 0, -1)
+    assert 72 == redis_client.zscore('index:products:passenger_capacity', 'LZ127')
+    assert 130 == redis_client.zscore('index:products:maximum_speed', 'LZ127')
+    assert 11 == redis_client.zscore('index:products:in_stock', 'LZ127')
+
+
+def test_create_many(storage, redis_client):
+    storage.batch_size = 2
+    new_products = [
+        {'id': 'LZ{}'.format(i), 'title': 'LZ {}'.format(i), 'passenger_capacity': 10,
+         'maximum_speed': 100, 'in_stock': i}
+        for i in range(5)
+    ]
+
+    storage.create_many(new_products)
+
+    assert new_products == sorted(storage.list(), key=lambda p: p['id'])
+    assert 5 == redis_client.zcard('index:products')
 
 
 def test_decrement_stock(storage, create_product, redis_client):
@@ -59,13 +252,201 @@ def test_decrement_stock(storage, create_product, redis_client):
     assert b'12' == product_three[b'in_stock']
 
 
+def test_adjust_stock(storage, products, redis_client):
+    in_stock = storage.adjust_stock({'LZ127': -3, 'LZ130': 5})
+
+    assert {'LZ127': 7, 'LZ130': 17} == in_stock
+    assert b'7' == redis_client.hget('products:LZ127', 'in_stock')
+    assert b'11' == redis_client.hget('products:LZ129', 'in_stock')
+    assert b'17' == redis_client.hget('products:LZ130', 'in_stock')
+    assert 7 == redis_client.zscore('index:products:in_stock', 'LZ127')
+    assert 17 == redis_client.zscore('index:products:in_stock', 'LZ130')
+
+
+def test_adjust_stock_fails_on_not_found(storage, products, redis_client):
+    with pytest.raises(storage.NotFound) as exc:
+        storage.adjust_stock({'LZ127': -3, 'LZ1': -1})
+
+    assert 'Product ID LZ1 does not exist' == exc.value.args[0]
+    assert b'10' == redis_client.hget('products:LZ127', 'in_stock')
+    assert not redis_client.exists('products:LZ1')
+
+
+def test_adjust_stock_refuses_negative_stock(storage, products, redis_client):
+    storage.prevent_negative_stock = True
+
+    with pytest.raises(OutOfStock) as exc:
+        storage.adjust_stock({'LZ127': -3, 'LZ129': -12})
+
+    assert 'Product ID LZ129 is out of stock' == exc.value.args[0]
+    assert b'10' == redis_client.hget('products:LZ127', 'in_stock')
+    assert b'11' == redis_client.hget('products:LZ129', 'in_stock')
+
+
+def test_adjust_stock_many(storage, products, redis_client):
+    storage.prevent_negative_stock = True
+
+    results = storage.adjust_stock_many([{'LZ127': -3}, {'LZ129': -12, 'LZ130': -1}, {'LZ130': -2}])
+
+    assert {'LZ127': 7} == results[0]
+    assert isinstance(results[1], OutOfStock)
+    assert {'LZ130': 10} == results[2]
+    assert b'11' == redis_client.hget('products:LZ129', 'in_stock')
+
+
 def test_delete(storage, products, redis_client):
 
     fields_deleted = storage.delete('LZ130')
-    keys = redis_client.keys()
+    keys = redis_client.keys('products:*')
 
     assert fields_deleted == 5
     assert redis_client.hgetall('products:LZ130') == {}
     assert len(keys) == 2
     for key in keys:
         assert b'products:LZ130' != key
+    assert [b'LZ127', b'LZ129'] == redis_client.zrange('index:products', 0, -1)
+    assert redis_client.zscore('index:products:in_stock', 'LZ130') is None
+    assert [b'lz 127 graf zeppelin\x00LZ127', b'lz 129 hindenburg\x00LZ129'] == \
+        redis_client.zrange('index:products:title', 0, -1)
+
+
+def test_update(json_storage, products, redis_client):
+    product = json_storage.update('LZ127', {'id': 'LZ1', 'title': 'Graf Zeppelin', 'maximum_speed': 140})
+
+    assert dict(products[0], title='Graf Zeppelin', maximum_speed=140) == product
+    assert product == json_storage.get('LZ127')
+    assert product == json.loads(redis_client.get('json:products:LZ127'))
+    assert 140 == redis_client.zscore('index:products:maximum_speed', 'LZ127')
+    assert ['LZ127'] == [found['id'] for found in json_storage.search_title('graf')]
+    assert redis_client.zscore('index:products:title', b'lz 127 graf zeppelin\x00LZ127') is None
+
+
+def test_update_fails_on_not_found(storage):
+    with pytest.raises(storage.NotFound):
+        storage.update('LZ1', {'title': 'LZ 1'})
+
+
+def test_rebuild_index(storage, products, redis_client):
+    redis_client.delete('index:products', 'index:products:in_stock')
+
+    indexed = storage.rebuild_index()
+
+    assert indexed == 3
+    assert [b'LZ127', b'LZ129', b'LZ130'] == redis_client.zrange('index:products', 0, -1)
+    assert [(b'LZ127', 10), (b'LZ129', 11), (b'LZ130', 12)] == redis_client.zrange(
+        'index:products:in_stock', 0, -1, withscores=True)
+
+
+@pytest.mark.parametrize('ranges, sort_by, descending, limit, expected', [
+    ({}, None, False, 10, ['LZ127', 'LZ129', 'LZ130']),
+    ({}, 'passenger_capacity', True, 2, ['LZ130', 'LZ129']),
+    ({'passenger_capacity': (30, None)}, None, False, 10, ['LZ129', 'LZ130']),
+    ({'maximum_speed': (130, None), 'in_stock': (None, 11)}, None, False, 10, ['LZ129']),
+    ({'maximum_speed': (130, 135), 'in_stock': (11, None)}, 'in_stock', True, 10, ['LZ130', 'LZ129']),
+    ({'maximum_speed': (130, 135), 'in_stock': (11, None)}, 'in_stock', True, 1, ['LZ130']),
+    ({'in_stock': (100, None)}, None, False, 10, []),
+])
+def test_search(ranges, sort_by, descending, limit, expected, storage, products):
+    storage.batch_size = 1
+
+    found = storage.search(ranges, sort_by, descending, limit)
+
+    assert expected == [product['id'] for product in found]
+
+
+@pytest.mark.parametrize('prefix, limit, expected', [
+    ('lz 1', 10, ['LZ127', 'LZ129', 'LZ130']),
+    ('  LZ 12 ', 10, ['LZ127', 'LZ129']),
+    ('lz 127 graf', 10, ['LZ127']),
+    ('LZ 13', 10, ['LZ130']),
+    ('', 2, ['LZ127', 'LZ129']),
+    ('zeppelin', 10, []),
+])
+def test_search_title(prefix, limit, expected, storage, products):
+    found = storage.search_title(prefix, limit)
+
+    assert expected == [product['id'] for product in found]
+
+
+def test_search_title_skips_and_removes_stale_titles(storage, products, redis_client):
+    storage.create(dict(products[0], title='Airship LZ 127'))
+    storage.create(dict(products[1], id='LZ128', title='LZ 128'))
+
+    found = storage.search_title('lz 12', limit=2)
+
+    assert ['LZ128', 'LZ129'] == [product['id'] for product in found]
+    assert redis_client.zscore('index:products:title', b'lz 127 graf zeppelin\x00LZ127') is None
+    assert ['LZ127'] == [product['id'] for product in storage.search_title('airship')]
+
+
+def test_metrics_collects_extension_metrics():
+    provider = Metrics()
+    entrypoint = Mock(method_name='handle_order_created')
+    entrypoint.metrics.return_value = {'batches': 1}
+    dependency = Mock(spec=['attr_name', 'metrics'], attr_name='storage')
+    dependency.metrics.return_value = {'in_use': 2}
+    provider.container = Mock(extensions={provider, entrypoint, dependency, Mock(spec=[])})
+
+    collect = provider.get_dependency({})
+
+    assert {'handle_order_created': {'batches': 1}, 'storage': {'in_use': 2}} == collect()
+
+
+@pytest.fixture
+def replica_client(test_config):
+    # A second database stands in for a replica that never catches up.
+    client = redis.StrictRedis(port=6379, db=8, password="password")
+    yield client
+    client.flushdb()
+
+
+@pytest.fixture
+def replicated_storage(replica_client):
+    provider = Storage()
+    provider.container = Mock(config=config)
+    with config.patch({'REDIS_REPLICAS': {
+        'uris': ['redis://:password@localhost:6379/8'], 'max_lag': 5, 'fallback_on_miss': True
+    }}):
+        provider.setup()
+    return provider
+
+
+def test_reads_use_primary_until_replica_is_current(replicated_storage, replica_client):
+    provider = replicated_storage
+    provider.check_replicas()
+
+    assert provider.replicas[0].lag is None
+    assert provider.get_dependency({}).read_client is provider.client
+
+    replica_client.set(provider.heartbeat_key, provider.client.get(provider.heartbeat_key))
+    provider.check_replicas()
+
+    assert provider.replicas[0].lag <= 5
+    assert provider.get_dependency({}).read_client is provider.replicas[0].client
+    assert provider.metrics()['replicas'][0]['lag'] == provider.replicas[0].lag
+
+
+def test_stale_replica_is_not_used(replicated_storage, replica_client):
+    provider = replicated_storage
+    replica_client.set(provider.heartbeat_key, 0)
+
+    provider.check_replicas()
+
+    assert provider.replicas[0].lag > 5
+    assert provider.get_dependency({}).read_client is provider.client
+
+
+def test_replica_misses_fall_back_to_primary(replicated_storage, replica_client, products):
+    provider = replicated_storage
+    replica_client.hmset('products:LZ127', dict(products[0], in_stock=1))
+    provider.replicas[0].lag = 0
+    storage = provider.get_dependency({})
+
+    found, missing = storage.get_many(['LZ127', 'LZ129', 'LZ1'])
+
+    assert [('LZ127', 1), ('LZ129', 11)] == [(product['id'], product['in_stock']) for product in found]
+    assert ['LZ1'] == missing
+
+    storage.create(dict(products[0], id='LZ131'))
+    assert storage.get('LZ131')['id'] == 'LZ131'
+    assert replica_client.hgetall('products:LZ131') == {}
@@ -0,0 +1,73 @@
+import pytest
+from mock import Mock, call
+
+from nameko import config
+from products.entrypoints import BatchEventHandler
+
+
+@pytest.fixture
+def create_handler():
+    def create(**kwargs):
+        handler = BatchEventHandler('orders', 'order_created', **kwargs)
+        handler.method_name = 'handle_order_created'
+        handler.container = Mock(service_name='products')
+        handler.container.spawn_managed_thread.side_effect = lambda fn, identifier: fn()
+        with config.patch({'AMQP_URI': 'memory://'}):
+            handler.setup()
+        handler.consumer = Mock()
+        return handler
+    return create
+
+
+@pytest.mark.parametrize('batch_size, prefetch_count, expected', [
+    (50, 10, 50),
+    (5, 10, 10),
+])
+def test_prefetch_count_covers_batch_size(batch_size, prefetch_count, expected):
+    handler = BatchEventHandler('orders', 'order_created', batch_size=batch_size, prefetch_count=prefetch_count)
+    handler.container = Mock(service_name='products')
+    with config.patch({'AMQP_URI': 'memory://'}):
+        handler.setup()
+    assert expected == handler.consumer.prefetch_count
+
+
+def test_dispatches_full_batches(create_handler):
+    handler = create_handler(batch_size=2, window=10)
+
+    handler.handle_message({'order': 1}, Mock(headers={}))
+    assert handler.container.spawn_worker.call_count == 0
+
+    handler.handle_message({'order': 2}, Mock(headers={}))
+    assert handler.container.spawn_worker.call_count == 1
+
+    (entrypoint, args, kwargs), _ = handler.container.spawn_worker.call_args
+    assert ([{'order': 1}, {'order': 2}],) == args
+    assert handler.pending == []
+
+
+def test_flush_dispatches_partial_batch(create_handler):
+    handler = create_handler(batch_size=10, window=10)
+
+    handler.handle_message({'order': 1}, Mock(headers={}))
+    handler.flush()
+
+    assert handler.container.spawn_worker.call_count == 1
+    metrics = handler.metrics()
+    assert metrics['batches'] == 1
+    assert metrics['events'] == 1
+    assert metrics['last_batch_size'] == 1
+    assert metrics['pending'] == 0
+
+
+@pytest.mark.parametrize('requeue_on_error, exc_info, expected_method', [
+    (False, None, 'ack_message'),
+    (False, (Exception, Exception(), None), 'ack_message'),
+    (True, (Exception, Exception(), None), 'requeue_message'),
+])
+def test_batch_messages_are_processed_together(requeue_on_error, exc_info, expected_method, create_handler):
+    handler = create_handler(batch_size=2, requeue_on_error=requeue_on_error)
+    messages = [Mock(headers={}), Mock(headers={})]
+
+    handler.handle_result(messages, Mock(), exc_info=exc_info)
+
+    assert getattr(handler.consumer, expected_method).call_args_list == [call(message) for message in messages]
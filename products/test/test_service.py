@@ -5,13 +5,15 @@ import random
 import pytest
 
 from products.dependencies import NotFound
-from products.service import ProductsService
+from products.exceptions import InvalidCursor
+from products.service import ProductsService, decode_cursor, encode_cursor
 
 
 @pytest.fixture
 def service(test_config):
     service = ProductsService()
     service.storage = Mock()
+    service.event_dispatcher = Mock()
     return service
 
 
@@ -39,6 +41,16 @@ def test_get_product_fails_on_not_found(service):
     assert service.storage.get.call_count == 1
 
 
+def test_get_many_products(products, service):
+
+    service.storage.get_many.return_value = (products[:1], ['LZ1'])
+
+    result = service.get_many(['LZ127', 'LZ1'])
+
+    assert service.storage.get_many.call_args_list == [((['LZ127', 'LZ1'],),)]
+    assert {'products': products[:1], 'missing': ['LZ1']} == result
+
+
 def test_list_products(products, service):
 
     service.storage.list.return_value = products
@@ -62,11 +74,165 @@ def test_list_product_when_empty(service):
     assert [] == listed_products
 
 
+def test_list_page(products, service):
+
+    service.storage.list_page.return_value = (products[:2], 'LZ129')
+
+    page = service.list_page(2, encode_cursor('LZ100'))
+
+    assert service.storage.list_page.call_args_list == [((2, 'LZ100'),)]
+    assert ['LZ127', 'LZ129'] == [product['id'] for product in page['products']]
+    assert 'LZ129' == decode_cursor(page['next_cursor'])
+
+
+def test_list_page_clamps_limit(service):
+
+    service.storage.list_page.return_value = ([], None)
+
+    page = service.list_page(10 ** 6)
+
+    assert service.storage.list_page.call_args_list == [((1000, None),)]
+    assert {'products': [], 'next_cursor': None} == page
+
+
+def test_list_page_fails_on_invalid_cursor(service):
+
+    with pytest.raises(InvalidCursor):
+        service.list_page(10, 'not base64!')
+
+    assert service.storage.list_page.call_count == 0
+
+
+def test_search_products(products, service):
+
+    service.storage.search.return_value = products[1:]
+
+    found = service.search({'passenger_capacity': {'min': 30}, 'in_stock': {'max': 20}}, 'maximum_speed', True, 5)
+
+    assert service.storage.search.call_args_list == [
+        (({'passenger_capacity': (30, None), 'in_stock': (None, 20)}, 'maximum_speed', True, 5),)
+    ]
+    assert ['LZ129', 'LZ130'] == [product['id'] for product in found]
+
+
+@pytest.mark.parametrize('filters, sort_by, expected_errors', [
+    ({'title': {'min': 1}}, None, {'title': ['Not an indexed field.']}),
+    ({}, 'id', {'id': ['Not an indexed field.']}),
+    ({'in_stock': {'min': 'one'}}, None, {'min': ['Not a valid integer.']}),
+])
+def test_search_products_validation_error(filters, sort_by, expected_errors, service):
+
+    with pytest.raises(ValidationError) as exc_info:
+        service.search(filters, sort_by)
+
+    assert expected_errors == exc_info.value.args[0]
+    assert service.storage.search.call_count == 0
+
+
+def test_get_json(service):
+
+    service.storage.get_json.return_value = '{"id":"LZ127"}'
+
+    assert '{"id":"LZ127"}' == service.get_json('LZ127')
+    assert service.storage.get_json.call_args_list == [(('LZ127',),)]
+
+
+def test_search_title(products, service):
+
+    service.storage.search_title.return_value = products[:2]
+
+    found = service.search_title('lz 12', 5000)
+
+    assert service.storage.search_title.call_args_list == [(('lz 12', 1000),)]
+    assert ['LZ127', 'LZ129'] == [product['id'] for product in found]
+
+
+def test_update_product(product, service):
+
+    service.storage.update.return_value = dict(product, title='LZ 127 Graf Zeppelin')
+
+    updated = service.update('LZ127', {'title': 'LZ 127 Graf Zeppelin', 'id': 'LZ1'})
+
+    assert service.storage.update.call_args_list == [(('LZ127', {'title': 'LZ 127 Graf Zeppelin'}),)]
+    assert 'LZ 127 Graf Zeppelin' == updated['title']
+    assert service.event_dispatcher.call_args_list == [(('products_changed', {'ids': ['LZ127']}),)]
+
+
+def test_update_product_validation_error(service):
+
+    with pytest.raises(ValidationError) as exc_info:
+        service.update('LZ127', {'in_stock': 'many'})
+
+    assert {'in_stock': ['Not a valid integer.']} == exc_info.value.args[0]
+    assert service.storage.update.call_count == 0
+
+
+def test_restock_many(service):
+
+    service.storage.adjust_stock.return_value = {'LZ127': 15, 'LZ129': 11}
+
+    levels = service.restock_many({'LZ127': 5, 'LZ129': 0})
+
+    assert {'LZ127': 15, 'LZ129': 11} == levels
+    assert service.storage.adjust_stock.call_args_list == [(({'LZ127': 5, 'LZ129': 0},),)]
+    assert service.event_dispatcher.call_args_list == [(('products_changed', {'ids': ['LZ127', 'LZ129']}),)]
+
+
+def test_restock_many_validation_error(service):
+
+    with pytest.raises(ValidationError) as exc_info:
+        service.restock_many({'LZ127': 5, 'LZ129': '5', 'LZ130': True})
+
+    assert {'LZ129': ['Not a valid integer.'], 'LZ130': ['Not a valid integer.']} == exc_info.value.args[0]
+    assert service.storage.adjust_stock.call_count == 0
+
+
 def test_create_product(product, service):
 
     service.create(product)
 
     assert service.storage.create.call_count == 1
+    assert service.event_dispatcher.call_args_list == [(('products_changed', {'ids': ['LZ127']}),)]
+
+
+def test_create_product_without_cache_does_not_dispatch(product, service):
+
+    service.storage.caching = False
+
+    service.create(product)
+
+    assert service.event_dispatcher.call_count == 0
+
+
+def test_handle_products_changed(service):
+
+    service.handle_products_changed({'ids': ['LZ127']})
+
+    assert service.storage.invalidate.call_args_list == [((['LZ127'],),)]
+
+
+def test_create_many_products(product, service):
+
+    invalid_product = dict(product, id='LZ1', in_stock='many')
+
+    result = service.create_many([product, invalid_product, 'not-a-product'])
+
+    assert service.storage.create_many.call_args_list == [(([product],),)]
+    assert {
+        'created': ['LZ127'],
+        'errors': {
+            '1': {'in_stock': ['Not a valid integer.']},
+            '2': {'_schema': ['Invalid input type.']},
+        },
+    } == result
+
+
+def test_create_many_products_requires_a_list(product, service):
+
+    with pytest.raises(ValidationError):
+        service.create_many(product)
+
+    assert service.storage.create_many.call_count == 0
 
 
 def test_delete_product(product, service):
@@ -125,3 +291,26 @@ def test_handle_order_created(test_config, product, service):
     service.create(product)
 
     assert service.storage.create.call_count == 1
+
+
+def test_handle_order_created_adjusts_stock_once(service):
+
+    service.storage.adjust_stock_many.return_value = [{'LZ127': 5, 'LZ129': 10}, {'LZ130': 1}]
+
+    service.handle_order_created([
+        {'order': {'id': 1, 'order_details': [
+            {'product_id': 'LZ127', 'quantity': 2},
+            {'product_id': 'LZ129', 'quantity': 1},
+            {'product_id': 'LZ127', 'quantity': 3},
+        ]}},
+        {'order': {'id': 2, 'order_details': [
+            {'product_id': 'LZ130', 'quantity': 4},
+        ]}},
+    ])
+
+    assert service.storage.adjust_stock_many.call_args_list == [
+        (([{'LZ127': -5, 'LZ129': -1}, {'LZ130': -4}],),)
+    ]
+    assert service.event_dispatcher.call_args_list == [
+        (('products_changed', {'ids': ['LZ127', 'LZ129', 'LZ130']}),)
+    ]
@@ -0,0 +1,247 @@
+from mock import Mock
+import pytest
+import redis
+
+from nameko import config
+from products.dependencies import Storage, StorageWrapper
+from products.exceptions import OutOfStock
+from products.rebalance import move, rebalance
+from products.sharding import HashRing, ShardedStorageWrapper
+
+
+SHARD_URIS = {
+    'a': 'redis://:password@localhost:6379/9',
+    'b': 'redis://:password@localhost:6379/10',
+    'c': 'redis://:password@localhost:6379/11',
+}
+
+
+def make_product(product_id, in_stock=10):
+    return {
+        'id': product_id,
+        'title': 'LZ {}'.format(product_id),
+        'passenger_capacity': 10,
+        'maximum_speed': 100,
+        'in_stock': in_stock,
+    }
+
+
+@pytest.fixture
+def shard_clients(test_config):
+    clients = {
+        name: redis.StrictRedis(port=6379, db=int(uri.rsplit('/', 1)[1]), password="password")
+        for name, uri in SHARD_URIS.items()
+    }
+    yield clients
+    for client in clients.values():
+        client.flushdb()
+
+
+@pytest.fixture
+def sharded_storage(shard_clients):
+    ring = HashRing(['a', 'b'])
+    shards = {name: StorageWrapper(shard_clients[name], batch_size=2) for name in ring.nodes}
+    return ShardedStorageWrapper(shards, ring, batch_size=2)
+
+
+@pytest.fixture
+def spread_ids(sharded_storage):
+    """ Product ids covering both shards. """
+    ids = ['P{}'.format(number) for number in range(20)]
+    assert {'a', 'b'} == {sharded_storage.ring.get_node(product_id) for product_id in ids}
+    return ids
+
+
+def test_ring_is_deterministic():
+    assert [HashRing(['a', 'b']).get_node(str(n)) for n in range(50)] == \
+        [HashRing(['b', 'a']).get_node(str(n)) for n in range(50)]
+
+
+def test_adding_node_only_moves_keys_to_it():
+    old, new = HashRing(['a', 'b']), HashRing(['a', 'b', 'c'])
+    moved = [str(n) for n in range(1000) if old.get_node(str(n)) != new.get_node(str(n))]
+
+    assert moved
+    assert {'c'} == {new.get_node(product_id) for product_id in moved}
+
+
+def test_products_are_stored_on_their_shard(sharded_storage, shard_clients, spread_ids):
+    sharded_storage.create_many([make_product(product_id) for product_id in spread_ids])
+
+    for product_id in spread_ids:
+        owner = sharded_storage.ring.get_node(product_id)
+        for name in ('a', 'b'):
+            assert shard_clients[name].exists('products:{}'.format(product_id)) == (name == owner)
+    assert 'P3' == sharded_storage.get('P3')['id']
+
+
+def test_get_many_merges_shards(sharded_storage, spread_ids):
+    sharded_storage.create_many([make_product(product_id) for product_id in spread_ids[:6]])
+
+    found, missing = sharded_storage.get_many(['P5', 'P1', 'missing', 'P0'])
+
+    assert ['P5', 'P1', 'P0'] == [product['id'] for product in found]
+    assert ['missing'] == missing
+
+
+def test_list_page_walks_all_shards_in_order(sharded_storage, spread_ids):
+    sharded_storage.create_many([make_product(product_id) for product_id in spread_ids])
+
+    pages, after = [], None
+    while True:
+        products, after = sharded_storage.list_page(3, after)
+        pages.append([product['id'] for product in products])
+        if after is None:
+            break
+
+    assert sorted(spread_ids) == [product_id for page in pages for product_id in page]
+    assert all(len(page) == 3 for page in pages[:-1])
+    assert sorted(spread_ids) == [product['id'] for product in sharded_storage.list()]
+
+
+def test_search_merges_sorted_results(sharded_storage, spread_ids):
+    sharded_storage.create_many([
+        make_product(product_id, in_stock=number) for number, product_id in enumerate(spread_ids)
+    ])
+
+    found = sharded_storage.search({'in_stock': (5, None)}, sort_by='in_stock', descending=True, limit=4)
+
+    assert [19, 18, 17, 16] == [product['in_stock'] for product in found]
+
+
+def test_search_without_sort_merges_on_one_field(sharded_storage, spread_ids):
+    sharded_storage.create_many([
+        dict(make_product(product_id, in_stock=number), maximum_speed=100 - number)
+        for number, product_id in enumerate(spread_ids)
+    ])
+
+    found = sharded_storage.search({'in_stock': (None, None), 'maximum_speed': (90, None)}, limit=5)
+
+    assert [90, 91, 92, 93, 94] == [product['maximum_speed'] for product in found]
+
+
+def test_search_title_merges_shards(sharded_storage, spread_ids):
+    sharded_storage.create_many([
+        dict(make_product(product_id), title='Ship {:02d}'.format(number))
+        for number, product_id in enumerate(spread_ids)
+    ])
+
+    found = sharded_storage.search_title('ship 1', limit=4)
+
+    assert ['Ship 10', 'Ship 11', 'Ship 12', 'Ship 13'] == [product['title'] for product in found]
+
+
+def test_cross_shard_adjustment_is_reverted(sharded_storage, spread_ids):
+    on_a = next(i for i in spread_ids if sharded_storage.ring.get_node(i) == 'a')
+    on_b = next(i for i in spread_ids if sharded_storage.ring.get_node(i) == 'b')
+    sharded_storage.create_many([make_product(on_a), make_product(on_b, in_stock=1)])
+    sharded_storage.shards['b'].prevent_negative_stock = True
+
+    results = sharded_storage.adjust_stock_many([{on_a: -2, on_b: -2}, {on_a: -1, on_b: -1}])
+
+    assert isinstance(results[0], OutOfStock)
+    assert 0 == results[1][on_b]
+    assert 9 == sharded_storage.get(on_a)['in_stock']
+    assert 0 == sharded_storage.get(on_b)['in_stock']
+
+
+def test_provider_builds_sharded_storage(shard_clients):
+    provider = Storage()
+    provider.container = Mock(config=config)
+    with config.patch({'REDIS_SHARDS': {'a': SHARD_URIS['a'], 'b': SHARD_URIS['b']}}):
+        provider.setup()
+
+    storage = provider.get_dependency({})
+
+    assert isinstance(storage, ShardedStorageWrapper)
+    assert {'a', 'b'} == set(provider.metrics()['shards'])
+
+
+@pytest.fixture
+def adding_shard(shard_clients, spread_ids):
+    """ Products stored on shards a and b, which are joined by c. """
+    old_ring, new_ring = HashRing(['a', 'b']), HashRing(['a', 'b', 'c'])
+    shards = {name: StorageWrapper(client, batch_size=3) for name, client in shard_clients.items()}
+    ShardedStorageWrapper({name: shards[name] for name in 'ab'}, old_ring, 3).create_many(
+        [make_product(product_id) for product_id in spread_ids]
+    )
+    moving = [product_id for product_id in spread_ids if new_ring.get_node(product_id) == 'c']
+    assert moving
+    return shards, old_ring, new_ring, moving
+
+
+def test_products_are_read_from_previous_owner_until_moved(adding_shard, spread_ids):
+    shards, old_ring, new_ring, moving = adding_shard
+    storage = ShardedStorageWrapper(shards, new_ring, 3, previous_ring=old_ring)
+
+    assert 10 == storage.get(moving[0])['in_stock']
+    assert 9 == storage.decrement_stock(moving[0], 1)
+    assert not any(shards['c'].holds(moving))
+    found, missing = storage.get_many(spread_ids)
+    assert (len(spread_ids), []) == (len(found), missing)
+
+    rebalance(shards, old_ring, new_ring)
+
+    assert 9 == storage.get(moving[0])['in_stock']
+    assert all(shards['c'].holds(moving))
+
+
+def test_product_moved_after_being_looked_up_is_found(adding_shard):
+    shards, old_ring, new_ring, moving = adding_shard
+    storage = ShardedStorageWrapper(shards, new_ring, 3, previous_ring=old_ring)
+    # Each call looks the product up on its old shard once.
+    looked_up = {moving[0]: old_ring.get_node(moving[0])}
+    storage._holders = Mock(side_effect=[looked_up, looked_up, {moving[0]: 'c'}])
+    move(shards[old_ring.get_node(moving[0])], shards['c'], moving[0])
+
+    assert 10 == storage.get(moving[0])['in_stock']
+    assert {moving[0]: 8} == storage.adjust_stock({moving[0]: -2})
+
+
+def test_move_copies_again_after_concurrent_write(adding_shard):
+    shards, old_ring, _, moving = adding_shard
+    source = shards[old_ring.get_node(moving[0])]
+    create = shards['c'].create
+
+    def create_during_write(product):
+        if create_during_write.first:
+            create_during_write.first = False
+            source.decrement_stock(moving[0], 3)
+        create(product)
+    create_during_write.first = True
+    shards['c'].create = create_during_write
+
+    assert move(source, shards['c'], moving[0])
+
+    assert 7 == shards['c'].get(moving[0])['in_stock']
+    assert [False] == source.holds([moving[0]])
+
+
+def test_delete_while_moving_removes_the_copy(adding_shard):
+    shards, old_ring, new_ring, moving = adding_shard
+    source = shards[old_ring.get_node(moving[0])]
+    storage = ShardedStorageWrapper(shards, new_ring, 3, previous_ring=old_ring)
+    create = shards['c'].create
+
+    def create_during_delete(product):
+        create(product)
+        storage.delete(moving[0])
+    shards['c'].create = create_during_delete
+
+    assert not move(source, shards['c'], moving[0])
+
+    assert [False] == shards['c'].holds([moving[0]])
+    with pytest.raises(ShardedStorageWrapper.NotFound):
+        storage.get(moving[0])
+
+
+def test_rebalance_moves_products_to_new_shard(adding_shard, shard_clients, spread_ids):
+    shards, old_ring, new_ring, moving = adding_shard
+
+    moved = rebalance(shards, old_ring, new_ring)
+
+    assert {'c': len(moving)} == moved
+    storage = ShardedStorageWrapper(shards, new_ring, 3)
+    assert sorted(spread_ids) == [product['id'] for product in storage.list()]
+    assert sorted(moving) == [product['id'] for product in shards['c'].list()]
+    assert not any(shard_clients[name].exists('products:{}'.format(i)) for name in 'ab' for i in moving)
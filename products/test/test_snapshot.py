@@ -0,0 +1,75 @@
+import io
+import json
+
+import pytest
+import redis
+
+from products.dependencies import StorageWrapper
+from products.sharding import HashRing
+from products.snapshot import export_snapshot, import_snapshot, main
+
+
+@pytest.fixture
+def storage(redis_client):
+    return StorageWrapper(redis_client, batch_size=2)
+
+
+def test_export(storage, products):
+    output = io.StringIO()
+
+    assert 3 == export_snapshot(storage, output)
+    assert products == [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_import_restores_products_and_indexes(storage, products, redis_client):
+    output = io.StringIO()
+    export_snapshot(storage, output)
+    redis_client.flushdb()
+
+    assert 3 == import_snapshot(storage, io.StringIO(output.getvalue() + '\n'))
+
+    assert products == list(storage.list())
+    assert ['LZ130'] == [product['id'] for product in storage.search({'in_stock': (12, None)})]
+    assert ['LZ129'] == [product['id'] for product in storage.search_title('lz 129')]
+
+
+def test_import_reports_invalid_line(storage, product):
+    lines = [json.dumps(product), json.dumps(product), '{"id": "LZ1"}']
+
+    with pytest.raises(ValueError) as exc_info:
+        import_snapshot(storage, lines)
+
+    assert exc_info.value.args[0].startswith('Invalid product on line 3:')
+    assert 'LZ127' == storage.get('LZ127')['id']
+
+
+@pytest.fixture
+def shard_clients(test_config):
+    clients = {name: redis.StrictRedis(port=6379, db=db, password="password") for name, db in (('a', 9), ('b', 10))}
+    yield clients
+    for client in clients.values():
+        client.flushdb()
+
+
+def test_import_and_export_sharded_catalog(shard_clients, product, tmp_path):
+    ring = HashRing(['a', 'b'])
+    products = [dict(product, id='P{}'.format(number)) for number in range(10)]
+    assert {'a', 'b'} == {ring.get_node(stored['id']) for stored in products}
+    snapshot = tmp_path / 'catalog.ndjson'
+    snapshot.write_text(''.join(json.dumps(line) + '\n' for line in products))
+    shards = ['--shard', 'a=redis://:password@localhost:6379/9', '--shard', 'b=redis://:password@localhost:6379/10']
+
+    main(['import', '--file', str(snapshot)] + shards)
+
+    for stored in products:
+        owner = ring.get_node(stored['id'])
+        assert all(
+            client.exists('products:{}'.format(stored['id'])) == (name == owner)
+            for name, client in shard_clients.items()
+        )
+
+    exported = tmp_path / 'exported.ndjson'
+    main(['export', '--file', str(exported)] + shards)
+    assert sorted(products, key=lambda found: found['id']) == [
+        json.loads(line) for line in exported.read_text().splitlines()
+    ]